@@ -7,6 +7,7 @@ from broadway.api.utils.bootstrap import (
     initialize_database,
     initialize_logger,
     initialize_course_tokens,
+    initialize_queue,
     initialize_signal_handler,
     initialize_app,
 )
@@ -24,6 +25,7 @@ def __main__():
 
     initialize_database(settings, flags)
     initialize_course_tokens(settings, flags)
+    initialize_queue(settings, flags)
     initialize_signal_handler(settings, flags)
     initialize_app(settings, flags)
 
@@ -32,6 +34,7 @@ def __main__():
     tornado.ioloop.IOLoop.current().start()
 
     tornado.ioloop.IOLoop.current().close(all_fds=True)
+    settings["DB_EXECUTOR"].shutdown()
     settings["DB"].close()
 
     logger.info("shutted down")
@@ -1,5 +1,7 @@
 import logging
 
+from tornado import gen
+
 import broadway.api.daos as daos
 from broadway.api.models.grading_job import GradingJobType
 from broadway.api.models.grading_run import GradingRunState
@@ -8,9 +10,10 @@ from broadway.api.utils.run import continue_grading_run, fail_grading_run
 logger = logging.getLogger(__name__)
 
 
+@gen.coroutine
 def job_update_callback(settings, grading_job_id, grading_run_id):
     job_dao = daos.GradingJobDao(settings)
-    job = job_dao.find_by_id(grading_job_id)
+    job = yield job_dao.aio.find_by_id(grading_job_id)
     if job is None:
         logger.critical(
             "cannot update non-existent job with ID '{}'".format(grading_job_id)
@@ -18,7 +21,7 @@ def job_update_callback(settings, grading_job_id, grading_run_id):
         return
 
     run_dao = daos.GradingRunDao(settings)
-    run = run_dao.find_by_id(grading_run_id)
+    run = yield run_dao.aio.find_by_id(grading_run_id)
     if run is None:
         logger.critical(
             "cannot update non-existent run with ID '{}'".format(grading_run_id)
@@ -32,16 +35,24 @@ def job_update_callback(settings, grading_job_id, grading_run_id):
 
     stream_queue = settings["STREAM_QUEUE"]
     if job.success:
-        stream_queue.update_job_state(job.id, GradingRunState.FINISHED.name)
+        stream_queue.update_job_state(
+            job.id, GradingRunState.FINISHED.name, run_id=job.run_id
+        )
     else:
-        stream_queue.update_job_state(job.id, GradingRunState.FAILED.name)
+        stream_queue.update_job_state(
+            job.id, GradingRunState.FAILED.name, run_id=job.run_id
+        )
     stream_queue.send_close_event(job.id)
 
+    settings["COURSE_OVERVIEW"].record_finished_job(
+        job.course_id, run.id, not job.success
+    )
+
     if job.type == GradingJobType.PRE_PROCESSING:
         if job.success:
-            continue_grading_run(settings, run)
+            yield continue_grading_run(settings, run)
         else:
-            fail_grading_run(settings, run)
+            yield fail_grading_run(settings, run)
     elif job.type == GradingJobType.POST_PROCESSING:
         if run.student_jobs_left != 0:
             logger.critical(
@@ -52,9 +63,9 @@ def job_update_callback(settings, grading_job_id, grading_run_id):
             return
 
         if job.success:
-            continue_grading_run(settings, run)
+            yield continue_grading_run(settings, run)
         else:
-            fail_grading_run(settings, run)
+            yield fail_grading_run(settings, run)
     elif job.type == GradingJobType.STUDENT:
         if run.student_jobs_left <= 0:
             logger.critical(
@@ -64,11 +75,20 @@ def job_update_callback(settings, grading_job_id, grading_run_id):
             )
             return
 
-        run.student_jobs_left -= 1
-        run_dao.update(run)
+        # jobs of a run finish concurrently, so the counter is decremented in the
+        # database and only the callback that brings it to zero moves the run on
+        run = yield run_dao.aio.decrement_student_jobs_left(run.id)
+        if run is None:
+            logger.critical(
+                "cannot update run with ID '{}' (no student jobs left)".format(
+                    grading_run_id
+                )
+            )
+            return
+        settings["COURSE_OVERVIEW"].update_run(run)
 
         if run.student_jobs_left == 0:
             # last job in this stage is complete
-            continue_grading_run(settings, run)
+            yield continue_grading_run(settings, run)
     else:
         logger.critical("cannot update run with last job type '{}'".format(job.type))
@@ -5,69 +5,95 @@ from queue import Empty
 import tornado
 import tornado.ioloop
 
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+
 from broadway.api.callbacks import job_update_callback
 from broadway.api.daos import GradingJobDao, WorkerNodeDao
+from broadway.api.models import GradingJobState
+from broadway.api.utils.run import fail_job, requeue_job
 from broadway.api.utils.time import get_time
 
-import random
-
 logger = logging.getLogger(__name__)
 
 
+@gen.coroutine
 def worker_heartbeat_callback(settings):
     """
-    Checks if any workers went offline (after 2 * heartbeat_interval seconds)
+    Checks if any workers went offline (after 2 * heartbeat_interval seconds), then
+    writes the heartbeats received since the last check
     """
     heartbeat_timestamp = get_time()
     heartbeat_interval = settings["FLAGS"]["heartbeat_interval"]
     conn_map = settings["WS_CONN_MAP"]
 
     dao = WorkerNodeDao(settings)
+    registry = settings["WORKER_REGISTRY"]
+
+    # websocket workers are tracked in memory, http workers only in the database.
+    # the heartbeats of both are read from memory, as they may not be written yet
+    nodes = registry.get_workers()
+    nodes += yield dao.aio.find_by_liveness(alive=True, use_ws=False)
 
-    for node in dao.find_by_liveness(alive=True):
-        if (
-            heartbeat_timestamp - node.last_seen
-        ).total_seconds() >= 2 * heartbeat_interval:
+    for node in nodes:
+        last_seen = registry.get_last_seen(node)
+        if (heartbeat_timestamp - last_seen).total_seconds() >= 2 * heartbeat_interval:
             if node.use_ws and node.id in conn_map:
                 conn_map[node.id].close()
 
-            _handle_lost_worker_node(settings, node)
+            yield _handle_lost_worker_node(settings, node)
 
+    yield registry.flush_heartbeats(settings)
 
+
+@gen.coroutine
 def worker_lost_callback(settings, worker_id, reason="closed connection"):
-    dao = WorkerNodeDao(settings)
-    worker = dao.find_by_id(worker_id)
+    worker = settings["WORKER_REGISTRY"].get(worker_id)
 
     if worker is None:
-        logger.critical("dead worker {} not found".format(worker_id))
+        # e.g. the worker timed out before its connection was closed
+        logger.info("dead worker {} was already removed".format(worker_id))
         return
 
-    _handle_lost_worker_node(settings, worker, reason=reason)
+    yield _handle_lost_worker_node(settings, worker, reason=reason)
 
 
-# assign available jobs to whoever is currently not working
+# assign available jobs to the free slots of workers, and wake up http workers
+# waiting for a job if there are jobs left over
 # triggered upon the following events
 # 1. client submitting a new job
 # 2. worker finishing a job
+@gen.coroutine
 def worker_schedule_job(settings):
     conn_map = settings["WS_CONN_MAP"]
     job_queue = settings["QUEUE"]
     stream_queue = settings["STREAM_QUEUE"]
 
+    registry = settings["WORKER_REGISTRY"]
+
     grading_job_dao = GradingJobDao(settings)
-    worker_node_dao = WorkerNodeDao(settings)
 
-    idle_workers = worker_node_dao.find_by_idleness()
-    random.shuffle(idle_workers)
+    try:
+        while True:
+            idle_worker = registry.get_idle_worker()
+            if idle_worker is None:
+                break
 
-    for idle_worker in idle_workers:
-        if idle_worker.use_ws and idle_worker.id in conn_map:
-            conn = conn_map[idle_worker.id]
+            try:
+                queue_id, grading_job_id = job_queue.pull_with_queue_id()
+            except Empty:
+                # no more jobs available
+                return
 
+            grading_job = None
             try:
-                grading_job_id = job_queue.pull()
-                job_queue.update_all_job_positions(stream_queue)
-                grading_job = grading_job_dao.find_by_id(grading_job_id)
+                stream_queue.schedule_position_update(job_queue)
+
+                # the slot is taken before the job is loaded, so that schedules
+                # running concurrently do not hand it out twice
+                registry.assign(idle_worker.id, grading_job_id)
+                grading_job = yield grading_job_dao.aio.find_by_id(grading_job_id)
 
                 if not grading_job:
                     logger.critical(
@@ -75,39 +101,87 @@ def worker_schedule_job(settings):
                             grading_job_id
                         )
                     )
+                    registry.release(idle_worker.id, grading_job_id)
+                    job_queue.release(queue_id)
                     return
 
                 grading_job.started_at = get_time()
                 grading_job.worker_id = idle_worker.id
-                grading_job_dao.update(grading_job)
+                yield grading_job_dao.aio.update(grading_job)
 
-                idle_worker.running_job_id = grading_job_id
-                idle_worker.jobs_processed += 1
-                worker_node_dao.update(idle_worker)
+                stream_queue.update_job_state(
+                    grading_job_id,
+                    GradingJobState.STARTED.name,
+                    run_id=grading_job.run_id,
+                )
 
-                conn.send(
+                conn_map[idle_worker.id].send(
                     {"grading_job_id": grading_job_id, "stages": grading_job.stages}
                 )
 
-            except Empty:
-                # no more jobs available
-                return
+            except (KeyError, WebSocketClosedError, StreamClosedError) as e:
+                # the worker went away, so no more jobs are sent to it
+                logger.critical(
+                    "failed to send job to {}: {}".format(idle_worker.id, repr(e))
+                )
+                registry.disconnect(idle_worker.id)
+                yield _requeue_unassigned_job(
+                    settings, idle_worker, queue_id, grading_job_id, grading_job
+                )
 
             except Exception as e:
+                # e.g. the database is unavailable, which is not the worker's fault.
+                # the job is tried again on the next schedule rather than right away
                 logger.critical(
                     "failed to assign job to {}: {}".format(idle_worker.id, repr(e))
                 )
+                yield _requeue_unassigned_job(
+                    settings, idle_worker, queue_id, grading_job_id, grading_job
+                )
+                break
 
+        registry.wake_parked(job_queue.get_total_length())
+    finally:
+        registry.schedule_flush(settings)
 
+
+@gen.coroutine
+def _requeue_unassigned_job(settings, worker, queue_id, grading_job_id, grading_job):
+    if grading_job_id not in worker.running_job_ids:
+        # the worker was lost in the meantime, and its jobs were handled with it
+        return
+
+    # frees the worker's slot, unless it was disconnected
+    settings["WORKER_REGISTRY"].release(worker.id, grading_job_id)
+
+    if grading_job is not None:
+        try:
+            yield requeue_job(settings, grading_job)
+            return
+        except Exception as e:
+            logger.critical(
+                "failed to requeue job '{}': {}".format(grading_job_id, repr(e))
+            )
+
+    # without the job its cost, run and priority are unknown, but it is still put
+    # back at the head of its course's queue rather than being lost
+    job_queue = settings["QUEUE"]
+    job_queue.release(queue_id)
+    job_queue.push_front(queue_id, grading_job_id)
+    settings["STREAM_QUEUE"].schedule_position_update(job_queue)
+
+
+@gen.coroutine
 def _handle_lost_worker_node(settings, worker, reason="timeout"):
-    lost_run_id = worker.running_job_id
+    settings["WORKER_REGISTRY"].remove(worker.id)
+    lost_job_ids = worker.running_job_ids
 
     worker.is_alive = False
-    worker.running_job_id = None
+    worker.running_job_ids = []
     worker_dao = WorkerNodeDao(settings)
-    worker_dao.update(worker)
+    yield worker_dao.aio.update(worker)
 
-    if not lost_run_id:
+    if not lost_job_ids:
         logger.critical(
             "worker '{}' went offline unexpectedly on '{}' due to {}".format(
                 worker.id, worker.hostname, reason
@@ -117,30 +191,60 @@ def _handle_lost_worker_node(settings, worker, reason="timeout"):
 
     logger.critical(
         "worker '{}' went offline unexpectedly on '{}' while"
-        " executing '{}' due to {}".format(
-            worker.id, worker.hostname, lost_run_id, reason
+        " executing {} due to {}".format(
+            worker.id,
+            worker.hostname,
+            ", ".join("'{}'".format(job_id) for job_id in lost_job_ids),
+            reason,
         )
     )
 
+    # jobs are started in the order they were assigned, so anything past the
+    # worker's slots was still prefetched and can be handed to another worker
+    for lost_job_id in lost_job_ids[: worker.slots]:
+        yield _fail_lost_job(settings, lost_job_id)
+    for prefetched_job_id in lost_job_ids[worker.slots :]:
+        yield _requeue_prefetched_job(settings, prefetched_job_id)
+
+    if len(lost_job_ids) > worker.slots:
+        tornado.ioloop.IOLoop.current().add_callback(worker_schedule_job, settings)
+
+
+@gen.coroutine
+def _fail_lost_job(settings, lost_job_id):
     jobs_dao = GradingJobDao(settings)
-    job = jobs_dao.find_by_id(lost_run_id)
+    job = yield jobs_dao.aio.find_by_id(lost_job_id)
     if job is None:
         logger.critical(
             (
                 "worker was reportedly executing job '{}' "
                 "but this job does not exist"
-            ).format(lost_run_id)
+            ).format(lost_job_id)
         )
         return
+    if job.finished_at is not None:
+        # the worker reported the job as finished while it was being removed
+        return
+
+    yield fail_job(settings, job, "worker died while executing job")
 
-    job.finished_at = get_time()
-    job.success = False
-    job.results = [{"result": "worker died while executing job"}]
-    jobs_dao.update(job)
+    if job.course_id is not None:
+        settings["QUEUE"].release(job.course_id)
 
     tornado.ioloop.IOLoop.current().add_callback(
-        job_update_callback, settings, lost_run_id, job.run_id
+        job_update_callback, settings, lost_job_id, job.run_id
     )
 
 
+@gen.coroutine
+def _requeue_prefetched_job(settings, prefetched_job_id):
+    job = yield GradingJobDao(settings).aio.find_by_id(prefetched_job_id)
+    if job is None or job.course_id is None:
+        yield _fail_lost_job(settings, prefetched_job_id)
+        return
+
+    logger.info("requeueing prefetched job '{}'".format(prefetched_job_id))
+    yield requeue_job(settings, job)
+
+
 __all__ = ["worker_heartbeat_callback", "worker_lost_callback", "worker_schedule_job"]
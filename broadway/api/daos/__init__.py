@@ -5,7 +5,18 @@ from broadway.api.daos.grading_job_log import GradingJobLogDao
 from broadway.api.daos.grading_run import GradingRunDao
 from broadway.api.daos.worker_node import WorkerNodeDao
 
+# every DAO, e.g. for ensuring their indexes
+ALL_DAOS = [
+    AssignmentConfigDao,
+    CourseDao,
+    GradingJobDao,
+    GradingJobLogDao,
+    GradingRunDao,
+    WorkerNodeDao,
+]
+
 __all__ = [
+    "ALL_DAOS",
     "AssignmentConfigDao",
     "CourseDao",
     "GradingJobDao",
@@ -1,7 +1,6 @@
 from typing import Optional
 
 from broadway.api.daos.base import BaseDao
-from broadway.api.daos.decorators import validate_obj_size
 from broadway.api.models.assignment_config import AssignmentConfig
 
 
@@ -13,6 +12,8 @@ class AssignmentConfigDao(BaseDao):
     POST_PROCESSING_PIPELINE = "post_processing_pipeline"
     _COLLECTION = "assignment_config"
 
+    _QUERY_SHAPES = {"find_by_id": ({ID: "course/assignment"}, None)}
+
     def __init__(self, app):
         super().__init__(app)
         self._collection = self._get_primary_collection(AssignmentConfigDao._COLLECTION)
@@ -21,9 +22,8 @@ class AssignmentConfigDao(BaseDao):
     def id_from(course_id, assignment_name):
         return "{}/{}".format(course_id, assignment_name)
 
-    @validate_obj_size
     def insert(self, obj):
-        return self._collection.insert_one(self._to_store(obj))
+        return self._insert_one(self._to_store(obj))
 
     def find_by_id(self, id_):
         return self._from_store(
@@ -1,17 +1,74 @@
+import functools
+
 from typing import Optional
 
 import bson
 
+from bson.raw_bson import RawBSONDocument
 from pymongo import MongoClient
 from pymongo.collection import Collection
+from pymongo.errors import DocumentTooLarge, WriteError
+from pymongo.results import InsertManyResult, InsertOneResult
+from tornado.ioloop import IOLoop
+
+# error codes of the server for a document that grew past the maximum size
+BSON_OBJECT_TOO_LARGE = (10334, 17419)
+
+
+def _get_stages(plan):
+    yield plan["stage"]
+
+    children = plan.get("inputStages", [])
+    if "inputStage" in plan:
+        children = [plan["inputStage"]]
+    for child in children:
+        yield from _get_stages(child)
+
+
+class AsyncDao:
+    """
+    Exposes the methods of a DAO as coroutine equivalents that run on the database
+    thread pool, so that a slow query does not hold up the IOLoop. Each method
+    returns a future resolving to what the DAO method returns.
+    """
+
+    def __init__(self, dao, executor):
+        self._dao = dao
+        self._executor = executor
+
+    def __getattr__(self, name):
+        attr = getattr(self._dao, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def method(*args, **kwargs):
+            return IOLoop.current().run_in_executor(
+                self._executor, functools.partial(attr, *args, **kwargs)
+            )
+
+        return method
 
 
 class BaseDao:
     ID = "_id"
+    # the indexes (`pymongo.IndexModel`s) that the queries of the DAO need, and a
+    # sample filter and sort of each of those queries, whose query plans are checked
+    # against the indexes by the tests
+    _INDEXES = []
+    _QUERY_SHAPES = {}
+    # the stored field of each model attribute, for updating only what changed
+    _FIELDS = {}
 
     def __init__(self, settings):
         self._config: dict = settings["FLAGS"]
         self._client: MongoClient = settings["DB"]
+        # None runs queries on the IOLoop's default executor
+        self._executor = settings.get("DB_EXECUTOR")
+
+    @property
+    def aio(self) -> AsyncDao:
+        return AsyncDao(self, self._executor)
 
     def _get_log_collection(self, collection_name) -> Collection:
         return self._client[self._config["mongodb_logs"]][collection_name]
@@ -19,11 +76,106 @@ class BaseDao:
     def _get_primary_collection(self, collection_name) -> Collection:
         return self._client[self._config["mongodb_primary"]][collection_name]
 
+    def ensure_indexes(self):
+        """
+        Creates the indexes of the DAO that do not exist yet
+        """
+        if self._INDEXES:
+            self._collection.create_indexes(self._INDEXES)
+
+    def explain_queries(self):
+        """
+        Returns the stages of the winning query plan of each of the DAO's query
+        shapes, e.g. `{"find_by_run_id": ["FETCH", "IXSCAN"]}`
+        """
+        plans = {}
+        for name, (pattern, sort) in self._QUERY_SHAPES.items():
+            explanation = self._collection.find(pattern, sort=sort).explain()
+            plans[name] = list(_get_stages(explanation["queryPlanner"]["winningPlan"]))
+        return plans
+
+    def _update_one(self, pattern, obj):
+        """
+        Writes the fields of a model that changed since it was loaded or stored. If
+        the update cannot be encoded or written, the fields are kept marked as
+        changed. Returns None if nothing changed.
+
+        Raises DocumentTooLarge both for an update that is too large itself and for
+        one that would make the stored document too large.
+        """
+        changes, increments = obj.pop_changes()
+        try:
+            update = self._to_update(obj, changes, increments)
+            if not update:
+                return None
+            try:
+                return self._collection.update_one(pattern, self._encode(update))
+            except WriteError as e:
+                if e.code not in BSON_OBJECT_TOO_LARGE:
+                    raise
+                raise DocumentTooLarge(
+                    "{} document would be larger than the maximum after the "
+                    "update".format(self._collection.name)
+                ) from e
+        except Exception:
+            obj.restore_changes(changes, increments)
+            raise
+
+    def _to_update(self, obj, changes, increments) -> dict:
+        """
+        Builds an update of the given changes of a model (see
+        `BaseModel.pop_changes`), which increments counters rather than overwriting
+        them. Empty if nothing changed.
+        """
+        document = self._to_store(obj)
+
+        update = {}
+        fields = [self._FIELDS[name] for name in changes if name in self._FIELDS]
+        if fields:
+            update["$set"] = {field: document[field] for field in fields}
+        if increments:
+            update["$inc"] = {
+                self._FIELDS[name]: amount for name, amount in increments.items()
+            }
+        return update
+
     def _to_store(self, obj) -> dict:
         raise NotImplementedError("_to_store not implemented")
 
     def _from_store(self, obj) -> Optional["BaseDao"]:
         raise NotImplementedError("_from_store not implemented")
 
-    def is_obj_size_valid(self, obj) -> bool:
-        return len(bson.BSON.encode(self._to_store(obj))) <= self._client.max_bson_size
+    def _insert_one(self, document) -> InsertOneResult:
+        """
+        Inserts a document, which must have its ID. pymongo does not read the ID
+        back from the encoded document it is given, so the result carries the ID of
+        the document itself.
+        """
+        result = self._collection.insert_one(self._encode(document))
+        return InsertOneResult(document[self.ID], result.acknowledged)
+
+    def _insert_many(self, documents) -> InsertManyResult:
+        """
+        Inserts documents, which must have their IDs, in order. Every document is
+        encoded before any is sent.
+        """
+        encoded = [self._encode(document) for document in documents]
+        result = self._collection.insert_many(encoded, ordered=True)
+        return InsertManyResult(
+            [document[self.ID] for document in documents], result.acknowledged
+        )
+
+    def _encode(self, document) -> RawBSONDocument:
+        """
+        Encodes a document or an update once, so that its size is checked on the
+        same bytes that are sent to the database. Raises `DocumentTooLarge` if the
+        database would reject it.
+        """
+        data = bson.BSON.encode(document)
+        if len(data) > self._client.max_bson_size:
+            raise DocumentTooLarge(
+                "{} document of {} bytes is larger than the maximum of {}".format(
+                    self._collection.name, len(data), self._client.max_bson_size
+                )
+            )
+        return RawBSONDocument(data)
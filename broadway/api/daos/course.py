@@ -1,7 +1,6 @@
 from typing import Optional
 
 from broadway.api.daos.base import BaseDao
-from broadway.api.daos.decorators import validate_obj_size
 from broadway.api.models import Course
 
 
@@ -9,22 +8,28 @@ class CourseDao(BaseDao):
     ID = "_id"
     TOKENS = "tokens"
     QUERY_TOKENS = "query_tokens"
+    WEIGHT = "weight"
+    MAX_CONCURRENCY = "max_concurrency"
     _COLLECTION = "course"
 
+    _QUERY_SHAPES = {"find_by_id": ({ID: "course"}, None)}
+
     def __init__(self, app):
         super().__init__(app)
         self._collection = self._get_primary_collection(CourseDao._COLLECTION)
 
-    @validate_obj_size
     def insert_or_update(self, obj):
         document = self._to_store(obj)
         return self._collection.update_one(
-            {CourseDao.ID: obj.id}, {"$set": document}, upsert=True
+            {CourseDao.ID: obj.id}, self._encode({"$set": document}), upsert=True
         )
 
     def find_by_id(self, id_):
         return self._from_store(self._collection.find_one({CourseDao.ID: id_}))
 
+    def find_all(self):
+        return list(map(self._from_store, self._collection.find()))
+
     def drop_all(self):
         return self._collection.delete_many({})
 
@@ -35,6 +40,8 @@ class CourseDao(BaseDao):
             "id_": obj.get(CourseDao.ID),
             "tokens": obj.get(CourseDao.TOKENS),
             "query_tokens": obj.get(CourseDao.QUERY_TOKENS),
+            "weight": obj.get(CourseDao.WEIGHT, 1),
+            "max_concurrency": obj.get(CourseDao.MAX_CONCURRENCY),
         }
         return Course(**attrs)
 
@@ -43,4 +50,6 @@ class CourseDao(BaseDao):
             CourseDao.ID: obj.id,
             CourseDao.TOKENS: obj.tokens,
             CourseDao.QUERY_TOKENS: obj.query_tokens,
+            CourseDao.WEIGHT: obj.weight,
+            CourseDao.MAX_CONCURRENCY: obj.max_concurrency,
         }
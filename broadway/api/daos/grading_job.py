@@ -1,9 +1,9 @@
 from typing import Optional
 
 from bson import ObjectId
+from pymongo import IndexModel
 
 from broadway.api.daos.base import BaseDao
-from broadway.api.daos.decorators import validate_obj_size
 from broadway.api.models.grading_job import GradingJob, GradingJobType
 
 
@@ -11,6 +11,7 @@ class GradingJobDao(BaseDao):
     ID = "_id"
     TYPE = "type"
     RUN_ID = "grading_run_id"
+    COURSE_ID = "course_id"
     WORKER_ID = "worker_id"
     QUEUED_AT = "queued_at"
     STARTED_AT = "started_at"
@@ -21,15 +22,55 @@ class GradingJobDao(BaseDao):
     STUDENTS = "students"
     _COLLECTION = "grading_job"
 
+    _INDEXES = [
+        IndexModel([(RUN_ID, 1), (TYPE, 1)]),
+        # unfinished jobs, oldest first, for recovering the queue
+        IndexModel([(FINISHED_AT, 1), (STARTED_AT, 1), (QUEUED_AT, 1), (ID, 1)]),
+    ]
+    _QUERY_SHAPES = {
+        "find_by_id": ({ID: ObjectId()}, None),
+        "find_by_run_id": ({RUN_ID: "run", TYPE: GradingJobType.STUDENT.value}, None),
+        "find_states_by_run_id": ({RUN_ID: "run"}, None),
+        "count_by_run_id": ({RUN_ID: "run", FINISHED_AT: {"$ne": None}}, None),
+        "find_states_by_ids": ({ID: {"$in": [ObjectId()]}, COURSE_ID: "course"}, None),
+        "find_queued": (
+            {STARTED_AT: None, FINISHED_AT: None},
+            [(QUEUED_AT, 1), (ID, 1)],
+        ),
+        "find_running": ({STARTED_AT: {"$ne": None}, FINISHED_AT: None}, None),
+    }
+    _FIELDS = {
+        "type": TYPE,
+        "run_id": RUN_ID,
+        "course_id": COURSE_ID,
+        "worker_id": WORKER_ID,
+        "queued_at": QUEUED_AT,
+        "started_at": STARTED_AT,
+        "finished_at": FINISHED_AT,
+        "results": RESULTS,
+        "success": SUCCESS,
+        "stages": STAGES,
+        "students": STUDENTS,
+    }
+
     def __init__(self, app):
         super().__init__(app)
         self._collection = self._get_primary_collection(GradingJobDao._COLLECTION)
 
-    @validate_obj_size
     def insert(self, obj):
-        document = self._to_store(obj)
-        del document[GradingJobDao.ID]
-        return self._collection.insert_one(document)
+        if obj.id is None:
+            obj.id = str(ObjectId())
+        result = self._insert_one(self._to_store(obj))
+        obj.mark_stored()
+        return result
+
+    def insert_many(self, objs):
+        """
+        Inserts jobs in a single round trip. The jobs must already have their IDs,
+        so they can be referenced (e.g. in their stages' environments) before they
+        are stored.
+        """
+        return self._insert_many([self._to_store(obj) for obj in objs])
 
     def find_by_id(self, id_):
         if not ObjectId.is_valid(id_):
@@ -38,17 +79,122 @@ class GradingJobDao(BaseDao):
             self._collection.find_one({GradingJobDao.ID: ObjectId(id_)})
         )
 
-    def find_by_run_id(self, run_id):
+    def find_by_run_id(self, run_id, job_type=None):
+        pattern = {GradingJobDao.RUN_ID: run_id}
+
+        if job_type is not None:
+            pattern[GradingJobDao.TYPE] = job_type.value
+
+        return list(map(self._from_store, self._collection.find(pattern)))
+
+    def find_states_by_run_id(self, run_id):
+        """
+        Returns the jobs of a run with only the fields needed for their states
+        """
+        return self._find_projected(
+            run_id,
+            [
+                GradingJobDao.TYPE,
+                GradingJobDao.QUEUED_AT,
+                GradingJobDao.STARTED_AT,
+                GradingJobDao.FINISHED_AT,
+                GradingJobDao.SUCCESS,
+            ],
+        )
+
+    def find_envs_by_run_id(self, run_id):
+        """
+        Returns the jobs of a run with only their types and, of the stages, only
+        their environments
+        """
+        return self._find_projected(
+            run_id, [GradingJobDao.TYPE, "{}.env".format(GradingJobDao.STAGES)]
+        )
+
+    def _find_projected(self, run_id, projection):
         return list(
-            map(self._from_store, self._collection.find({GradingJobDao.RUN_ID: run_id}))
+            map(
+                self._from_store,
+                self._collection.find(
+                    {GradingJobDao.RUN_ID: run_id}, projection=projection
+                ),
+            )
         )
 
-    @validate_obj_size
-    def update(self, obj):
-        return self._collection.update_one(
-            {GradingJobDao.ID: ObjectId(obj.id)}, {"$set": self._to_store(obj)}
+    def count_by_run_id(self, run_id, job_type=None, finished=None):
+        pattern = {GradingJobDao.RUN_ID: run_id}
+
+        if job_type is not None:
+            pattern[GradingJobDao.TYPE] = job_type.value
+        if finished is not None:
+            pattern[GradingJobDao.FINISHED_AT] = {"$ne": None} if finished else None
+
+        return self._collection.count_documents(pattern)
+
+    def find_states_by_ids(self, ids, course_id=None):
+        """
+        Returns the jobs with the given IDs, with only the fields needed for their
+        states
+        """
+        ids = [ObjectId(id_) for id_ in ids if ObjectId.is_valid(id_)]
+        pattern = {GradingJobDao.ID: {"$in": ids}}
+
+        if course_id is not None:
+            pattern[GradingJobDao.COURSE_ID] = course_id
+
+        return list(
+            map(
+                self._from_store,
+                self._collection.find(
+                    pattern,
+                    projection=[
+                        GradingJobDao.TYPE,
+                        GradingJobDao.FINISHED_AT,
+                        GradingJobDao.SUCCESS,
+                    ],
+                ),
+            )
+        )
+
+    def find_queued(self):
+        """
+        Returns all jobs that have not been started yet in the order they were
+        queued. Only the fields needed to put a job back into the queue are loaded
+        (of the stages, only their timeouts).
+        """
+        return list(
+            map(
+                self._from_store,
+                self._collection.find(
+                    {GradingJobDao.STARTED_AT: None, GradingJobDao.FINISHED_AT: None},
+                    projection=[
+                        GradingJobDao.TYPE,
+                        GradingJobDao.RUN_ID,
+                        GradingJobDao.COURSE_ID,
+                        GradingJobDao.QUEUED_AT,
+                        "{}.timeout".format(GradingJobDao.STAGES),
+                    ],
+                    sort=[(GradingJobDao.QUEUED_AT, 1), (GradingJobDao.ID, 1)],
+                ),
+            )
+        )
+
+    def find_running(self):
+        return list(
+            map(
+                self._from_store,
+                self._collection.find(
+                    {
+                        GradingJobDao.STARTED_AT: {"$ne": None},
+                        GradingJobDao.FINISHED_AT: None,
+                    }
+                ),
+            )
         )
 
+    def update(self, obj):
+        return self._update_one({GradingJobDao.ID: ObjectId(obj.id)}, obj)
+
     def _from_store(self, obj) -> Optional[GradingJob]:
         if obj is None:
             return None
@@ -56,6 +202,7 @@ class GradingJobDao(BaseDao):
             "id_": str(obj.get(GradingJobDao.ID)),
             "job_type": GradingJobType(obj.get(GradingJobDao.TYPE)),
             "run_id": obj.get(GradingJobDao.RUN_ID),
+            "course_id": obj.get(GradingJobDao.COURSE_ID),
             "worker_id": obj.get(GradingJobDao.WORKER_ID),
             "queued_at": obj.get(GradingJobDao.QUEUED_AT),
             "started_at": obj.get(GradingJobDao.STARTED_AT),
@@ -65,13 +212,16 @@ class GradingJobDao(BaseDao):
             "stages": obj.get(GradingJobDao.STAGES),
             "students": obj.get(GradingJobDao.STUDENTS),
         }
-        return GradingJob(**attrs)
+        job = GradingJob(**attrs)
+        job.mark_stored()
+        return job
 
     def _to_store(self, obj) -> dict:
         return {
             GradingJobDao.ID: ObjectId(obj.id) if obj.id is not None else obj.id,
             GradingJobDao.TYPE: obj.type.value,
             GradingJobDao.RUN_ID: obj.run_id,
+            GradingJobDao.COURSE_ID: obj.course_id,
             GradingJobDao.WORKER_ID: obj.worker_id,
             GradingJobDao.QUEUED_AT: obj.queued_at,
             GradingJobDao.STARTED_AT: obj.started_at,
@@ -1,9 +1,9 @@
 from typing import Optional
 
 from bson import ObjectId
+from pymongo import IndexModel
 
 from broadway.api.daos.base import BaseDao
-from broadway.api.daos.decorators import validate_obj_size
 from broadway.api.models import GradingJobLog
 
 
@@ -14,15 +14,48 @@ class GradingJobLogDao(BaseDao):
     STDERR = "stderr"
     _COLLECTION = "job_log"
 
+    _INDEXES = [IndexModel([(GRADING_JOB_ID, 1)])]
+    _QUERY_SHAPES = {
+        "find_by_id": ({ID: ObjectId()}, None),
+        "find_by_job_id": ({GRADING_JOB_ID: "job"}, None),
+    }
+
     def __init__(self, app):
         super().__init__(app)
         self._collection = self._get_log_collection(GradingJobLogDao._COLLECTION)
 
-    @validate_obj_size
     def insert(self, obj):
+        obj.id = str(ObjectId())
+        return self._insert_one(self._to_store(obj))
+
+    def append(self, job_id, stdout=None, stderr=None):
+        """
+        Appends output to the logs of a job, creating them if they do not exist yet.
+        Appended output is stored in chunks, which are joined when read.
+        """
+        chunks = {GradingJobLogDao.STDOUT: stdout, GradingJobLogDao.STDERR: stderr}
+        update = {
+            "$push": {key: chunk for key, chunk in chunks.items() if chunk is not None},
+            "$setOnInsert": {key: [] for key, chunk in chunks.items() if chunk is None},
+        }
+        return self._collection.update_one(
+            {GradingJobLogDao.GRADING_JOB_ID: job_id},
+            self._encode({op: fields for op, fields in update.items() if fields}),
+            upsert=True,
+        )
+
+    def replace(self, obj):
+        """
+        Replaces the logs of a job, e.g. the output stored while it ran with its
+        complete output, creating them if they do not exist yet
+        """
         document = self._to_store(obj)
         del document[GradingJobLogDao.ID]
-        return self._collection.insert_one(document)
+        return self._collection.replace_one(
+            {GradingJobLogDao.GRADING_JOB_ID: obj.job_id},
+            self._encode(document),
+            upsert=True,
+        )
 
     def find_by_id(self, id_):
         if not ObjectId.is_valid(id_):
@@ -41,11 +74,18 @@ class GradingJobLogDao(BaseDao):
         attrs = {
             "id_": str(obj.get(GradingJobLogDao.ID)),
             "job_id": obj.get(GradingJobLogDao.GRADING_JOB_ID),
-            "stdout": obj.get(GradingJobLogDao.STDOUT),
-            "stderr": obj.get(GradingJobLogDao.STDERR),
+            "stdout": self._join_chunks(obj.get(GradingJobLogDao.STDOUT)),
+            "stderr": self._join_chunks(obj.get(GradingJobLogDao.STDERR)),
         }
         return GradingJobLog(**attrs)
 
+    @staticmethod
+    def _join_chunks(output):
+        # see append
+        if isinstance(output, list):
+            return "".join(output)
+        return output
+
     def _to_store(self, obj) -> dict:
         return {
             GradingJobLogDao.ID: ObjectId(obj.id) if obj.id is not None else obj.id,
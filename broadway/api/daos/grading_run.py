@@ -1,9 +1,9 @@
 from typing import Optional
 
 from bson import ObjectId
+from pymongo import IndexModel, ReturnDocument
 
 from broadway.api.daos.base import BaseDao
-from broadway.api.daos.decorators import validate_obj_size
 from broadway.api.models import GradingRun, GradingRunState
 
 
@@ -20,15 +20,32 @@ class GradingRunDao(BaseDao):
     SUCCESS = "success"
     _COLLECTION = "grading_run"
 
+    _INDEXES = [IndexModel([(FINISHED_AT, 1)])]
+    _QUERY_SHAPES = {
+        "find_by_id": ({ID: ObjectId()}, None),
+        "find_unfinished": ({FINISHED_AT: None}, None),
+    }
+    _FIELDS = {
+        "state": STATE,
+        "assignment_id": ASSIGNMENT_ID,
+        "started_at": STARTED_AT,
+        "finished_at": FINISHED_AT,
+        "pre_processing_env": PRE_PROCESSING_ENV,
+        "post_processing_env": POST_PROCESSING_ENV,
+        "students_env": STUDENTS_ENV,
+        "student_jobs_left": STUDENT_JOBS_LEFT,
+        "success": SUCCESS,
+    }
+
     def __init__(self, app):
         super().__init__(app)
         self._collection = self._get_primary_collection(GradingRunDao._COLLECTION)
 
-    @validate_obj_size
     def insert(self, obj):
-        document = self._to_store(obj)
-        del document[GradingRunDao.ID]
-        return self._collection.insert_one(document)
+        obj.id = str(ObjectId())
+        result = self._insert_one(self._to_store(obj))
+        obj.mark_stored()
+        return result
 
     def find_by_id(self, id_):
         if not ObjectId.is_valid(id_):
@@ -37,10 +54,33 @@ class GradingRunDao(BaseDao):
             self._collection.find_one({GradingRunDao.ID: ObjectId(id_)})
         )
 
-    @validate_obj_size
+    def find_unfinished(self):
+        return list(
+            map(
+                self._from_store,
+                self._collection.find({GradingRunDao.FINISHED_AT: None}),
+            )
+        )
+
     def update(self, obj):
-        return self._collection.update_one(
-            {GradingRunDao.ID: ObjectId(obj.id)}, {"$set": self._to_store(obj)}
+        return self._update_one({GradingRunDao.ID: ObjectId(obj.id)}, obj)
+
+    def decrement_student_jobs_left(self, id_):
+        """
+        Atomically counts one more student job of an unfinished run as done, and
+        returns the updated run, or None if the run has no student jobs left. Unlike
+        `update`, finishing jobs concurrently cannot lose a decrement.
+        """
+        return self._from_store(
+            self._collection.find_one_and_update(
+                {
+                    GradingRunDao.ID: ObjectId(id_),
+                    GradingRunDao.FINISHED_AT: None,
+                    GradingRunDao.STUDENT_JOBS_LEFT: {"$gt": 0},
+                },
+                {"$inc": {GradingRunDao.STUDENT_JOBS_LEFT: -1}},
+                return_document=ReturnDocument.AFTER,
+            )
         )
 
     def _from_store(self, obj) -> Optional[GradingRun]:
@@ -58,7 +98,9 @@ class GradingRunDao(BaseDao):
             "student_jobs_left": obj.get(GradingRunDao.STUDENT_JOBS_LEFT),
             "success": obj.get(GradingRunDao.SUCCESS),
         }
-        return GradingRun(**attrs)
+        run = GradingRun(**attrs)
+        run.mark_stored()
+        return run
 
     def _to_store(self, obj) -> dict:
         return {
@@ -1,13 +1,18 @@
 from typing import Optional
 
+from pymongo import IndexModel, UpdateOne
+
 from broadway.api.daos.base import BaseDao
-from broadway.api.daos.decorators import validate_obj_size
 from broadway.api.models import WorkerNode
 
 
 class WorkerNodeDao(BaseDao):
     ID = "_id"
-    RUNNING_JOB_ID = "running_job_id"
+    RUNNING_JOB_IDS = "running_job_ids"
+    # written by versions that ran a single job per worker
+    LEGACY_RUNNING_JOB_ID = "running_job_id"
+    SLOTS = "slots"
+    PREFETCH = "prefetch"
     LAST_SEEN = "last_seen"
     WORKER_HOSTNAME = "worker_hostname"
     JOBS_PROCESSED = "jobs_processed"
@@ -15,21 +20,70 @@ class WorkerNodeDao(BaseDao):
     USE_WS = "use_ws"
     _COLLECTION = "worker_node"
 
+    _INDEXES = [
+        IndexModel([(ALIVE, 1), (USE_WS, 1)]),
+        IndexModel([(USE_WS, 1)]),
+        IndexModel([(WORKER_HOSTNAME, 1)]),
+    ]
+    _QUERY_SHAPES = {
+        "find_by_id": ({ID: "worker"}, None),
+        "find_by_hostname": ({WORKER_HOSTNAME: "hostname"}, None),
+        "find_by_liveness": ({ALIVE: True, USE_WS: False}, None),
+        "reset_worker_nodes": ({USE_WS: True}, None),
+    }
+    _FIELDS = {
+        "running_job_ids": RUNNING_JOB_IDS,
+        "slots": SLOTS,
+        "prefetch": PREFETCH,
+        "last_seen": LAST_SEEN,
+        "hostname": WORKER_HOSTNAME,
+        "jobs_processed": JOBS_PROCESSED,
+        "is_alive": ALIVE,
+        "use_ws": USE_WS,
+    }
+
     def __init__(self, app):
         super().__init__(app)
         self._collection = self._get_primary_collection(WorkerNodeDao._COLLECTION)
 
-    @validate_obj_size
     def insert(self, obj):
-        document = self._to_store(obj)
-        return self._collection.insert_one(document)
+        result = self._insert_one(self._to_store(obj))
+        obj.mark_stored()
+        return result
 
-    @validate_obj_size
     def update(self, obj):
-        document = self._to_store(obj)
-        return self._collection.update_one(
-            {WorkerNodeDao.ID: obj.id}, {"$set": document}
-        )
+        return self._update_one({WorkerNodeDao.ID: obj.id}, obj)
+
+    def to_updates(self, popped, heartbeats=None):
+        """
+        Builds the requests of a bulk write of the changes of several workers, each
+        given with the changes popped from it (see `BaseModel.pop_changes`), and of
+        the time of the last heartbeat of each worker in `heartbeats` (a dict of
+        worker ID to time)
+        """
+        requests = []
+        for obj, changes, increments in popped:
+            update = self._to_update(obj, changes, increments)
+            if update:
+                requests.append(
+                    UpdateOne({WorkerNodeDao.ID: obj.id}, self._encode(update))
+                )
+        for worker_id, last_seen in (heartbeats or {}).items():
+            requests.append(
+                UpdateOne(
+                    {WorkerNodeDao.ID: worker_id},
+                    {
+                        "$set": {
+                            WorkerNodeDao.LAST_SEEN: last_seen,
+                            WorkerNodeDao.ALIVE: True,
+                        }
+                    },
+                )
+            )
+        return requests
+
+    def bulk_update(self, requests):
+        return self._collection.bulk_write(requests, ordered=False)
 
     def find_all(self):
         return list(map(self._from_store, self._collection.find()))
@@ -55,12 +109,23 @@ class WorkerNodeDao(BaseDao):
             {WorkerNodeDao.USE_WS: True}, {"$set": {WorkerNodeDao.ALIVE: False}}
         )
 
-    def find_by_idleness(self):
-        return list(
-            map(
-                self._from_store,
-                self._collection.find({WorkerNodeDao.RUNNING_JOB_ID: None}),
+    def migrate_running_job_id(self):
+        """
+        Moves the job of worker documents that still have the legacy
+        `running_job_id` field into their `running_job_ids`, so that recovery can
+        fail or requeue it
+        """
+        legacy = WorkerNodeDao.LEGACY_RUNNING_JOB_ID
+        for document in self._collection.find({legacy: {"$ne": None}}):
+            self._collection.update_one(
+                {WorkerNodeDao.ID: document[WorkerNodeDao.ID]},
+                {
+                    "$addToSet": {WorkerNodeDao.RUNNING_JOB_IDS: document[legacy]},
+                    "$unset": {legacy: ""},
+                },
             )
+        return self._collection.update_many(
+            {legacy: {"$exists": True}}, {"$unset": {legacy: ""}}
         )
 
     def _from_store(self, obj) -> Optional[WorkerNode]:
@@ -68,19 +133,25 @@ class WorkerNodeDao(BaseDao):
             return None
         attrs = {
             "id_": obj.get(WorkerNodeDao.ID),
-            "running_job_id": obj.get(WorkerNodeDao.RUNNING_JOB_ID),
+            "running_job_ids": obj.get(WorkerNodeDao.RUNNING_JOB_IDS),
+            "slots": obj.get(WorkerNodeDao.SLOTS) or 1,
+            "prefetch": obj.get(WorkerNodeDao.PREFETCH) or 0,
             "last_seen": obj.get(WorkerNodeDao.LAST_SEEN),
             "hostname": obj.get(WorkerNodeDao.WORKER_HOSTNAME),
             "jobs_processed": obj.get(WorkerNodeDao.JOBS_PROCESSED),
             "is_alive": obj.get(WorkerNodeDao.ALIVE),
             "use_ws": obj.get(WorkerNodeDao.USE_WS),
         }
-        return WorkerNode(**attrs)
+        worker_node = WorkerNode(**attrs)
+        worker_node.mark_stored()
+        return worker_node
 
     def _to_store(self, obj) -> dict:
         return {
             WorkerNodeDao.ID: obj.id,
-            WorkerNodeDao.RUNNING_JOB_ID: obj.running_job_id,
+            WorkerNodeDao.RUNNING_JOB_IDS: obj.running_job_ids,
+            WorkerNodeDao.SLOTS: obj.slots,
+            WorkerNodeDao.PREFETCH: obj.prefetch,
             WorkerNodeDao.LAST_SEEN: obj.last_seen,
             WorkerNodeDao.WORKER_HOSTNAME: obj.hostname,
             WorkerNodeDao.JOBS_PROCESSED: obj.jobs_processed,
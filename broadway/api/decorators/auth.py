@@ -1,5 +1,8 @@
 import logging
 
+from tornado import gen
+from tornado.concurrent import is_future
+
 from broadway.api.daos import AssignmentConfigDao, CourseDao, WorkerNodeDao
 
 logger = logging.getLogger(__name__)
@@ -13,25 +16,36 @@ def _is_token_valid(token):
     )
 
 
+@gen.coroutine
+def _call(func, *args, **kwargs):
+    # the decorated method may or may not be a coroutine
+    result = func(*args, **kwargs)
+    if is_future(result):
+        result = yield result
+    return result
+
+
 def authenticate_worker(func):
+    @gen.coroutine
     def wrapper(*args, **kwargs):
         handler = args[0]
         worker_id = kwargs.get("worker_id")
 
         dao = WorkerNodeDao(handler.settings)
 
-        worker = dao.find_by_id(worker_id)
+        worker = yield dao.aio.find_by_id(worker_id)
 
         if worker is None:
             handler.abort({"message": "worker not found"}, status=401)
             return
 
-        return func(*args, **kwargs)
+        return (yield _call(func, *args, **kwargs))
 
     return wrapper
 
 
 def validate_assignment(func):
+    @gen.coroutine
     def wrapper(*args, **kwargs):
         handler = args[0]
         course_id = kwargs.get("course_id")
@@ -39,10 +53,10 @@ def validate_assignment(func):
         assignment_id = AssignmentConfigDao.id_from(course_id, assignment_name)
 
         dao = AssignmentConfigDao(handler.settings)
-        if dao.find_by_id(assignment_id) is None:
+        if (yield dao.aio.find_by_id(assignment_id)) is None:
             handler.abort({"message": "assignment not found"}, status=401)
             return
-        return func(*args, **kwargs)
+        return (yield _call(func, *args, **kwargs))
 
     return wrapper
 
@@ -81,22 +95,29 @@ def authenticate_cluster_token_ws(func):
     return wrapper
 
 
-def authenticate_course_wrapper_generator(admin_only, func):
+def authenticate_course_wrapper_generator(admin_only, func, ws=False):
+    @gen.coroutine
     def wrapper(*args, **kwargs):
         handler = args[0]
 
+        def reject(message):
+            if ws:
+                handler.close(reason=message, code=1008)
+            else:
+                handler.abort({"message": message}, status=401)
+
         request_token = handler.request.headers.get("Authorization")
         if not _is_token_valid(request_token):
-            handler.abort({"message": "invalid token format"}, status=401)
+            reject("invalid token format")
             return
 
         request_token = request_token.split(" ")[1]
         course_id = kwargs.get("course_id")
 
         dao = CourseDao(handler.settings)
-        course = dao.find_by_id(course_id)
+        course = yield dao.aio.find_by_id(course_id)
         if course is None:
-            handler.abort({"message": "course not found"}, status=401)
+            reject("course not found")
             return
 
         if admin_only:
@@ -105,10 +126,10 @@ def authenticate_course_wrapper_generator(admin_only, func):
             allowed_tokens = set(course.tokens).union(set(course.query_tokens))
 
         if request_token not in allowed_tokens:
-            handler.abort({"message": "invalid token"}, status=401)
+            reject("invalid token")
             return
 
-        return func(*args, **kwargs)
+        return (yield _call(func, *args, **kwargs))
 
     return wrapper
 
@@ -117,6 +138,10 @@ def authenticate_course_member_or_admin(func):
     return authenticate_course_wrapper_generator(False, func)
 
 
+def authenticate_course_member_or_admin_ws(func):
+    return authenticate_course_wrapper_generator(False, func, ws=True)
+
+
 def authenticate_course_admin(func):
     return authenticate_course_wrapper_generator(True, func)
 
@@ -124,6 +149,7 @@ def authenticate_course_admin(func):
 __all__ = [
     "authenticate_cluster_token",
     "authenticate_course_member_or_admin",
+    "authenticate_course_member_or_admin_ws",
     "authenticate_course_admin",
     "authenticate_worker",
     "validate_assignment",
@@ -5,6 +5,8 @@ course_config = {
             "properties": {
                 "tokens": {"type": "array", "items": {"type": "string"}},
                 "query_tokens": {"type": "array", "items": {"type": "string"}},
+                "weight": {"type": "number", "minimum": 0, "exclusiveMinimum": True},
+                "max_concurrency": {"type": "integer", "minimum": 1},
             },
             "required": ["tokens"],
         }
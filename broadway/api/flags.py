@@ -24,6 +24,107 @@ app_flags = FlagSet(
             config_name="heartbeat_interval",
             help="heartbeat interval in seconds",
         ),
+        "long_poll_timeout": Flag(
+            int,
+            default=30,
+            cmdline_name="--long-poll-timeout",
+            config_name="long_poll_timeout",
+            help="maximum number of seconds an http worker can wait for a job",
+        ),
+        "position_update_interval": Flag(
+            int,
+            default=0,
+            cmdline_name="--position-update-interval",
+            config_name="position_update_interval",
+            help="interval in milliseconds over which queue position updates "
+            + "to streams are coalesced. 0 coalesces them per IOLoop iteration",
+        ),
+        "stream_replay_size": Flag(
+            int,
+            default=256,
+            cmdline_name="--stream-replay-size",
+            config_name="stream_replay_size",
+            help="number of recent events kept for each streamed job and run, "
+            + "so that reconnecting clients receive the events they missed",
+        ),
+        "stream_replay_timeout": Flag(
+            int,
+            default=60,
+            cmdline_name="--stream-replay-timeout",
+            config_name="stream_replay_timeout",
+            help="number of seconds recent events are kept after the last "
+            + "client of a job or run disconnects",
+        ),
+        "stream_log_backlog": Flag(
+            int,
+            default=256,
+            cmdline_name="--stream-log-backlog",
+            config_name="stream_log_backlog",
+            help="number of events a client can fall behind on a job's stream "
+            + "before the job's live output is dropped for it",
+        ),
+        "job_log_max_size": Flag(
+            int,
+            default=8 * 1024 * 1024,
+            cmdline_name="--job-log-max-size",
+            config_name="job_log_max_size",
+            help="maximum number of bytes of live output stored for a job. "
+            + "the rest is truncated",
+        ),
+        "stream_idle_timeout": Flag(
+            int,
+            default=300,
+            cmdline_name="--stream-idle-timeout",
+            config_name="stream_idle_timeout",
+            help="number of seconds without events after which a stream is closed "
+            + "if its job or run is over",
+        ),
+        "max_streams": Flag(
+            int,
+            default=10000,
+            cmdline_name="--max-streams",
+            config_name="max_streams",
+            help="maximum number of concurrent streams. 0 for no limit",
+        ),
+        "max_course_streams": Flag(
+            int,
+            default=1000,
+            cmdline_name="--max-course-streams",
+            config_name="max_course_streams",
+            help="maximum number of concurrent streams per course. 0 for no limit",
+        ),
+        "overview_interval": Flag(
+            int,
+            default=2000,
+            cmdline_name="--overview-interval",
+            config_name="overview_interval",
+            help="interval in milliseconds at which course overviews are streamed",
+        ),
+        "queue_aging": Flag(
+            int,
+            default=300,
+            cmdline_name="--queue-aging",
+            config_name="queue_aging",
+            help="seconds after which a queued normal priority job "
+            + "is dispatched ahead of high priority jobs",
+        ),
+        "high_priority_run_size": Flag(
+            int,
+            default=5,
+            cmdline_name="--high-priority-run-size",
+            config_name="high_priority_run_size",
+            help="grading runs with at most this many students "
+            + "have their student jobs queued at high priority",
+        ),
+        "persistent_queue": Flag(
+            bool,
+            default=False,
+            cmdline_name="--persistent-queue",
+            env_name="BROADWAY_PERSISTENT_QUEUE",
+            config_name="persistent_queue",
+            help="rebuild the job queue from the database on startup "
+            + "and reconcile unfinished grading runs",
+        ),
         "course_config": Flag(
             str,
             cmdline_name="--course-config",
@@ -123,5 +224,13 @@ app_flags = FlagSet(
             config_name="mongodb.timeout",
             help="timeout for mongodb connection",
         ),
+        "mongodb_threads": Flag(
+            int,
+            default=16,
+            cmdline_name="--mongodb-threads",
+            env_name="BROADWAY_MONGODB_THREADS",
+            config_name="mongodb.threads",
+            help="number of threads running database queries off the IOLoop",
+        ),
     }
 )
@@ -42,14 +42,36 @@ class BaseAPIHandler(APIHandler):
     def get_stream_queue(self):
         return self.settings["STREAM_QUEUE"]
 
+    def get_worker_registry(self):
+        return self.settings["WORKER_REGISTRY"]
+
+    def get_heartbeat_scheduler(self):
+        return self.settings["HEARTBEAT_SCHEDULER"]
+
+    def get_course_overview(self):
+        return self.settings["COURSE_OVERVIEW"]
+
+    def get_stream_limiter(self):
+        return self.settings["STREAM_LIMITER"]
+
 
 class BaseWSAPIHandler(BaseAPIHandler, WebSocketHandler):
     msg_type_map = {}
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # each handler only accepts the message types declared on it
+        cls.msg_type_map = dict(cls.msg_type_map)
+        for handler in vars(cls).values():
+            if hasattr(handler, "msg_type_decl"):
+                type_id, decl = handler.msg_type_decl
+                cls.msg_type_map[type_id] = (decl, handler)
+
     @staticmethod
     def msg_type(type_id, decl):
         def decor(handler):
-            BaseWSAPIHandler.msg_type_map[type_id] = (decl, handler)
+            handler.msg_type_decl = (type_id, decl)
             return handler
 
         return decor
@@ -63,7 +85,7 @@ class BaseWSAPIHandler(BaseAPIHandler, WebSocketHandler):
 
             msg_type = data["type"]
 
-            decl, handler = BaseWSAPIHandler.msg_type_map[msg_type]
+            decl, handler = self.msg_type_map[msg_type]
 
             # check argument decl
             validate(instance=data["args"], schema=decl)
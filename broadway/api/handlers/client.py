@@ -1,6 +1,8 @@
 import logging
 import tornado.ioloop
 
+from pymongo.errors import DocumentTooLarge
+from tornado import gen
 from tornado_json import schema
 
 import broadway.api.daos as daos
@@ -28,22 +30,27 @@ class ClientAPIHandler(BaseAPIHandler):
 class GradingConfigHandler(ClientAPIHandler):
     @authenticate_course_admin
     @schema.validate(input_schema=definitions.grading_config)
+    @gen.coroutine
     def post(self, *args, **kwargs):
         assignment_id = self.get_assignment_id(**kwargs)
         config = models.AssignmentConfig(id_=assignment_id, **self.body)
         config.id = assignment_id
 
         config_dao = daos.AssignmentConfigDao(self.settings)
-        config_dao.delete_by_id(assignment_id)
-        config_dao.insert(config)
+        yield config_dao.aio.delete_by_id(assignment_id)
+        try:
+            yield config_dao.aio.insert(config)
+        except DocumentTooLarge:
+            self.abort({"message": "grading config is too large"})
 
     @authenticate_course_admin
     @schema.validate(on_empty_404=True, output_schema=definitions.grading_config)
+    @gen.coroutine
     def get(self, *args, **kwargs):
         assignment_id = self.get_assignment_id(**kwargs)
 
         config_dao = daos.AssignmentConfigDao(self.settings)
-        config = config_dao.find_by_id(assignment_id)
+        config = yield config_dao.aio.find_by_id(assignment_id)
         if not config:
             self.abort({"message": "assignment configuration not found"})
             return
@@ -72,11 +79,12 @@ class GradingRunHandler(ClientAPIHandler):
         },
         on_empty_404=True,
     )
+    @gen.coroutine
     def post(self, *args, **kwargs):
         assignment_id = self.get_assignment_id(**kwargs)
 
         config_dao = daos.AssignmentConfigDao(self.settings)
-        config = config_dao.find_by_id(assignment_id)
+        config = yield config_dao.aio.find_by_id(assignment_id)
         if not config:
             self.abort({"message": "assignment configuration not found"})
             return
@@ -95,9 +103,13 @@ class GradingRunHandler(ClientAPIHandler):
         run = models.GradingRun(**run_attrs)
 
         run_dao = daos.GradingRunDao(self.settings)
-        run.id = str(run_dao.insert(run).inserted_id)
+        try:
+            yield run_dao.aio.insert(run)
+        except DocumentTooLarge:
+            self.abort({"message": "grading run is too large"})
+            return
 
-        if not continue_grading_run(self.settings, run):
+        if not (yield continue_grading_run(self.settings, run)):
             self.abort({"message": "failed to start grading run"}, status=500)
             return
 
@@ -149,17 +161,18 @@ class GradingRunStatusHandler(ClientAPIHandler):
         },
         on_empty_404=True,
     )
+    @gen.coroutine
     def get(self, *args, **kwargs):
         grading_run_id = kwargs.get("run_id")
 
         grading_run_dao = daos.GradingRunDao(self.settings)
-        grading_run = grading_run_dao.find_by_id(grading_run_id)
+        grading_run = yield grading_run_dao.aio.find_by_id(grading_run_id)
         if grading_run is None:
             self.abort({"message": "grading run with the given ID not found"})
             return
 
         grading_job_dao = daos.GradingJobDao(self.settings)
-        grading_jobs = grading_job_dao.find_by_run_id(grading_run_id)
+        grading_jobs = yield grading_job_dao.aio.find_states_by_run_id(grading_run_id)
         pre_processing_job = next(
             filter(
                 lambda j: j.type == models.GradingJobType.PRE_PROCESSING, grading_jobs
@@ -210,17 +223,18 @@ class GradingRunEnvHandler(ClientAPIHandler):
         },
         on_empty_404=True,
     )
+    @gen.coroutine
     def get(self, *args, **kwargs):
         grading_run_id = kwargs.get("run_id")
 
         grading_run_dao = daos.GradingRunDao(self.settings)
-        grading_run = grading_run_dao.find_by_id(grading_run_id)
+        grading_run = yield grading_run_dao.aio.find_by_id(grading_run_id)
         if grading_run is None:
             self.abort({"message": "grading run with the given ID not found"})
             return
 
         grading_job_dao = daos.GradingJobDao(self.settings)
-        grading_jobs = grading_job_dao.find_by_run_id(grading_run_id)
+        grading_jobs = yield grading_job_dao.aio.find_envs_by_run_id(grading_run_id)
 
         # Helper method for making a dictionary from the grading_run
         def get_job_id_to_env_map(jobs):
@@ -290,11 +304,12 @@ class GradingJobLogHandler(ClientAPIHandler):
         },
         on_empty_404=True,
     )
+    @gen.coroutine
     def get(self, *args, **kwargs):
         job_id = kwargs["job_id"]
 
         job_log_dao = daos.GradingJobLogDao(self.settings)
-        job_log = job_log_dao.find_by_job_id(job_id)
+        job_log = yield job_log_dao.aio.find_by_job_id(job_id)
 
         if job_log is None:
             self.abort(
@@ -322,6 +337,8 @@ class CourseWorkerNodeHandler(ClientAPIHandler):
                             "hostname": {"type": "string"},
                             "jobs_processed": {"type": "number"},
                             "busy": {"type": "boolean"},
+                            "slots": {"type": "integer"},
+                            "running_jobs": {"type": "integer"},
                             "alive": {"type": "boolean"},
                         },
                         "required": ["hostname", "jobs_processed", "busy", "alive"],
@@ -334,6 +351,7 @@ class CourseWorkerNodeHandler(ClientAPIHandler):
         },
         on_empty_404=True,
     )
+    @gen.coroutine
     def get(self, *args, **kwargs):
         scope = kwargs.get("scope")
         worker_node_dao = daos.WorkerNodeDao(self.settings)
@@ -345,10 +363,13 @@ class CourseWorkerNodeHandler(ClientAPIHandler):
                         lambda worker_node: {
                             "hostname": worker_node.hostname,
                             "jobs_processed": worker_node.jobs_processed,
-                            "busy": (worker_node.running_job_id is not None),
+                            "busy": len(worker_node.running_job_ids)
+                            >= worker_node.slots,
+                            "slots": worker_node.slots,
+                            "running_jobs": len(worker_node.running_job_ids),
                             "alive": worker_node.is_alive,
                         },
-                        worker_node_dao.find_all(),
+                        (yield worker_node_dao.aio.find_all()),
                     )
                 )
             }
@@ -381,6 +402,50 @@ class CourseQueueLengthHandler(ClientAPIHandler):
         return {"length": length}
 
 
+class CourseQueueStatsHandler(ClientAPIHandler):
+    @authenticate_course_admin
+    @schema.validate(
+        output_schema={
+            "type": "object",
+            "properties": {
+                "weight": {"type": "number"},
+                "max_concurrency": {"type": ["null", "number"]},
+                "queued": {"type": "number"},
+                "running": {"type": "number"},
+                "dispatched_jobs": {"type": "number"},
+                "dispatched_work": {"type": "number"},
+            },
+            "required": [
+                "weight",
+                "max_concurrency",
+                "queued",
+                "running",
+                "dispatched_jobs",
+                "dispatched_work",
+            ],
+            "additionalProperties": False,
+        },
+        on_empty_404=True,
+    )
+    @gen.coroutine
+    def get(self, *args, **kwargs):
+        course_id = kwargs["course_id"]
+        queue = self.settings["QUEUE"]
+
+        if not queue.contains_key(course_id):
+            course = yield daos.CourseDao(self.settings).aio.find_by_id(course_id)
+            return {
+                "weight": course.weight,
+                "max_concurrency": course.max_concurrency,
+                "queued": 0,
+                "running": 0,
+                "dispatched_jobs": 0,
+                "dispatched_work": 0,
+            }
+
+        return queue.get_stats(course_id)
+
+
 class GradingJobQueuePositionHandler(ClientAPIHandler):
     @authenticate_course_member_or_admin
     @schema.validate(
@@ -392,12 +457,13 @@ class GradingJobQueuePositionHandler(ClientAPIHandler):
         },
         on_empty_404=True,
     )
+    @gen.coroutine
     def get(self, *args, **kwargs):
 
         grading_job_id = kwargs.get("job_id")
 
         grading_job_dao = daos.GradingJobDao(self.settings)
-        if grading_job_dao.find_by_id(grading_job_id) is None:
+        if (yield grading_job_dao.aio.find_by_id(grading_job_id)) is None:
             self.abort({"message": "grading job with the given ID not found"})
             return
 
@@ -410,6 +476,8 @@ class GradingJobQueuePositionHandler(ClientAPIHandler):
             )
             return
 
+        # jobs of different runs take turns, so this is the number of jobs expected
+        # to be pulled from the course before this one if no new jobs arrive
         queue_position = queue.get_position_in_queue(course_id, grading_job_id)
         if queue_position == -1:
             self.abort(
@@ -0,0 +1,302 @@
+from asyncio import CancelledError
+from datetime import timedelta
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import broadway.api.daos as daos
+
+from broadway.api.handlers.base import BaseWSAPIHandler
+from broadway.api.decorators.auth import authenticate_course_member_or_admin_ws
+from broadway.api.models import GradingRunState
+from broadway.api.utils.streamqueue import StreamQueue
+
+_ids_schema = {"type": "array", "items": {"type": "string"}}
+
+
+class ClientConnectionHandler(BaseWSAPIHandler):
+    """
+    Lets a client follow the events of any number of jobs and runs of a course over a
+    single websocket, instead of opening a server-sent event stream for each of them.
+
+    Each job or run followed takes one of the course's stream slots, as a server-sent
+    event stream would. Jobs and runs that are already over are sent their final
+    state and closed right away instead.
+
+    Events are sent in batches, as `{"type": "events", "events": [...]}` messages.
+    With the `batch` query argument, events are collected for that many milliseconds
+    before they are sent. Otherwise, the events published in one IOLoop iteration
+    are sent together.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.course_id = None
+        self._job_ids = set()
+        self._run_ids = set()
+        self._pending = []
+        self._flush_scheduled = False
+        super().__init__(*args, **kwargs)
+
+    def check_origin(self, origin):
+        # dashboards are served from other origins and authenticate with their
+        # course token, as with the http endpoints
+        return True
+
+    @authenticate_course_member_or_admin_ws
+    def open(self, course_id):
+        try:
+            self._batch = max(float(self.get_query_argument("batch", 0)), 0)
+        except ValueError:
+            self.close(reason="batch must be a number", code=1008)
+            return
+
+        self.course_id = course_id
+        self._id = id(self)
+
+    def _is_run_in_course(self, grading_run):
+        return grading_run is not None and grading_run.assignment_id.startswith(
+            "{}/".format(self.course_id)
+        )
+
+    @BaseWSAPIHandler.msg_type(
+        "subscribe",
+        {
+            "type": "object",
+            "properties": {
+                "job_ids": _ids_schema,
+                "run_ids": _ids_schema,
+                "last_event_id": {"type": "integer"},
+            },
+            "additionalProperties": False,
+        },
+    )
+    @gen.coroutine
+    def handler_subscribe(self, job_ids=(), run_ids=(), last_event_id=None):
+        if self.course_id is None:
+            return
+
+        job_ids = set(job_ids) - self._job_ids
+        run_ids = set(run_ids) - self._run_ids
+
+        grading_job_dao = daos.GradingJobDao(self.settings)
+        grading_run_dao = daos.GradingRunDao(self.settings)
+        # the jobs and runs are looked up concurrently
+        grading_jobs, grading_runs = yield [
+            grading_job_dao.aio.find_states_by_ids(job_ids, self.course_id),
+            [grading_run_dao.aio.find_by_id(run_id) for run_id in run_ids],
+        ]
+        if self.ws_connection is None:
+            # closed while the lookups were in flight
+            return
+
+        if len(grading_jobs) != len(job_ids):
+            self.send(
+                {
+                    "type": "subscribe",
+                    "success": False,
+                    "message": "grading job with the given ID not found",
+                }
+            )
+            return
+
+        if not all(map(self._is_run_in_course, grading_runs)):
+            self.send(
+                {
+                    "type": "subscribe",
+                    "success": False,
+                    "message": "grading run with the given ID not found",
+                }
+            )
+            return
+
+        # nothing more will be published for jobs and runs that are over
+        finished_jobs = [job for job in grading_jobs if job.finished_at is not None]
+        finished_runs = [
+            run
+            for run in grading_runs
+            if run.state in (GradingRunState.FINISHED, GradingRunState.FAILED)
+        ]
+        job_ids -= {job.id for job in finished_jobs}
+        run_ids -= {run.id for run in finished_runs}
+
+        if not self._acquire_streams(len(job_ids) + len(run_ids)):
+            self.send(
+                {
+                    "type": "subscribe",
+                    "success": False,
+                    "message": "too many open streams",
+                }
+            )
+            return
+
+        stream_queue = self.get_stream_queue()
+        for job_id in job_ids:
+            stream_queue.register_stream(job_id, self._id, last_event_id)
+            self._job_ids.add(job_id)
+            IOLoop.current().spawn_callback(self._listen_to_job, job_id)
+        for run_id in run_ids:
+            stream_queue.register_run_stream(run_id, self._id, None, last_event_id)
+            self._run_ids.add(run_id)
+            IOLoop.current().spawn_callback(self._listen_to_run, run_id)
+
+        self.send({"type": "subscribe", "success": True})
+
+        for job in finished_jobs:
+            state = GradingRunState.FINISHED if job.success else GradingRunState.FAILED
+            self._publish_final(
+                "grading_job_id", job.id, StreamQueue.STATE_EVENT, state
+            )
+        for run in finished_runs:
+            self._publish_final(
+                "grading_run_id", run.id, StreamQueue.RUN_STATE_EVENT, run.state
+            )
+
+    @BaseWSAPIHandler.msg_type(
+        "unsubscribe",
+        {
+            "type": "object",
+            "properties": {"job_ids": _ids_schema, "run_ids": _ids_schema},
+            "additionalProperties": False,
+        },
+    )
+    def handler_unsubscribe(self, job_ids=(), run_ids=()):
+        if self.course_id is None:
+            return
+
+        for job_id in self._job_ids.intersection(job_ids):
+            self._unsubscribe_from_job(job_id)
+        for run_id in self._run_ids.intersection(run_ids):
+            self._unsubscribe_from_run(run_id)
+
+        self.send({"type": "unsubscribe", "success": True})
+
+    def _acquire_streams(self, count):
+        """
+        Takes all or none of the given number of the course's stream slots
+        """
+        stream_limiter = self.get_stream_limiter()
+        for acquired in range(count):
+            if not stream_limiter.acquire(self.course_id):
+                for _ in range(acquired):
+                    stream_limiter.release(self.course_id)
+                return False
+        return True
+
+    def _unsubscribe_from_job(self, job_id):
+        self._job_ids.remove(job_id)
+        self.get_stream_queue().unregister_stream(job_id, self._id)
+        self.get_stream_limiter().release(self.course_id)
+
+    def _unsubscribe_from_run(self, run_id):
+        self._run_ids.remove(run_id)
+        self.get_stream_queue().unregister_run_stream(run_id, self._id)
+        self.get_stream_limiter().release(self.course_id)
+
+    @gen.coroutine
+    def _wait_for_event(self, future, is_over):
+        """
+        Resolves to the next event of a job or run, or to None once it sees no
+        events for the idle timeout and is over, e.g. because it finished before
+        it was subscribed to
+        """
+        idle_timeout = timedelta(seconds=self.get_flags()["stream_idle_timeout"])
+        while True:
+            try:
+                return (
+                    yield gen.with_timeout(
+                        idle_timeout, future, quiet_exceptions=CancelledError
+                    )
+                )
+            except gen.TimeoutError:
+                if (yield is_over()):
+                    return None
+
+    @gen.coroutine
+    def _is_job_over(self, job_id):
+        job = yield daos.GradingJobDao(self.settings).aio.find_by_id(job_id)
+        return job is None or job.finished_at is not None
+
+    @gen.coroutine
+    def _is_run_over(self, run_id):
+        run = yield daos.GradingRunDao(self.settings).aio.find_by_id(run_id)
+        return run is None or run.finished_at is not None
+
+    @gen.coroutine
+    def _listen_to_job(self, job_id):
+        stream_queue = self.get_stream_queue()
+        while job_id in self._job_ids:
+            try:
+                event = yield self._wait_for_event(
+                    stream_queue.get(job_id, self._id, raw=True),
+                    lambda: self._is_job_over(job_id),
+                )
+            except CancelledError:
+                # unsubscribed
+                return
+
+            if job_id not in self._job_ids:
+                # unsubscribed while checking whether the job is over
+                return
+            self._publish("grading_job_id", job_id, event)
+            if event is None or event.chunk is StreamQueue.CLOSE_EVENT:
+                self._unsubscribe_from_job(job_id)
+                return
+
+    @gen.coroutine
+    def _listen_to_run(self, run_id):
+        stream_queue = self.get_stream_queue()
+        while run_id in self._run_ids:
+            try:
+                event = yield self._wait_for_event(
+                    stream_queue.get_run_event(run_id, self._id, raw=True),
+                    lambda: self._is_run_over(run_id),
+                )
+            except CancelledError:
+                # unsubscribed
+                return
+
+            if run_id not in self._run_ids:
+                # unsubscribed while checking whether the run is over
+                return
+            self._publish("grading_run_id", run_id, event)
+            if event is None or event.chunk is StreamQueue.CLOSE_EVENT:
+                self._unsubscribe_from_run(run_id)
+                return
+
+    def _publish_final(self, key_name, key, event_type, state):
+        """
+        Sends the final state of a job or run that is over, and closes it
+        """
+        self._pending.append({key_name: key, "type": event_type, "data": state.name})
+        self._publish(key_name, key, None)
+
+    def _publish(self, key_name, key, event):
+        # None closes the job or run, like the close event
+        if event is None or event.chunk is StreamQueue.CLOSE_EVENT:
+            self._pending.append({key_name: key, "type": "close"})
+        else:
+            self._pending.append(
+                {key_name: key, "id": event.id, "type": event.type, "data": event.data}
+            )
+
+        if self._flush_scheduled:
+            return
+        self._flush_scheduled = True
+
+        if self._batch > 0:
+            IOLoop.current().call_later(self._batch / 1000, self._flush)
+        else:
+            IOLoop.current().add_callback(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+
+        events, self._pending = self._pending, []
+        if events and self.ws_connection is not None:
+            self.send({"type": "events", "events": events})
+
+    def on_close(self):
+        for job_id in list(self._job_ids):
+            self._unsubscribe_from_job(job_id)
+        for run_id in list(self._run_ids):
+            self._unsubscribe_from_run(run_id)
@@ -1,16 +1,24 @@
-import json
+from asyncio import CancelledError
+from datetime import timedelta
+
 from tornado import gen, web
 from tornado.iostream import StreamClosedError
-from tornado.ioloop import PeriodicCallback
+from tornado_json import schema
 
+import broadway.api.daos as daos
 from broadway.api.handlers.base import BaseAPIHandler
-from broadway.api.decorators.auth import authenticate_course_member_or_admin
-from broadway.api.utils.streamqueue import StreamQueue
+from broadway.api.decorators.auth import (
+    authenticate_cluster_token,
+    authenticate_course_admin,
+    authenticate_course_member_or_admin,
+)
+from broadway.api.models import GradingRunState
+from broadway.api.utils.streamqueue import StreamQueue, encode_event
 
-HEARTBEAT_TIME_MILLI = 20 * 1000  # 20 seconds
+HEARTBEAT_CHUNK = b":\n\n"
 
 
-class GradingJobStreamHandler(BaseAPIHandler):
+class BaseStreamHandler(BaseAPIHandler):
     def initialize(self):
         # Prepare for Server-Sent Events
         self.set_header("Content-Type", "text/event-stream")
@@ -20,21 +28,95 @@ class GradingJobStreamHandler(BaseAPIHandler):
         # See https://serverfault.com/a/801629
         self.set_header("X-Accel-Buffering", "no")
 
-        # No need to register stream or callback when it's a preflight request
-        if self.request.method == "OPTIONS":
-            return
-
         self._id = id(self)
-        self._callback = PeriodicCallback(
-            callback=self._heartbeat, callback_time=HEARTBEAT_TIME_MILLI
-        )
-        self._callback.start()
+        # course whose stream slot is held, and whether the stream queue listener
+        # is registered. cleared once they are released
+        self._course_id = None
+        self._registered = False
+
+    def _unregister_stream(self):
+        raise NotImplementedError("_unregister_stream not implemented")
+
+    @gen.coroutine
+    def _is_over(self):
+        """
+        Resolves to whether the job or run being streamed is over, so no more events
+        will be published for it
+        """
+        return False
+
+    def _open_stream(self, course_id):
+        """
+        Takes one of the stream slots of the course. Fails fast with 503 when the
+        course or the process has too many streams open.
+        """
+        if not self.get_stream_limiter().acquire(course_id):
+            self.abort({"message": "too many open streams"}, status=503)
+            return False
+
+        self._course_id = course_id
+        self.get_heartbeat_scheduler().register(self)
+        return True
+
+    def _close_stream(self):
+        """
+        Releases everything held by the stream. Can be called more than once.
+        """
+        if self._registered:
+            self._registered = False
+            self._unregister_stream()
+
+        self.get_heartbeat_scheduler().unregister(self)
+
+        if self._course_id is not None:
+            self.get_stream_limiter().release(self._course_id)
+            self._course_id = None
+
+    def _parse_last_event_id(self):
+        # sent by EventSource clients when they reconnect
+        last_event_id = self.request.headers.get("Last-Event-ID")
+        if last_event_id is None:
+            return None
+
+        try:
+            return int(last_event_id)
+        except ValueError:
+            self.abort({"message": "Last-Event-ID must be an integer"})
+            return
 
     def _stop_listening(self):
-        self.get_stream_queue().unregister_stream(self._job_id, self._id)
-        self._callback.stop()
+        self._close_stream()
         raise web.Finish
 
+    def on_connection_close(self):
+        # clean up as soon as the client goes away rather than on the next write
+        self._close_stream()
+
+    def on_finish(self):
+        # the stream may also end without the client going away, e.g. on an error
+        self._close_stream()
+
+    @gen.coroutine
+    def _wait_for_event(self, future):
+        """
+        Resolves to the stream's next event. A stream that sees no events for the
+        idle timeout is closed if its job or run is over.
+        """
+        idle_timeout = timedelta(seconds=self.get_flags()["stream_idle_timeout"])
+        while True:
+            try:
+                return (
+                    yield gen.with_timeout(
+                        idle_timeout, future, quiet_exceptions=CancelledError
+                    )
+                )
+            except gen.TimeoutError:
+                if (yield self._is_over()):
+                    self._stop_listening()
+            except CancelledError:
+                # the client went away and the listener was unregistered
+                raise web.Finish
+
     @gen.coroutine
     def _send_sse(self, message):
         try:
@@ -43,26 +125,252 @@ class GradingJobStreamHandler(BaseAPIHandler):
         except StreamClosedError:
             self._stop_listening()
 
+    def send_heartbeat(self):
+        """
+        Called by the shared heartbeat scheduler. A failed write is noticed by the
+        next event that is published.
+        """
+        if self._finished:
+            self._close_stream()
+            return
+
+        try:
+            self.write(HEARTBEAT_CHUNK)
+            self.flush().add_done_callback(lambda future: future.exception())
+        except StreamClosedError:
+            self._close_stream()
+
     @gen.coroutine
-    def _heartbeat(self):
-        yield self._send_sse(":\n\n")
+    def publish(self, chunk):
+        # events are already encoded once for all of their listeners
+        yield self._send_sse(chunk)
+
+
+class GradingJobStreamHandler(BaseStreamHandler):
+    def _unregister_stream(self):
+        self.get_stream_queue().unregister_stream(self._job_id, self._id)
 
     @gen.coroutine
-    def publish(self, event, data):
-        blob = json.dumps({"type": event, "data": data})
-        yield self._send_sse(f"event: status_update\ndata: {blob}\n\n")
+    def _is_over(self):
+        job = yield daos.GradingJobDao(self.settings).aio.find_by_id(self._job_id)
+        return job is None or job.finished_at is not None
 
     @authenticate_course_member_or_admin
     @gen.coroutine
     def get(self, **kwargs):
+        course_id = kwargs.get("course_id")
         self._job_id = kwargs.get("job_id")
 
+        job = yield daos.GradingJobDao(self.settings).aio.find_by_id(self._job_id)
+        # jobs queued before course IDs were recorded do not have one
+        if job is None or job.course_id not in (None, course_id):
+            self.abort({"message": "grading job with the given ID not found"})
+            return
+
+        last_event_id = self._parse_last_event_id()
+        if self._finished or not self._open_stream(course_id):
+            return
+
         sq = self.get_stream_queue()
-        sq.register_stream(self._job_id, self._id)
+        resumed = sq.register_stream(self._job_id, self._id, last_event_id)
+        self._registered = True
+
+        # nothing more will be published for a job that is over
+        if not resumed and job.finished_at is not None:
+            state = GradingRunState.FINISHED if job.success else GradingRunState.FAILED
+            yield self.publish(encode_event(StreamQueue.STATE_EVENT, state.name))
+            self._stop_listening()
 
         while True:
-            res = yield sq.get(self._job_id, self._id)
+            res = yield self._wait_for_event(sq.get(self._job_id, self._id))
             # If we receive the sentinel value, stop listening
             if res is StreamQueue.CLOSE_EVENT:
                 self._stop_listening()
-            yield self.publish(*res)
+            yield self.publish(res)
+
+
+class GradingRunStreamHandler(BaseStreamHandler):
+    """
+    Streams the state changes and queue positions of every job in a run, and the
+    state changes of the run itself, over a single connection.
+
+    The `events` query argument takes a comma separated list of the event types to
+    receive (see `StreamQueue.RUN_EVENTS`). With the `batch` query argument, events
+    are collected for that many milliseconds and written out together.
+    """
+
+    def _unregister_stream(self):
+        self.get_stream_queue().unregister_run_stream(self._run_id, self._id)
+
+    @gen.coroutine
+    def _is_over(self):
+        grading_run = yield daos.GradingRunDao(self.settings).aio.find_by_id(
+            self._run_id
+        )
+        return grading_run is None or grading_run.finished_at is not None
+
+    def _parse_event_types(self):
+        events = self.get_query_argument("events", None)
+        if events is None:
+            return None
+
+        event_types = set(events.split(","))
+        if not event_types.issubset(StreamQueue.RUN_EVENTS):
+            self.abort(
+                {
+                    "message": "events must be a subset of {}".format(
+                        ", ".join(StreamQueue.RUN_EVENTS)
+                    )
+                }
+            )
+            return
+        return event_types
+
+    def _parse_batch(self):
+        try:
+            return max(float(self.get_query_argument("batch", 0)), 0)
+        except ValueError:
+            self.abort({"message": "batch must be a number"})
+            return
+
+    @authenticate_course_member_or_admin
+    @gen.coroutine
+    def get(self, **kwargs):
+        course_id = kwargs.get("course_id")
+        self._run_id = kwargs.get("run_id")
+
+        grading_run = yield daos.GradingRunDao(self.settings).aio.find_by_id(
+            self._run_id
+        )
+        if grading_run is None or not grading_run.assignment_id.startswith(
+            "{}/".format(course_id)
+        ):
+            self.abort({"message": "grading run with the given ID not found"})
+            return
+
+        event_types = self._parse_event_types()
+        batch = self._parse_batch()
+        last_event_id = self._parse_last_event_id()
+        if self._finished or not self._open_stream(course_id):
+            return
+
+        sq = self.get_stream_queue()
+        resumed = sq.register_run_stream(
+            self._run_id, self._id, event_types, last_event_id
+        )
+        self._registered = True
+
+        # the current state is sent first, so clients do not need to poll for it,
+        # unless the client resumed from an earlier connection and already has it
+        if not resumed:
+            if event_types is None or StreamQueue.RUN_STATE_EVENT in event_types:
+                yield self.publish(
+                    encode_event(StreamQueue.RUN_STATE_EVENT, grading_run.state.name)
+                )
+            if grading_run.state in (GradingRunState.FINISHED, GradingRunState.FAILED):
+                self._stop_listening()
+
+        while True:
+            chunks = [
+                (yield self._wait_for_event(sq.get_run_event(self._run_id, self._id)))
+            ]
+            if batch and chunks[0] is not StreamQueue.CLOSE_EVENT:
+                yield gen.sleep(batch / 1000)
+                if not self._registered:
+                    # the client went away while the events were collected
+                    raise web.Finish
+                while sq.has_run_update(self._run_id, self._id):
+                    chunks.append(sq.get_run_event(self._run_id, self._id).result())
+
+            closed = StreamQueue.CLOSE_EVENT in chunks
+            chunks = [chunk for chunk in chunks if chunk is not StreamQueue.CLOSE_EVENT]
+            if chunks:
+                yield self.publish(b"".join(chunks))
+            # If we receive the sentinel value, stop listening
+            if closed:
+                self._stop_listening()
+
+
+class CourseOverviewStreamHandler(BaseStreamHandler):
+    """
+    Streams a snapshot of a course (see `CourseOverview.get_overview`) at a fixed
+    interval, for dashboards that would otherwise poll the queue and worker
+    endpoints.
+    """
+
+    OVERVIEW_EVENT = "overview"
+
+    def initialize(self):
+        super().initialize()
+        self._closed = False
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        self._closed = True
+
+    @authenticate_course_admin
+    @gen.coroutine
+    def get(self, **kwargs):
+        course_id = kwargs.get("course_id")
+        interval = self.get_flags()["overview_interval"] / 1000
+        if not self._open_stream(course_id):
+            return
+
+        overview = self.get_course_overview()
+        while not self._closed:
+            yield self.publish(
+                encode_event(
+                    self.OVERVIEW_EVENT,
+                    overview.get_overview(
+                        course_id, self.get_queue(), self.get_worker_registry()
+                    ),
+                )
+            )
+            yield gen.sleep(interval)
+
+
+class StreamStatsHandler(BaseAPIHandler):
+    @authenticate_cluster_token
+    @schema.validate(
+        output_schema={
+            "type": "object",
+            "properties": {
+                "streams": {"type": "integer"},
+                "course_streams": {
+                    "type": "object",
+                    "additionalProperties": {"type": "integer"},
+                },
+                "heartbeat_connections": {"type": "integer"},
+                "stream_queue": {
+                    "type": "object",
+                    "properties": {
+                        "jobs": {"type": "integer"},
+                        "runs": {"type": "integer"},
+                        "listeners": {"type": "integer"},
+                        "events": {"type": "integer"},
+                        "bytes": {"type": "integer"},
+                    },
+                    "required": ["jobs", "runs", "listeners", "events", "bytes"],
+                    "additionalProperties": False,
+                },
+            },
+            "required": [
+                "streams",
+                "course_streams",
+                "heartbeat_connections",
+                "stream_queue",
+            ],
+            "additionalProperties": False,
+        },
+        on_empty_404=True,
+    )
+    def get(self, *args, **kwargs):
+        stream_limiter = self.get_stream_limiter()
+        return {
+            "streams": stream_limiter.get_total_count(),
+            "course_streams": stream_limiter.get_counts(),
+            "heartbeat_connections": (
+                self.get_heartbeat_scheduler().get_connection_count()
+            ),
+            "stream_queue": self.get_stream_queue().get_stats(),
+        }
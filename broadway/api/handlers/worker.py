@@ -1,6 +1,8 @@
 import logging
+import tornado.gen
 import tornado.ioloop
 from queue import Empty
+from pymongo.errors import DocumentTooLarge
 from tornado_json import schema
 
 import broadway.api.daos as daos
@@ -8,7 +10,9 @@ import broadway.api.definitions as definitions
 import broadway.api.models as models
 from broadway.api.decorators.auth import authenticate_cluster_token, authenticate_worker
 from broadway.api.callbacks.job import job_update_callback
+from broadway.api.callbacks.worker import worker_schedule_job
 from broadway.api.handlers.base import BaseAPIHandler
+from broadway.api.utils.run import fail_job, finish_job
 from broadway.api.utils.time import get_time
 
 logger = logging.getLogger(__name__)
@@ -31,6 +35,7 @@ class WorkerRegisterHandler(BaseAPIHandler):
             "additionalProperties": False,
         },
     )
+    @tornado.gen.coroutine
     def post(self, *args, **kwargs):
         worker_id = kwargs.get("worker_id")
         hostname = self.body.get("hostname")
@@ -41,15 +46,15 @@ class WorkerRegisterHandler(BaseAPIHandler):
             id_=worker_id, hostname=hostname, last_seen=get_time(), is_alive=True
         )
 
-        dup = worker_node_dao.find_by_id(worker_id)
+        dup = yield worker_node_dao.aio.find_by_id(worker_id)
 
         if dup is None:
             logger.info("new worker {} joined on {}".format(worker_id, hostname))
-            worker_node_dao.insert(worker_node)
+            yield worker_node_dao.aio.insert(worker_node)
         elif not dup.is_alive:
             dup.is_alive = True
             logger.info("worker {} alive again on {}".format(worker_id, hostname))
-            worker_node_dao.update(dup)
+            yield worker_node_dao.aio.update(dup)
         else:
             msg = "worker id '{}' already exists".format(worker_id)
             logger.info(msg)
@@ -60,6 +65,11 @@ class WorkerRegisterHandler(BaseAPIHandler):
 
 
 class GradingJobHandler(BaseAPIHandler):
+    def initialize(self):
+        self.closed = False
+        # the future the request is parked on while it waits for a job
+        self.parked = None
+
     @authenticate_cluster_token
     @authenticate_worker
     @schema.validate(
@@ -74,13 +84,16 @@ class GradingJobHandler(BaseAPIHandler):
             "additionalProperties": False,
         },
     )
+    @tornado.gen.coroutine
     def get(self, *args, **kwargs):
         """
-        Allows workers to request their next grading job
+        Allows workers to request their next grading job. With a `wait` query
+        argument, the request is held for up to that many seconds until a job is
+        available.
         """
         worker_id = kwargs.get("worker_id")
         worker_node_dao = daos.WorkerNodeDao(self.settings)
-        worker_node = worker_node_dao.find_by_id(worker_id)
+        worker_node = yield worker_node_dao.aio.find_by_id(worker_id)
         if not worker_node:
             logger.critical(
                 "unknown node with ID '{}' successfully requested job".format(worker_id)
@@ -89,36 +102,107 @@ class GradingJobHandler(BaseAPIHandler):
             return
 
         try:
-            grading_job_id = self.get_queue().pull()
+            wait = float(self.get_query_argument("wait", 0))
+        except ValueError:
+            self.abort({"message": "wait must be a number"})
+            return
+
+        wait = min(max(wait, 0), self.get_flags()["long_poll_timeout"])
+        deadline = tornado.ioloop.IOLoop.current().time() + wait
+
+        while True:
+            try:
+                return (yield self._start_next_job(worker_id))
+            except Empty:
+                available = yield self._wait_for_job(deadline)
+                if not available:
+                    self.abort({"message": "no jobs available"}, status=498)
+                    return
+
+            # a job pulled for a worker that stopped waiting would be lost
+            if self.closed:
+                return
+
+    async def _wait_for_job(self, deadline):
+        """
+        Parks the request until the scheduler finds jobs for it to pull.
+        Returns False once the deadline has passed
+        """
+        if tornado.ioloop.IOLoop.current().time() >= deadline:
+            return False
+
+        worker_registry = self.get_worker_registry()
+        self.parked = worker_registry.park()
+        try:
+            await tornado.gen.with_timeout(deadline, self.parked)
+            return True
+        except tornado.gen.TimeoutError:
+            worker_registry.unpark(self.parked)
+            return False
+        finally:
+            self.parked = None
+
+    @tornado.gen.coroutine
+    def _start_next_job(self, worker_id):
+        queue_id, grading_job_id = self.get_queue().pull_with_queue_id()
+        self.get_stream_queue().schedule_position_update(self.get_queue())
+        grading_job_dao = daos.GradingJobDao(self.settings)
+        grading_job = yield grading_job_dao.aio.find_by_id(grading_job_id)
+        if grading_job:
             self.get_stream_queue().update_job_state(
-                grading_job_id, models.GradingJobState.STARTED.name
+                grading_job_id,
+                models.GradingJobState.STARTED.name,
+                run_id=grading_job.run_id,
             )
-            self.get_queue().update_all_job_positions(self.get_stream_queue())
-            grading_job_dao = daos.GradingJobDao(self.settings)
-            grading_job = grading_job_dao.find_by_id(grading_job_id)
-            if not grading_job:
-                logger.critical(
-                    "found job ID '{}' in queue, but job does not exist".format(
-                        grading_job_id
-                    )
-                )
-                self.abort(
-                    {"message": "a failure occurred while getting next job"}, status=500
+        else:
+            logger.critical(
+                "found job ID '{}' in queue, but job does not exist".format(
+                    grading_job_id
                 )
-                return
+            )
+            self.get_queue().release(queue_id)
+            self.abort(
+                {"message": "a failure occurred while getting next job"}, status=500
+            )
+            return
+
+        grading_job.started_at = get_time()
+        grading_job.worker_id = worker_id
+        try:
+            yield grading_job_dao.aio.update(grading_job)
+        except DocumentTooLarge:
+            logger.critical("job '{}' is too large to be stored".format(grading_job_id))
+            yield fail_job(self.settings, grading_job, "job is too large to be stored")
+            if grading_job.course_id is not None:
+                self.get_queue().release(grading_job.course_id)
+            tornado.ioloop.IOLoop.current().add_callback(
+                job_update_callback, self.settings, grading_job_id, grading_job.run_id
+            )
+            self.abort(
+                {"message": "a failure occurred while getting next job"}, status=500
+            )
+            return
 
-            grading_job.started_at = get_time()
-            grading_job.worker_id = worker_id
-            grading_job_dao.update(grading_job)
+        # the worker node is loaded again since the request may have been parked
+        worker_node_dao = daos.WorkerNodeDao(self.settings)
+        worker_node = yield worker_node_dao.aio.find_by_id(worker_id)
 
-            worker_node.running_job_id = grading_job_id
-            worker_node.jobs_processed += 1
-            worker_node.is_alive = True
-            worker_node_dao.update(worker_node)
+        # http workers poll for one job at a time
+        worker_node.running_job_ids = [grading_job_id]
+        worker_node.jobs_processed += 1
+        worker_node.is_alive = True
+        yield worker_node_dao.aio.update(worker_node)
 
-            return {"grading_job_id": grading_job_id, "stages": grading_job.stages}
-        except Empty:
-            self.abort({"message": "no jobs available"}, status=498)
+        return {"grading_job_id": grading_job_id, "stages": grading_job.stages}
+
+    def on_connection_close(self):
+        self.closed = True
+
+        # a worker that stopped waiting must not take a wakeup from one that waits
+        if self.parked is not None:
+            self.get_worker_registry().unpark(self.parked)
+            if not self.parked.done():
+                self.parked.set_result(None)
 
     @authenticate_cluster_token
     @authenticate_worker
@@ -135,6 +219,7 @@ class GradingJobHandler(BaseAPIHandler):
             "additionalProperties": False,
         }
     )
+    @tornado.gen.coroutine
     def post(self, *args, **kwargs):
         """
         Allows workers to update grading job status on completion
@@ -143,7 +228,7 @@ class GradingJobHandler(BaseAPIHandler):
         job_id = self.body.get("grading_job_id")
 
         grading_job_dao = daos.GradingJobDao(self.settings)
-        job = grading_job_dao.find_by_id(job_id)
+        job = yield grading_job_dao.aio.find_by_id(job_id)
         if not job:
             self.abort({"message": "job with the given ID not found"})
             return
@@ -158,8 +243,11 @@ class GradingJobHandler(BaseAPIHandler):
             self.abort({"message": "cannot update job that is not in STARTED state"})
             return
 
+        if job.course_id is not None:
+            self.get_queue().release(job.course_id)
+
         worker_node_dao = daos.WorkerNodeDao(self.settings)
-        worker_node = worker_node_dao.find_by_id(worker_id)
+        worker_node = yield worker_node_dao.aio.find_by_id(worker_id)
         if not worker_node:
             logger.critical(
                 "unknown node with ID '{}' successfully updated job".format(worker_id)
@@ -168,25 +256,28 @@ class GradingJobHandler(BaseAPIHandler):
             return
 
         # clear the worker node's job
-        worker_node.running_job_id = None
+        if job_id in worker_node.running_job_ids:
+            worker_node.running_job_ids.remove(job_id)
+            worker_node.mark_changed("running_job_ids")
         worker_node.is_alive = True
-        worker_node_dao.update(worker_node)
+        yield worker_node_dao.aio.update(worker_node)
 
         # finish the job
-        job.finished_at = get_time()
-        job.results = self.body.get("results")
-        job.success = self.body.get("success")
-        grading_job_dao.update(job)
+        yield finish_job(
+            self.settings, job, self.body.get("success"), self.body.get("results")
+        )
 
         # store the logs
         job_log_dao = daos.GradingJobLogDao(self.settings)
         job_log = models.GradingJobLog(job_id=job_id, **self.body.get("logs"))
-        job_log_dao.insert(job_log)
+        yield job_log_dao.aio.insert(job_log)
 
-        # thread safe callback
-        tornado.ioloop.IOLoop.current().add_callback(
-            job_update_callback, self.settings, job_id, job.run_id
-        )
+        # trigger schedule event, since this may have freed up a course's
+        # concurrency for waiting workers
+        tornado.ioloop.IOLoop.current().add_callback(worker_schedule_job, self.settings)
+
+        # the result is acknowledged once the run has been moved along
+        yield job_update_callback(self.settings, job_id, job.run_id)
 
 
 class HeartBeatHandler(BaseAPIHandler):
@@ -195,17 +286,6 @@ class HeartBeatHandler(BaseAPIHandler):
     def post(self, *args, **kwargs):
         worker_id = kwargs.get("worker_id")
 
-        worker_node_dao = daos.WorkerNodeDao(self.settings)
-        worker_node = worker_node_dao.find_by_id(worker_id)
-        if not worker_node:
-            logger.critical(
-                "unknown node with ID '{}' successfully sent heartbeat".format(
-                    worker_id
-                )
-            )
-            self.abort({"message": ""}, status=404)
-            return
-
-        worker_node.last_seen = get_time()
-        worker_node.is_alive = True
-        worker_node_dao.update(worker_node)
+        # written along with the other heartbeats by the heartbeat callback, the
+        # worker was already looked up by authenticate_worker
+        self.get_worker_registry().touch_http(worker_id, get_time())
@@ -2,6 +2,9 @@ import logging
 
 import tornado.ioloop
 
+from pymongo.errors import DocumentTooLarge
+from tornado import gen
+
 from broadway.api.handlers.base import BaseWSAPIHandler
 from broadway.api.decorators.auth import authenticate_cluster_token_ws
 
@@ -10,6 +13,7 @@ import broadway.api.models as models
 
 from broadway.api.callbacks.job import job_update_callback
 from broadway.api.callbacks.worker import worker_lost_callback, worker_schedule_job
+from broadway.api.utils.run import finish_job
 from broadway.api.utils.time import get_time
 
 logger = logging.getLogger(__name__)
@@ -18,6 +22,11 @@ logger = logging.getLogger(__name__)
 class WorkerConnectionHandler(BaseWSAPIHandler):
     def __init__(self, *args, **kwargs):
         self.worker_id = None
+        # number of bytes of live output received for each running job
+        self.log_sizes = {}
+        # live output received but not stored yet, by job and stream
+        self.pending_logs = {}
+        self.log_flush = None
         super().__init__(*args, **kwargs)
 
     @authenticate_cluster_token_ws
@@ -30,41 +39,53 @@ class WorkerConnectionHandler(BaseWSAPIHandler):
         "register",
         {
             "type": "object",
-            "properties": {"hostname": {"type": "string"}},
+            "properties": {
+                "hostname": {"type": "string"},
+                "slots": {"type": "integer", "minimum": 1},
+                "prefetch": {"type": "integer", "minimum": 0},
+            },
             "required": ["hostname"],
             "additionalProperties": False,
         },
     )
-    def handler_register(self, hostname):
+    @gen.coroutine
+    def handler_register(self, hostname, slots=1, prefetch=0):
         if self.worker_id is None:
             return
 
         worker_node_dao = daos.WorkerNodeDao(self.settings)
 
-        dup = worker_node_dao.find_by_id(self.worker_id)
+        dup = yield worker_node_dao.aio.find_by_id(self.worker_id)
 
         if dup is None:
             self.worker_node = models.WorkerNode(
                 id_=self.worker_id,
                 hostname=hostname,
+                slots=slots,
+                prefetch=prefetch,
                 last_seen=get_time(),
                 is_alive=True,
                 use_ws=True,
             )
             logger.info(
-                "new worker '{}' joined on '{}'".format(self.worker_id, hostname)
+                "new worker '{}' joined on '{}' with {} slot(s)".format(
+                    self.worker_id, hostname, slots
+                )
             )
-            worker_node_dao.insert(self.worker_node)
+            yield worker_node_dao.aio.insert(self.worker_node)
         elif not dup.is_alive:
             self.worker_node = dup
             self.worker_node.hostname = hostname
+            self.worker_node.slots = slots
+            self.worker_node.prefetch = prefetch
+            self.worker_node.running_job_ids = []
             self.worker_node.last_seen = get_time()
             self.worker_node.is_alive = True
             self.use_ws = True
             logger.info(
                 "worker '{}' alive again on '{}'".format(self.worker_id, hostname)
             )
-            worker_node_dao.update(self.worker_node)
+            yield worker_node_dao.aio.update(self.worker_node)
         else:
             msg = "worker id '{}' already exists".format(self.worker_id)
             logger.info(msg)
@@ -72,8 +93,13 @@ class WorkerConnectionHandler(BaseWSAPIHandler):
             self.close(reason=msg, code=1002)
             return
 
+        if self.ws_connection is None:
+            # the worker went away while it was being stored
+            return
+
         self.registered = True
         self.get_ws_conn_map()[self.worker_id] = self
+        self.get_worker_registry().add(self.worker_node)
 
         self.send({"success": True})
 
@@ -90,11 +116,12 @@ class WorkerConnectionHandler(BaseWSAPIHandler):
                 "results": {"type": "array", "items": {"type": "object"}},
                 "logs": {"type": "object"},
             },
-            "required": ["grading_job_id", "success", "results", "logs"],
+            "required": ["grading_job_id", "success", "results"],
             "additionalProperties": False,
         },
     )
-    def handler_job_result(self, grading_job_id, success, results, logs):
+    @gen.coroutine
+    def handler_job_result(self, grading_job_id, success, results, logs=None):
         if not self.registered:
             logger.info(
                 "worker '{}' submitted before registering".format(self.worker_id)
@@ -103,7 +130,7 @@ class WorkerConnectionHandler(BaseWSAPIHandler):
             return
 
         grading_job_dao = daos.GradingJobDao(self.settings)
-        job = grading_job_dao.find_by_id(grading_job_id)
+        job = yield grading_job_dao.aio.find_by_id(grading_job_id)
 
         if not job:
             self.close(reason="job with the given ID not found", code=1002)
@@ -122,8 +149,11 @@ class WorkerConnectionHandler(BaseWSAPIHandler):
             )
             return
 
-        worker_node_dao = daos.WorkerNodeDao(self.settings)
-        worker_node = worker_node_dao.find_by_id(self.worker_id)
+        if job.course_id is not None:
+            self.get_queue().release(job.course_id)
+
+        worker_registry = self.get_worker_registry()
+        worker_node = worker_registry.get(self.worker_id)
 
         if not worker_node:
             msg = "unknown worker '{}' successfully updated job".format(self.worker_id)
@@ -137,31 +167,132 @@ class WorkerConnectionHandler(BaseWSAPIHandler):
             )
         )
 
-        # clear the worker node's job
-        worker_node.running_job_id = None
-        worker_node_dao.update(worker_node)
+        # free the worker node's slot
+        worker_registry.release(self.worker_id, grading_job_id)
+        worker_registry.schedule_flush(self.settings)
 
         # finish the job
-        job.finished_at = get_time()
-        job.results = results
-        job.success = success
-        grading_job_dao.update(job)
+        yield finish_job(self.settings, job, success, results)
 
-        # store the logs
+        # the output sent while the job was running is stored first, so that the
+        # complete logs sent with the result, if any, replace it
+        if self.log_flush is not None:
+            yield self.log_flush
         job_log_dao = daos.GradingJobLogDao(self.settings)
-        job_log = models.GradingJobLog(job_id=grading_job_id, **logs)
-        job_log_dao.insert(job_log)
-
-        # thread safe callback
-        tornado.ioloop.IOLoop.current().add_callback(
-            job_update_callback, self.settings, grading_job_id, job.run_id
-        )
+        log_size = self.log_sizes.pop(grading_job_id, 0)
+        if logs is not None:
+            yield self._store_logs(grading_job_id, logs, log_size)
+        elif log_size > self.get_flags()["job_log_max_size"]:
+            yield job_log_dao.aio.append(
+                grading_job_id,
+                stderr="\n[{} bytes of output truncated]\n".format(
+                    log_size - self.get_flags()["job_log_max_size"]
+                ),
+            )
+        else:
+            # make sure jobs without any output have logs as well
+            yield job_log_dao.aio.append(grading_job_id)
 
         # trigger schedule event
         tornado.ioloop.IOLoop.current().add_callback(worker_schedule_job, self.settings)
 
+        # the worker's next message is handled once the run has been moved along
+        yield job_update_callback(self.settings, grading_job_id, job.run_id)
+
+    @gen.coroutine
+    def _store_logs(self, grading_job_id, logs, log_size):
+        if not log_size:
+            # none of the output was relayed while the job was running
+            for stream in ("stdout", "stderr"):
+                if logs.get(stream):
+                    self.get_stream_queue().update_job_log(
+                        grading_job_id, stream, logs[stream]
+                    )
+
+        job_log = models.GradingJobLog(job_id=grading_job_id, **logs)
+        try:
+            yield daos.GradingJobLogDao(self.settings).aio.replace(job_log)
+        except DocumentTooLarge:
+            logger.critical(
+                "logs of job '{}' are too large to be stored, keeping the output "
+                "stored while it ran".format(grading_job_id)
+            )
+
+    @BaseWSAPIHandler.msg_type(
+        "job_log",
+        {
+            "type": "object",
+            "properties": {
+                "grading_job_id": {"type": "string"},
+                "stream": {"type": "string", "enum": ["stdout", "stderr"]},
+                "chunk": {"type": "string"},
+            },
+            "required": ["grading_job_id", "stream", "chunk"],
+            "additionalProperties": False,
+        },
+    )
+    def handler_job_log(self, grading_job_id, stream, chunk):
+        if not self.registered:
+            logger.info(
+                "worker '{}' sent logs before registering".format(self.worker_id)
+            )
+            self.close(reason="sending logs before registering", code=1002)
+            return
+
+        worker_node = self.get_worker_registry().get(self.worker_id)
+        if worker_node is None or grading_job_id not in worker_node.running_job_ids:
+            # e.g. the job was given up on while the output was in flight
+            logger.info(
+                "worker '{}' sent logs for job '{}' it is not running".format(
+                    self.worker_id, grading_job_id
+                )
+            )
+            return
+
+        # output past the limit is still relayed, just not stored. the limit is on
+        # the encoded size, as that is what counts towards the document size limit
+        log_size = self.log_sizes.get(grading_job_id, 0) + len(chunk.encode())
+        self.log_sizes[grading_job_id] = log_size
+        if log_size <= self.get_flags()["job_log_max_size"]:
+            pending = self.pending_logs.setdefault(
+                grading_job_id, {"stdout": [], "stderr": []}
+            )
+            pending[stream].append(chunk)
+            if self.log_flush is None:
+                flush = self._flush_logs()
+                self.log_flush = None if flush.done() else flush
+
+        self.get_stream_queue().update_job_log(grading_job_id, stream, chunk)
+
+    @gen.coroutine
+    def _flush_logs(self):
+        """
+        Stores the live output received since the last flush with one append per
+        job, rather than one per message, without holding up the messages that
+        follow. Output that arrives while appending is stored by the next round.
+        """
+        job_log_dao = daos.GradingJobLogDao(self.settings)
+        try:
+            while self.pending_logs:
+                pending, self.pending_logs = self.pending_logs, {}
+                for job_id, chunks in pending.items():
+                    yield job_log_dao.aio.append(
+                        job_id,
+                        **{
+                            stream: "".join(chunks[stream])
+                            for stream in chunks
+                            if chunks[stream]
+                        }
+                    )
+        except Exception as e:
+            logger.critical("failed to store live output: {}".format(repr(e)))
+        finally:
+            self.log_flush = None
+
     def on_close(self):
         if self.worker_id is not None and self.registered:
+            # no more jobs can be sent to the worker
+            self.get_worker_registry().disconnect(self.worker_id)
             tornado.ioloop.IOLoop.current().add_callback(
                 worker_lost_callback, self.settings, self.worker_id
             )
@@ -180,8 +311,8 @@ class WorkerConnectionHandler(BaseWSAPIHandler):
             logger.critical("worker is not initialized")
             return
 
-        worker_node_dao = daos.WorkerNodeDao(self.settings)
-        worker_node = worker_node_dao.find_by_id(self.worker_id)
+        worker_registry = self.get_worker_registry()
+        worker_node = worker_registry.get(self.worker_id)
 
         if not worker_node:
             logger.critical(
@@ -191,5 +322,5 @@ class WorkerConnectionHandler(BaseWSAPIHandler):
             )
             return
 
-        worker_node.last_seen = get_time()
-        worker_node_dao.update(worker_node)
+        # written along with the other heartbeats by the heartbeat callback
+        worker_registry.touch(self.worker_id, get_time())
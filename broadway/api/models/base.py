@@ -1,2 +1,63 @@
 class BaseModel:
-    pass
+    """
+    Records which attributes are assigned, so that DAOs only write the fields of a
+    model that changed since it was loaded or stored. Attributes that are changed in
+    place (e.g. a list that is appended to) have to be marked with `mark_changed`.
+    """
+
+    # the bookkeeping is kept out of the instance dictionary, which only holds the
+    # model's attributes
+    __slots__ = ("__dict__", "_changes", "_stored_counters")
+
+    # numeric attributes that are written as increments, so that a write does not
+    # overwrite what was added to them elsewhere in the meantime
+    _COUNTERS = ()
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        self.mark_changed(name)
+
+    def mark_changed(self, *names):
+        if not hasattr(self, "_changes"):
+            object.__setattr__(self, "_changes", set())
+        self._changes.update(names)
+
+    def mark_stored(self):
+        """
+        Starts tracking changes from the current values of the attributes
+        """
+        object.__setattr__(self, "_changes", set())
+        object.__setattr__(
+            self,
+            "_stored_counters",
+            {name: getattr(self, name) for name in self._COUNTERS},
+        )
+
+    def pop_changes(self):
+        """
+        Returns the names of the changed attributes to be set, and the amount each
+        changed counter is to be incremented by, and marks the model as stored
+        """
+        changes = getattr(self, "_changes", set())
+        stored_counters = getattr(self, "_stored_counters", {})
+        self.mark_stored()
+
+        increments = {}
+        for name, value in self._stored_counters.items():
+            stored = stored_counters.get(name)
+            # counters of models that were never stored are set as they are
+            if name in changes and stored is not None and value is not None:
+                changes.discard(name)
+                if value != stored:
+                    increments[name] = value - stored
+
+        return changes, increments
+
+    def restore_changes(self, changes, increments):
+        """
+        Marks changes returned by `pop_changes` that could not be written as changed
+        again, so that the next write includes them
+        """
+        self.mark_changed(*changes, *increments)
+        for name, amount in increments.items():
+            self._stored_counters[name] -= amount
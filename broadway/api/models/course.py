@@ -1,8 +1,17 @@
-from typing import List
+from typing import List, Optional
 
 
 class Course:
-    def __init__(self, id_: str, tokens: List[str] = [], query_tokens: List[str] = []):
+    def __init__(
+        self,
+        id_: str,
+        tokens: List[str] = [],
+        query_tokens: List[str] = [],
+        weight: float = 1,
+        max_concurrency: Optional[int] = None,
+    ):
         self.id = id_
         self.tokens = tokens
         self.query_tokens = query_tokens
+        self.weight = weight
+        self.max_concurrency = max_concurrency
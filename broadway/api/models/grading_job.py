@@ -26,6 +26,7 @@ class GradingJob(BaseModel):
         stages: List[Any] = [],
         students: List[Dict[str, str]] = None,
         id_: Optional[str] = None,
+        course_id: Optional[str] = None,
         worker_id: Optional[str] = None,
         queued_at: Optional[datetime] = None,
         started_at: Optional[datetime] = None,
@@ -36,6 +37,7 @@ class GradingJob(BaseModel):
         self.id = id_
         self.type = job_type
         self.run_id = run_id
+        self.course_id = course_id
         self.worker_id = worker_id
         self.queued_at = queued_at
         self.started_at = started_at
@@ -62,7 +64,9 @@ class GradingJob(BaseModel):
 
         # we need to make sure that the incoming stages have these environments
         # merged correctly before setting them
-        stages_copy = stages.copy()
-        for stage in stages_copy:
-            stage["env"] = {**global_environ, **stage.get("env", {}), **run_environ}
-        self.stages = stages_copy
+        # the stages are copied one by one since the same pipeline is used to build
+        # every job of a run
+        self.stages = [
+            {**stage, "env": {**global_environ, **stage.get("env", {}), **run_environ}}
+            for stage in stages
+        ]
@@ -14,6 +14,8 @@ class GradingRunState(Enum):
 
 
 class GradingRun(BaseModel):
+    _COUNTERS = ("student_jobs_left",)
+
     def __init__(
         self,
         assignment_id: str,
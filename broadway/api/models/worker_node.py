@@ -1,22 +1,34 @@
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
+from broadway.api.models.base import BaseModel
+
+
+class WorkerNode(BaseModel):
+    _COUNTERS = ("jobs_processed",)
 
-class WorkerNode:
     def __init__(
         self,
         id_: str,
         hostname: str,
-        running_job_id: Optional[str] = None,
+        running_job_ids: Optional[List[str]] = None,
+        slots: int = 1,
+        prefetch: int = 0,
         last_seen: Optional[datetime] = None,
         jobs_processed: int = 0,
         is_alive: bool = True,
         use_ws: bool = False,
     ):
         self.id = id_
-        self.running_job_id = running_job_id
+        self.running_job_ids = running_job_ids or []
+        self.slots = slots
+        self.prefetch = prefetch
         self.last_seen = last_seen
         self.hostname = hostname
         self.jobs_processed = jobs_processed
         self.is_alive = is_alive
         self.use_ws = use_ws
+
+    def get_free_slots(self) -> int:
+        # prefetched jobs are buffered on the worker until a slot frees up
+        return max(self.slots + self.prefetch - len(self.running_job_ids), 0)
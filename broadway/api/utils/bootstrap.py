@@ -6,6 +6,7 @@ import sys
 import uuid
 import signal
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any
 
 from pymongo import MongoClient
@@ -19,13 +20,19 @@ import tornado.httpserver
 from logging.handlers import TimedRotatingFileHandler
 
 from broadway.api.definitions import course_config
-from broadway.api.daos import CourseDao, WorkerNodeDao
+from broadway.api.daos import ALL_DAOS, CourseDao, WorkerNodeDao
 from broadway.api.models import Course
+from broadway.api.utils.heartbeat import HeartbeatScheduler
 from broadway.api.utils.multiqueue import MultiQueue
+from broadway.api.utils.recovery import recover_queue
 from broadway.api.utils.streamqueue import StreamQueue
+from broadway.api.utils.workerregistry import WorkerRegistry
+from broadway.api.utils.overview import CourseOverview
+from broadway.api.utils.streamlimits import StreamLimiter
 
 import broadway.api.callbacks as callbacks
 import broadway.api.handlers.client as client_handlers
+import broadway.api.handlers.client_ws as client_ws_handlers
 import broadway.api.handlers.worker as worker_handlers
 import broadway.api.handlers.stream as stream_handlers
 import broadway.api.handlers.worker_ws as worker_ws_handlers
@@ -70,39 +77,64 @@ def initialize_global_settings(flags: Dict[str, Any]) -> Dict[str, Any]:
     return {
         "FLAGS": flags,
         "DB": None,
-        "QUEUE": MultiQueue(),
-        "STREAM_QUEUE": StreamQueue(),
+        "DB_EXECUTOR": ThreadPoolExecutor(
+            max_workers=flags["mongodb_threads"], thread_name_prefix="mongodb"
+        ),
+        "QUEUE": MultiQueue(aging=flags["queue_aging"]),
+        "STREAM_QUEUE": StreamQueue(
+            position_update_interval=flags["position_update_interval"],
+            replay_size=flags["stream_replay_size"],
+            replay_timeout=flags["stream_replay_timeout"],
+            log_backlog=flags["stream_log_backlog"],
+        ),
         "WS_CONN_MAP": {},
+        "WORKER_REGISTRY": WorkerRegistry(),
+        "HEARTBEAT_SCHEDULER": HeartbeatScheduler(),
+        "COURSE_OVERVIEW": CourseOverview(),
+        # a limit of 0 means no limit
+        "STREAM_LIMITER": StreamLimiter(
+            max_streams=flags["max_streams"] or None,
+            max_course_streams=flags["max_course_streams"] or None,
+        ),
     }
 
 
 def initialize_course_tokens(settings: Dict[str, Any], flags: Dict[str, Any]):
     logger.info("initializing course config")
 
+    course_dao = CourseDao(settings)
+
     if flags["course_config"] is None:
         logger.warning(
             "no course configuration specified, using existing configuration"
         )
-        return
+    else:
+        with open(flags["course_config"]) as f:
+            courses = json.load(f)
 
-    with open(flags["course_config"]) as f:
-        courses = json.load(f)
+        jsonschema.validate(courses, course_config)
 
-    jsonschema.validate(courses, course_config)
+        logger.info("course config found for {} courses".format(len(courses)))
+        logger.info("dropping existing courses and loading new configuration")
 
-    logger.info("course config found for {} courses".format(len(courses)))
-    logger.info("dropping existing courses and loading new configuration")
+        course_dao.drop_all()
 
-    course_dao = CourseDao(settings)
-    course_dao.drop_all()
+        for course_id, course in courses.items():
+            course = Course(
+                id_=course_id,
+                tokens=course["tokens"],
+                query_tokens=course.get("query_tokens", []),
+                weight=course.get("weight", 1),
+                max_concurrency=course.get("max_concurrency"),
+            )
+            course_dao.insert_or_update(course)
 
-    for course_id, course in courses.items():
-        course = Course(
-            id_=course_id,
-            tokens=course["tokens"],
-            query_tokens=course.get("query_tokens", []),
+    # scheduling shares of each course
+    queue = settings["QUEUE"]
+    for course in course_dao.find_all():
+        queue.configure(
+            course.id, weight=course.weight, max_concurrency=course.max_concurrency
         )
-        course_dao.insert_or_update(course)
 
 
 def initialize_database(settings: Dict[str, Any], flags: Dict[str, Any]):
@@ -117,7 +149,14 @@ def initialize_database(settings: Dict[str, Any], flags: Dict[str, Any]):
 
         settings["DB"] = db_client
 
+        logger.info("ensuring indexes")
+        for dao_class in ALL_DAOS:
+            dao_class(settings).ensure_indexes()
+
         dao = WorkerNodeDao(settings)
+        logger.info("migrating running jobs of worker nodes")
+        dao.migrate_running_job_id()
+
         logger.info("resetting ws worker nodes")
         dao.reset_worker_nodes()
 
@@ -126,6 +165,14 @@ def initialize_database(settings: Dict[str, Any], flags: Dict[str, Any]):
         sys.exit(1)
 
 
+def initialize_queue(settings: Dict[str, Any], flags: Dict[str, Any]):
+    if not flags["persistent_queue"]:
+        return
+
+    logger.info("recovering job queue from database")
+    tornado.ioloop.IOLoop.current().run_sync(lambda: recover_queue(settings))
+
+
 def initialize_signal_handler(settings: Dict[str, Any], flags: Dict[str, Any]):
     logger.info("initializing signal handler")
 
@@ -190,6 +237,10 @@ def initialize_app(
                 r"/api/v1/queue/{}/length".format(id_regex.format("course_id")),
                 client_handlers.CourseQueueLengthHandler,
             ),
+            (
+                r"/api/v1/queue/{}/stats".format(id_regex.format("course_id")),
+                client_handlers.CourseQueueStatsHandler,
+            ),
             (
                 r"/api/v1/queue/{}/{}/position".format(
                     id_regex.format("course_id"), id_regex.format("job_id")
@@ -216,6 +267,21 @@ def initialize_app(
             ),
             # ----------------------------------
             # -------- Stream Endpoints --------
+            (r"/api/v1/stream_stats", stream_handlers.StreamStatsHandler),
+            (
+                r"/api/v1/client_ws/{}".format(id_regex.format("course_id")),
+                client_ws_handlers.ClientConnectionHandler,
+            ),
+            (
+                r"/api/v1/stream/{}/run/{}".format(
+                    id_regex.format("course_id"), id_regex.format("run_id")
+                ),
+                stream_handlers.GradingRunStreamHandler,
+            ),
+            (
+                r"/api/v1/stream/{}/overview".format(id_regex.format("course_id")),
+                stream_handlers.CourseOverviewStreamHandler,
+            ),
             (
                 r"/api/v1/stream/{}/{}".format(
                     id_regex.format("course_id"), id_regex.format("job_id")
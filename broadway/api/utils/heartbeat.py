@@ -0,0 +1,73 @@
+import logging
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+"""
+Keeps idle server-sent event connections alive (and lets proxies and clients know
+they are) with a single timer for the whole process.
+"""
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_TIME_MILLI = 20 * 1000  # 20 seconds
+HEARTBEAT_BATCH_SIZE = 500
+
+
+class HeartbeatScheduler:
+    """
+    Calls `send_heartbeat` on every registered connection once per interval. The
+    connections are walked in batches, yielding to the IOLoop in between, so a large
+    number of connections does not hold up other requests.
+    """
+
+    def __init__(self, interval=HEARTBEAT_TIME_MILLI, batch_size=HEARTBEAT_BATCH_SIZE):
+        # dicts keep insertion order and remove keys in constant time
+        self._connections = {}
+        self._interval = interval
+        self._batch_size = batch_size
+        self._callback = None
+        self._beating = False
+
+    def register(self, conn) -> None:
+        self._connections[conn] = None
+        if self._callback is None:
+            self._callback = PeriodicCallback(self._schedule_beat, self._interval)
+            self._callback.start()
+
+    def unregister(self, conn) -> None:
+        self._connections.pop(conn, None)
+        if not self._connections and self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def get_connection_count(self) -> int:
+        return len(self._connections)
+
+    def _schedule_beat(self):
+        # a walk that takes longer than the interval is not started again
+        if not self._beating:
+            IOLoop.current().spawn_callback(self.beat)
+
+    @gen.coroutine
+    def beat(self):
+        self._beating = True
+        try:
+            connections = list(self._connections)
+            for start in range(0, len(connections), self._batch_size):
+                for conn in connections[start : start + self._batch_size]:
+                    # the connection may have closed during an earlier batch
+                    if conn not in self._connections:
+                        continue
+                    # one broken connection does not hold up the others
+                    try:
+                        conn.send_heartbeat()
+                    except Exception as e:
+                        logger.warning(
+                            "failed to send heartbeat to {}: {}".format(
+                                repr(conn), repr(e)
+                            )
+                        )
+                yield gen.moment
+        finally:
+            self._beating = False
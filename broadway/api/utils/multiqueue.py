@@ -1,52 +1,586 @@
-from queue import Queue, Empty
+import time
+
+from bisect import bisect_right
+from collections import deque
+from queue import Empty
 
 """
-A wrapper around Python's queue module that contains multiple queues
-and round-robins between them when pulling.
+A collection of queues that shares pulls between them by weight, where each queue
+shares its pulls between groups of elements.
 """
 
 
-class MultiQueue:
+class _TicketCounter:
+    """
+    A Fenwick tree counting marked tickets within a window of tickets, which finds
+    the number of marked tickets below a given one in O(log n)
+    """
+
+    def __init__(self, start=0, size=0):
+        self.start = start
+        self._tree = [0] * (size + 1)
+
+    def covers(self, ticket):
+        return self.start <= ticket < self.start + len(self._tree) - 1
+
+    def add(self, ticket, delta):
+        i = ticket - self.start + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def count_below(self, ticket):
+        i = min(ticket - self.start, len(self._tree) - 1)
+        count = 0
+        while i > 0:
+            count += self._tree[i]
+            i -= i & -i
+        return count
+
+
+class TicketQueue:
+    """
+    A FIFO queue that hands out a monotonically increasing ticket to every element
+    pushed into it. The position of an element is the offset of its ticket from the
+    ticket at the head of the queue, so looking up a position does not require
+    scanning the queue.
+
+    Removing an element only marks its ticket as removed; removed entries are
+    skipped once they reach the head of the queue. The removed tickets that have
+    not reached the head yet are counted in a Fenwick tree, so they are subtracted
+    from positions in O(log n).
+    """
+
+    def __init__(self):
+        self._entries = deque()
+        self._tickets = {}
+        self._removed = set()
+        self._removed_counter = _TicketCounter()
+        self._next_ticket = 0
+
+    def _skip_removed(self):
+        while self._entries and self._entries[0][0] in self._removed:
+            ticket = self._entries.popleft()[0]
+            self._removed.remove(ticket)
+            self._removed_counter.add(ticket, -1)
+
+    def _count_removed(self, ticket):
+        if not self._removed_counter.covers(ticket):
+            # the window is twice the span of the live tickets, with room on both
+            # sides, so it is only rebuilt after a proportional number of pushes
+            low = min(ticket, self._entries[0][0])
+            span = max(ticket, self._next_ticket) - low + 1
+            self._removed_counter = _TicketCounter(low - span // 2, 2 * span)
+            for removed in self._removed:
+                self._removed_counter.add(removed, 1)
+
+        self._removed.add(ticket)
+        self._removed_counter.add(ticket, 1)
+
+    def put(self, elem):
+        if elem in self._tickets:
+            raise Exception(f"{elem} is already in the queue.")
+
+        ticket = self._next_ticket
+        self._next_ticket += 1
+
+        self._entries.append((ticket, elem))
+        self._tickets[elem] = ticket
+
+    def put_front(self, elem):
+        if elem in self._tickets:
+            raise Exception(f"{elem} is already in the queue.")
+
+        self._skip_removed()
+        if not self._entries:
+            self.put(elem)
+            return
+
+        # tickets only need to be ordered, so they can go below zero
+        ticket = self._entries[0][0] - 1
+
+        self._entries.appendleft((ticket, elem))
+        self._tickets[elem] = ticket
+
+    def get_nowait(self):
+        self._skip_removed()
+        if not self._entries:
+            raise Empty("TicketQueue is empty.")
+
+        _, elem = self._entries.popleft()
+        del self._tickets[elem]
+        return elem
+
+    def peek(self):
+        self._skip_removed()
+        if not self._entries:
+            raise Empty("TicketQueue is empty.")
+
+        return self._entries[0][1]
+
+    def remove(self, elem) -> bool:
+        ticket = self._tickets.pop(elem, None)
+        if ticket is None:
+            return False
+
+        self._count_removed(ticket)
+        self._skip_removed()
+        return True
+
+    def position(self, elem) -> int:
+        ticket = self._tickets.get(elem)
+        if ticket is None:
+            return -1
+
+        # only removals that have not reached the head yet are counted here
+        return ticket - self._entries[0][0] - self._removed_counter.count_below(ticket)
+
+    def qsize(self) -> int:
+        return len(self._tickets)
+
+    def empty(self) -> bool:
+        return not self._tickets
+
+    def __contains__(self, elem):
+        return elem in self._tickets
+
+    def __iter__(self):
+        for ticket, elem in self._entries:
+            if ticket not in self._removed:
+                yield elem
+
+
+class FairQueue:
+    """
+    A queue made up of ticketed FIFO groups that round-robins between the groups
+    when pulling, so elements of a small group do not have to wait for every element
+    of a large group pushed before them.
+
+    Positions are estimates: they assume the groups keep their current sizes and
+    are pulled from in their current rotation order. The group sizes are sorted once
+    per change of the queue, so looking up the positions of many elements between
+    changes takes O(log n) each.
+    """
+
     def __init__(self):
+        self._groups = {}
+        self._order = deque()
+        self._group_of = {}
+
+        self._sizes = None
+        self._sizes_ahead = {}
+
+    def _changed(self):
+        self._sizes = None
+        self._sizes_ahead = {}
+
+    def _get_sizes(self):
+        """
+        Returns the sorted sizes of all groups, and their prefix sums
+        """
+        if self._sizes is None:
+            sizes = sorted(job_queue.qsize() for job_queue in self._groups.values())
+            prefix_sums = [0]
+            for size in sizes:
+                prefix_sums.append(prefix_sums[-1] + size)
+            self._sizes = (sizes, prefix_sums)
+        return self._sizes
+
+    def _get_sizes_ahead(self, group):
+        """
+        Returns the sorted sizes of the groups ahead of a group in the rotation
+        """
+        if group not in self._sizes_ahead:
+            sizes = []
+            for other in self._order:
+                if other == group:
+                    break
+                sizes.append(self._groups[other].qsize())
+            self._sizes_ahead[group] = sorted(sizes)
+        return self._sizes_ahead[group]
+
+    def _drop_group_if_empty(self, group):
+        if self._groups[group].empty():
+            del self._groups[group]
+            self._order.remove(group)
+
+    def put(self, elem, group=None):
+        if elem in self._group_of:
+            raise Exception(f"{elem} is already in the queue.")
+
+        if group not in self._groups:
+            self._groups[group] = TicketQueue()
+            self._order.append(group)
+
+        self._groups[group].put(elem)
+        self._group_of[elem] = group
+        self._changed()
+
+    def put_front(self, elem, group=None):
+        """
+        Puts an element back at the head of its group, and the group at the head of
+        the rotation, so it is the next element to be pulled.
+        """
+        if elem in self._group_of:
+            raise Exception(f"{elem} is already in the queue.")
+
+        if group not in self._groups:
+            self._groups[group] = TicketQueue()
+        else:
+            self._order.remove(group)
+        self._order.appendleft(group)
+
+        self._groups[group].put_front(elem)
+        self._group_of[elem] = group
+        self._changed()
+
+    def peek(self):
+        if not self._order:
+            raise Empty("FairQueue is empty.")
+
+        return self._groups[self._order[0]].peek()
+
+    def get_nowait(self):
+        if not self._order:
+            raise Empty("FairQueue is empty.")
+
+        group = self._order.popleft()
+        elem = self._groups[group].get_nowait()
+        del self._group_of[elem]
+
+        if self._groups[group].empty():
+            del self._groups[group]
+        else:
+            self._order.append(group)
+
+        self._changed()
+        return elem
+
+    def remove(self, elem) -> bool:
+        if elem not in self._group_of:
+            return False
+
+        group = self._group_of.pop(elem)
+        self._groups[group].remove(elem)
+        self._drop_group_if_empty(group)
+        self._changed()
+        return True
+
+    def position(self, elem) -> int:
+        if elem not in self._group_of:
+            return -1
+
+        group = self._group_of[elem]
+        pos = self._groups[group].position(elem)
+
+        # every group is pulled from once per rotation, so each is pulled from at
+        # most `pos` times in the rotations before the element's turn. the group of
+        # the element is larger than `pos`, and counts the elements ahead of it
+        sizes, prefix_sums = self._get_sizes()
+        smaller = bisect_right(sizes, pos)
+        ahead = prefix_sums[smaller] + pos * (len(sizes) - smaller)
+
+        # groups ahead of this one in the rotation get one more turn before it
+        sizes_ahead = self._get_sizes_ahead(group)
+        return ahead + len(sizes_ahead) - bisect_right(sizes_ahead, pos)
+
+    def get_group(self, group):
+        if group not in self._groups:
+            return []
+        return list(self._groups[group])
+
+    def qsize(self) -> int:
+        return len(self._group_of)
+
+    def empty(self) -> bool:
+        return not self._group_of
+
+    def __contains__(self, elem):
+        return elem in self._group_of
+
+
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+
+
+class LaneQueue:
+    """
+    A high and a normal priority FairQueue. High priority elements are pulled first
+    unless the next normal priority element has waited for longer than `aging`
+    seconds, which keeps normal priority elements from starving.
+    """
+
+    def __init__(self, aging=None):
+        self._lanes = {HIGH_PRIORITY: FairQueue(), NORMAL_PRIORITY: FairQueue()}
+        self._lane_of = {}
+        self._pushed_at = {}
+        self.aging = aging
+
+    def _next_lane(self):
+        high = self._lanes[HIGH_PRIORITY]
+        normal = self._lanes[NORMAL_PRIORITY]
+
+        if high.empty():
+            return normal
+        if normal.empty():
+            return high
+        if (
+            self.aging is not None
+            and time.monotonic() - self._pushed_at[normal.peek()] >= self.aging
+        ):
+            return normal
+        return high
+
+    def put(self, elem, group=None, priority=NORMAL_PRIORITY, front=False):
+        if elem in self._lane_of:
+            raise Exception(f"{elem} is already in the queue.")
+
+        if front:
+            self._lanes[priority].put_front(elem, group)
+        else:
+            self._lanes[priority].put(elem, group)
+        self._lane_of[elem] = priority
+        self._pushed_at[elem] = time.monotonic()
+
+    def peek(self):
+        return self._next_lane().peek()
+
+    def get_nowait(self):
+        elem = self._next_lane().get_nowait()
+        del self._lane_of[elem]
+        del self._pushed_at[elem]
+        return elem
+
+    def remove(self, elem) -> bool:
+        if elem not in self._lane_of:
+            return False
+
+        self._lanes[self._lane_of.pop(elem)].remove(elem)
+        del self._pushed_at[elem]
+        return True
+
+    def position(self, elem) -> int:
+        priority = self._lane_of.get(elem)
+        if priority is None:
+            return -1
+
+        pos = self._lanes[priority].position(elem)
+        if priority == NORMAL_PRIORITY:
+            pos += self._lanes[HIGH_PRIORITY].qsize()
+        return pos
+
+    def get_group(self, group):
+        return self._lanes[HIGH_PRIORITY].get_group(group) + self._lanes[
+            NORMAL_PRIORITY
+        ].get_group(group)
+
+    def next_is_high(self) -> bool:
+        return not self.empty() and self._next_lane() is self._lanes[HIGH_PRIORITY]
+
+    def qsize(self) -> int:
+        return len(self._lane_of)
+
+    def empty(self) -> bool:
+        return not self._lane_of
+
+    def __contains__(self, elem):
+        return elem in self._lane_of
+
+
+class MultiQueue:
+    """
+    Pulls from its queues using deficit round robin. Every time a queue gets its
+    turn it earns credit proportional to its weight, and it keeps being pulled from
+    until it no longer has enough credit to pay for the cost of its next element.
+    A queue can also be capped at a number of elements that have been pulled but
+    not yet released.
+
+    Each queue is a LaneQueue, so high priority elements go first within their queue
+    and elements pushed with different groups (e.g. jobs of different grading runs)
+    take turns within their lane. A queue that is not in debt can also pull a high
+    priority element out of turn; its credit is charged for it as usual.
+    """
+
+    def __init__(self, aging=None):
         self.queues = {}
+        self.aging = aging
         self.keys = []
         self.round_robin_idx = 0
 
+        self.weights = {}
+        self.max_concurrency = {}
+        self.deficits = {}
+        self.running = {}
+        self.dispatched_jobs = {}
+        self.dispatched_work = {}
+
+        self._costs = {}
+        self._queue_of = {}
+        self._max_cost = 1
+        self._credited = False
+
     def _add_queue(self, queue_id):
         if queue_id in self.queues:
             raise Exception(f"{queue_id} already exists in the MultiQueue.")
 
-        self.queues[queue_id] = Queue()
+        self.queues[queue_id] = LaneQueue(aging=self.aging)
         self.keys.append(queue_id)
 
+        self.deficits[queue_id] = 0
+        self.running.setdefault(queue_id, 0)
+        self.dispatched_jobs[queue_id] = 0
+        self.dispatched_work[queue_id] = 0
+
     def _ensure_queue_exists(self, queue_id):
         if queue_id not in self.queues:
             raise Exception(f"{queue_id} does not exist in the MultiQueue.")
 
-    def push(self, queue_id, elem):
+    def _is_eligible(self, queue_id):
+        limit = self.max_concurrency.get(queue_id)
+        return not self.queues[queue_id].empty() and (
+            limit is None or self.running[queue_id] < limit
+        )
+
+    def configure(self, queue_id, weight=1, max_concurrency=None):
+        """
+        Sets the share of a queue. A queue with twice the weight of another gets
+        twice the amount of work pulled from it when both have elements.
+        """
+        if weight <= 0:
+            raise Exception(f"weight of {queue_id} must be positive.")
+
+        self.weights[queue_id] = weight
+        self.max_concurrency[queue_id] = max_concurrency
+
+    def push(self, queue_id, elem, cost=1, group=None, priority=NORMAL_PRIORITY):
+        if queue_id not in self.queues:
+            self._add_queue(queue_id)
+
+        self.queues[queue_id].put(elem, group, priority)
+        self._costs[elem] = cost
+        self._queue_of[elem] = queue_id
+        self._max_cost = max(self._max_cost, cost)
+
+    def push_front(self, queue_id, elem, cost=1, group=None, priority=NORMAL_PRIORITY):
+        """
+        Pushes an element back to the head of its queue, e.g. a job that was handed
+        out but never started.
+        """
+        if queue_id not in self.queues:
+            self._add_queue(queue_id)
+
+        self.queues[queue_id].put(elem, group, priority, front=True)
+        self._costs[elem] = cost
+        self._queue_of[elem] = queue_id
+        self._max_cost = max(self._max_cost, cost)
+
+    def push_many(self, queue_id, elems, cost=1, group=None, priority=NORMAL_PRIORITY):
         if queue_id not in self.queues:
             self._add_queue(queue_id)
 
-        self.queues[queue_id].put(elem)
+        job_queue = self.queues[queue_id]
+        for elem in elems:
+            job_queue.put(elem, group, priority)
+            self._costs[elem] = cost
+            self._queue_of[elem] = queue_id
+        self._max_cost = max(self._max_cost, cost)
 
     def pull(self):
+        return self.pull_with_queue_id()[1]
+
+    def pull_with_queue_id(self):
+        """
+        Pulls the next element, along with the ID of the queue it was pulled from,
+        which is needed to release the element again
+        """
         N = len(self.keys)
         if N == 0:
             raise Empty("MultiQueue has no queues in it.")
 
+        if not any(self._is_eligible(queue_id) for queue_id in self.keys):
+            raise Empty("All the queues in the MultiQueue are empty.")
+
         for i in range(N):
-            idx = (self.round_robin_idx + i) % N
+            queue_id = self.keys[(self.round_robin_idx + i) % N]
+            if (
+                self.deficits[queue_id] >= 0
+                and self._is_eligible(queue_id)
+                and self.queues[queue_id].next_is_high()
+            ):
+                return queue_id, self._pull_from(queue_id)
+
+        while True:
+            queue_id = self.keys[self.round_robin_idx]
 
-            try:
-                rv = self.queues[self.keys[idx]].get_nowait()
-                self.round_robin_idx = (idx + 1) % N
-                return rv
+            if self._is_eligible(queue_id):
+                if not self._credited:
+                    # crediting the largest cost seen keeps every queue with a weight
+                    # of at least 1 able to pull an element on each of its turns
+                    self.deficits[queue_id] += self.weights.get(queue_id, 1) * (
+                        self._max_cost
+                    )
+                    self._credited = True
 
-            except Empty:
-                # continue to next queue
-                pass
+                cost = self._costs[self.queues[queue_id].peek()]
+                if self.deficits[queue_id] >= cost:
+                    return queue_id, self._pull_from(queue_id)
 
-        raise Empty("All the queues in the MultiQueue are empty.")
+            elif self.queues[queue_id].empty():
+                self.deficits[queue_id] = min(self.deficits[queue_id], 0)
+
+            self.round_robin_idx = (self.round_robin_idx + 1) % N
+            self._credited = False
+
+    def _pull_from(self, queue_id):
+        job_queue = self.queues[queue_id]
+
+        rv = job_queue.get_nowait()
+        cost = self._costs.pop(rv)
+        del self._queue_of[rv]
+
+        # unused credit is dropped once a queue runs empty, but debt is kept
+        self.deficits[queue_id] -= cost
+        if job_queue.empty():
+            self.deficits[queue_id] = min(self.deficits[queue_id], 0)
+
+        self.running[queue_id] += 1
+        self.dispatched_jobs[queue_id] += 1
+        self.dispatched_work[queue_id] += cost
+        return rv
+
+    def release(self, queue_id):
+        """
+        Marks an element previously pulled from the queue as finished.
+        """
+        if self.running.get(queue_id, 0) > 0:
+            self.running[queue_id] -= 1
+
+    def acquire(self, queue_id):
+        """
+        Counts an element that was pulled before the MultiQueue was created (e.g. a
+        job still running across a restart) against the queue's concurrency.
+        """
+        self.running[queue_id] = self.running.get(queue_id, 0) + 1
+
+    def get_stats(self, queue_id):
+        self._ensure_queue_exists(queue_id)
+        return {
+            "weight": self.weights.get(queue_id, 1),
+            "max_concurrency": self.max_concurrency.get(queue_id),
+            "queued": self.queues[queue_id].qsize(),
+            "running": self.running[queue_id],
+            "dispatched_jobs": self.dispatched_jobs[queue_id],
+            "dispatched_work": self.dispatched_work[queue_id],
+        }
+
+    def remove(self, queue_id, key):
+        self._ensure_queue_exists(queue_id)
+        if not self.queues[queue_id].remove(key):
+            return False
+
+        del self._costs[key]
+        del self._queue_of[key]
+        return True
 
     def contains_key(self, key):
         return key in self.queues
@@ -55,15 +589,31 @@ class MultiQueue:
         self._ensure_queue_exists(queue_id)
         return self.queues[queue_id].qsize()
 
+    def get_total_length(self):
+        return sum(job_queue.qsize() for job_queue in self.queues.values())
+
     def get_position_in_queue(self, queue_id, key):
         self._ensure_queue_exists(queue_id)
-        try:
-            return self.queues[queue_id].queue.index(key)
-        except ValueError:
+        return self.queues[queue_id].position(key)
+
+    def find_position(self, key):
+        queue_id = self._queue_of.get(key)
+        if queue_id is None:
             return -1
+        return self.queues[queue_id].position(key)
 
-    def update_all_job_positions(self, stream_queue):
-        for queue_id, job_queue in self.queues.items():
-            for job_id in list(job_queue.queue):
-                pos = self.queues[queue_id].queue.index(job_id)
+    def update_job_positions(self, stream_queue):
+        # only jobs that somebody is listening to need a position event
+        for job_id in stream_queue.get_job_ids():
+            pos = self.find_position(job_id)
+            if pos != -1:
                 stream_queue.update_queue_position(job_id, pos)
+
+        # elements are grouped by run, so the queued jobs of a run are found
+        # without scanning the queues
+        for run_id in stream_queue.get_run_ids():
+            for job_queue in self.queues.values():
+                for job_id in job_queue.get_group(run_id):
+                    stream_queue.update_queue_position(
+                        job_id, job_queue.position(job_id), run_id=run_id
+                    )
@@ -0,0 +1,109 @@
+import time
+
+from collections import defaultdict, deque
+
+"""
+In-memory counters behind the course overview stream, updated as runs and jobs
+progress so that an overview never has to be recomputed from the database.
+"""
+
+THROUGHPUT_WINDOW = 60  # seconds
+
+
+class CourseOverview:
+    """
+    Tracks the progress of each course's unfinished runs and the number of jobs
+    each course finished in the last `window` seconds.
+    """
+
+    def __init__(self, window=THROUGHPUT_WINDOW):
+        self._window = window
+        # course id -> run id -> progress of the run
+        self._runs = defaultdict(dict)
+        # course id -> [second, jobs finished in that second] oldest first
+        self._finished = defaultdict(deque)
+        self._finished_counts = defaultdict(int)
+
+    @staticmethod
+    def _course_of(grading_run):
+        return grading_run.assignment_id.split("/")[0]
+
+    def update_run(self, grading_run):
+        """
+        Records the current state of a run, and forgets about it once it is over
+        """
+        course_id = self._course_of(grading_run)
+        runs = self._runs[course_id]
+
+        if grading_run.finished_at is not None:
+            runs.pop(grading_run.id, None)
+            if not runs:
+                del self._runs[course_id]
+            return
+
+        progress = runs.setdefault(grading_run.id, {"failed_jobs": 0})
+        progress["state"] = grading_run.state.name
+        progress["total_jobs"] = len(grading_run.students_env)
+        progress["jobs_left"] = grading_run.student_jobs_left
+
+    def record_finished_job(self, course_id, grading_run_id, failed):
+        now = int(time.monotonic())
+        buckets = self._finished[course_id]
+        if buckets and buckets[-1][0] == now:
+            buckets[-1][1] += 1
+        else:
+            buckets.append([now, 1])
+        self._finished_counts[course_id] += 1
+
+        progress = self._runs.get(course_id, {}).get(grading_run_id)
+        if progress is not None and failed:
+            progress["failed_jobs"] += 1
+
+    def get_throughput(self, course_id):
+        """
+        Returns the number of jobs the course finished in the last `window` seconds
+        """
+        buckets = self._finished.get(course_id)
+        if buckets is None:
+            return 0
+
+        cutoff = int(time.monotonic()) - self._window
+        while buckets and buckets[0][0] <= cutoff:
+            self._finished_counts[course_id] -= buckets.popleft()[1]
+        if not buckets:
+            del self._finished[course_id]
+            del self._finished_counts[course_id]
+            return 0
+        return self._finished_counts[course_id]
+
+    def get_overview(self, course_id, queue, worker_registry):
+        """
+        Combines these counters with the ones kept by the queue and the worker
+        registry into a snapshot of the course
+        """
+        queued = running = 0
+        if queue.contains_key(course_id):
+            stats = queue.get_stats(course_id)
+            queued, running = stats["queued"], stats["running"]
+
+        return {
+            "queue_length": queued,
+            "running_jobs": running,
+            "runs": [
+                {
+                    "grading_run_id": run_id,
+                    "state": progress["state"],
+                    "total_jobs": progress["total_jobs"],
+                    "finished_jobs": progress["total_jobs"] - progress["jobs_left"],
+                    "failed_jobs": progress["failed_jobs"],
+                }
+                for run_id, progress in self._runs.get(course_id, {}).items()
+            ],
+            # workers are shared between courses
+            "idle_workers": worker_registry.get_idle_count(),
+            "busy_workers": worker_registry.get_busy_count(),
+            "throughput": {
+                "window": self._window,
+                "finished_jobs": self.get_throughput(course_id),
+            },
+        }
@@ -0,0 +1,183 @@
+import logging
+
+from tornado import gen
+
+import broadway.api.daos as daos
+from broadway.api.models.grading_job import GradingJobType
+from broadway.api.models.grading_run import GradingRunState
+from broadway.api.utils.run import (
+    continue_grading_run,
+    estimate_job_cost,
+    fail_grading_run,
+    get_job_priority,
+)
+
+logger = logging.getLogger(__name__)
+
+"""
+Rebuilds the in-memory job queue from the grading jobs stored in the database so
+that an API restart does not orphan queued jobs or leave grading runs unfinished.
+
+A job is enqueued once its document is inserted with `queued_at` set and dequeued
+once `started_at` is set on dispatch, so the documents themselves are the journal.
+"""
+
+
+@gen.coroutine
+def recover_queue(settings):
+    """
+    Pushes every unstarted job back into the queue, requeues jobs that were running
+    on workers that did not survive the restart, and reconciles unfinished runs.
+    Runs before the API starts serving, so the database is queried directly except
+    for the runs it moves forward.
+    """
+    queue = settings["QUEUE"]
+    job_dao = daos.GradingJobDao(settings)
+    run_dao = daos.GradingRunDao(settings)
+
+    run_courses = {}
+
+    def course_of(job):
+        if job.course_id is not None:
+            return job.course_id
+
+        # jobs queued before course IDs were recorded
+        if job.run_id not in run_courses:
+            run = run_dao.find_by_id(job.run_id)
+            run_courses[job.run_id] = (
+                run.assignment_id.split("/")[0] if run is not None else None
+            )
+        return run_courses[job.run_id]
+
+    run_sizes = {}
+
+    def push(course_id, job, front=False):
+        if job.type == GradingJobType.STUDENT and job.run_id not in run_sizes:
+            run = run_dao.find_by_id(job.run_id)
+            run_sizes[job.run_id] = len(run.students_env) if run is not None else 0
+
+        (queue.push_front if front else queue.push)(
+            course_id,
+            job.id,
+            cost=estimate_job_cost(job.stages),
+            group=job.run_id,
+            priority=get_job_priority(settings, job.type, run_sizes.get(job.run_id)),
+        )
+
+    pending_runs = set()
+
+    queued_jobs = job_dao.find_queued()
+    for job in queued_jobs:
+        course_id = course_of(job)
+        if course_id is None:
+            logger.critical("cannot requeue job '{}' without a run".format(job.id))
+            continue
+
+        push(course_id, job)
+        pending_runs.add(job.run_id)
+
+    requeued = _requeue_lost_jobs(settings, queue, course_of, push, pending_runs)
+
+    logger.info(
+        "recovered {} queued and {} lost job(s)".format(len(queued_jobs), requeued)
+    )
+
+    for run in run_dao.find_unfinished():
+        yield _reconcile_run(settings, run, run.id in pending_runs)
+        settings["COURSE_OVERVIEW"].update_run(run)
+
+
+def _requeue_lost_jobs(settings, queue, course_of, push, pending_runs):
+    """
+    Jobs that were started on websocket workers are lost on restart since those
+    workers have been reset. HTTP workers may still be alive and report back.
+
+    Lost jobs were dispatched before any job still queued, so they are put back at
+    the head of their queues, in the order they were found.
+    """
+    job_dao = daos.GradingJobDao(settings)
+    worker_dao = daos.WorkerNodeDao(settings)
+
+    lost_jobs = []
+    for job in job_dao.find_running():
+        course_id = course_of(job)
+        if course_id is None:
+            logger.critical("cannot requeue job '{}' without a run".format(job.id))
+            continue
+
+        worker = worker_dao.find_by_id(job.worker_id)
+        if worker is not None and worker.is_alive:
+            queue.acquire(course_id)
+            pending_runs.add(job.run_id)
+            continue
+
+        job.started_at = None
+        job.worker_id = None
+        job_dao.update(job)
+
+        if worker is not None and job.id in worker.running_job_ids:
+            worker.running_job_ids.remove(job.id)
+            worker.mark_changed("running_job_ids")
+            worker_dao.update(worker)
+
+        lost_jobs.append((course_id, job))
+
+    # each job pushed to the front goes ahead of the ones pushed before it
+    for course_id, job in reversed(lost_jobs):
+        push(course_id, job, front=True)
+        pending_runs.add(job.run_id)
+
+    return len(lost_jobs)
+
+
+@gen.coroutine
+def _reconcile_run(settings, run, has_pending_jobs):
+    """
+    Moves a run forward if the API went down between a job finishing and the run
+    being updated, and fails it if the jobs it is waiting for no longer exist.
+    """
+    job_dao = daos.GradingJobDao(settings)
+
+    if run.state == GradingRunState.READY:
+        logger.info("restarting grading run '{}'".format(run.id))
+        yield continue_grading_run(settings, run)
+        return
+
+    if run.state == GradingRunState.STUDENTS_STAGE:
+        total = job_dao.count_by_run_id(run.id, GradingJobType.STUDENT)
+        if total < len(run.students_env):
+            logger.critical(
+                "grading run '{}' lost {} student job(s)".format(
+                    run.id, len(run.students_env) - total
+                )
+            )
+            yield fail_grading_run(settings, run)
+            return
+
+        finished = job_dao.count_by_run_id(
+            run.id, GradingJobType.STUDENT, finished=True
+        )
+        if run.student_jobs_left != total - finished:
+            run.student_jobs_left = total - finished
+            daos.GradingRunDao(settings).update(run)
+
+        if run.student_jobs_left == 0:
+            yield continue_grading_run(settings, run)
+        return
+
+    if has_pending_jobs:
+        return
+
+    if run.state == GradingRunState.PRE_PROCESSING_STAGE:
+        job_type = GradingJobType.PRE_PROCESSING
+    else:
+        job_type = GradingJobType.POST_PROCESSING
+
+    jobs = job_dao.find_by_run_id(run.id, job_type)
+    if not jobs or jobs[0].finished_at is None:
+        logger.critical("grading run '{}' lost its {}".format(run.id, job_type.value))
+        yield fail_grading_run(settings, run)
+    elif jobs[0].success:
+        yield continue_grading_run(settings, run)
+    else:
+        yield fail_grading_run(settings, run)
@@ -1,20 +1,29 @@
 import logging
 
+from bson import ObjectId
+from pymongo.errors import DocumentTooLarge
+from tornado import gen
+
 import broadway.api.daos as daos
 import broadway.api.models as models
 from broadway.api.models.grading_job import GradingJobType
 from broadway.api.models.grading_run import GradingRunState
+from broadway.api.utils.multiqueue import HIGH_PRIORITY, NORMAL_PRIORITY
 from broadway.api.utils.time import get_time
 
 logger = logging.getLogger(__name__)
 
+# seconds a stage is assumed to take when its config does not declare a timeout
+DEFAULT_STAGE_COST = 60
+
 
+@gen.coroutine
 def continue_grading_run(settings, grading_run):
     """
     Moves grading run into next state or finishes it
     """
     assignment_config_dao = daos.AssignmentConfigDao(settings)
-    assignment = assignment_config_dao.find_by_id(grading_run.assignment_id)
+    assignment = yield assignment_config_dao.aio.find_by_id(grading_run.assignment_id)
 
     course_id = assignment.id.split("/")[0]
 
@@ -24,60 +33,180 @@ def continue_grading_run(settings, grading_run):
     queue = settings["QUEUE"]
     if grading_run.state == GradingRunState.READY:
         if assignment.pre_processing_pipeline:
-            _update_run_state(
+            yield _update_run_state(
                 settings, grading_run, GradingRunState.PRE_PROCESSING_STAGE
             )
-            next_job = _prepare_next_job(
+            next_job = yield _prepare_next_job(
                 settings,
+                course_id,
                 grading_run,
                 global_environ,
                 grading_run.pre_processing_env or {},
                 assignment.pre_processing_pipeline,
                 GradingJobType.PRE_PROCESSING,
             )
-            queue.push(course_id, next_job)
+            if next_job is None:
+                yield fail_grading_run(settings, grading_run)
+                return False
+            queue.push(
+                course_id,
+                next_job,
+                cost=estimate_job_cost(assignment.pre_processing_pipeline),
+                group=grading_run.id,
+                priority=HIGH_PRIORITY,
+            )
+            settings["STREAM_QUEUE"].schedule_position_update(queue)
             return True
     if (
         grading_run.state == GradingRunState.READY
         or grading_run.state == GradingRunState.PRE_PROCESSING_STAGE
     ):
-        _update_run_state(settings, grading_run, GradingRunState.STUDENTS_STAGE)
-        for runtime_environ in grading_run.students_env:
-            next_job = _prepare_next_job(
-                settings,
+        yield _update_run_state(settings, grading_run, GradingRunState.STUDENTS_STAGE)
+        cost = estimate_job_cost(assignment.student_pipeline)
+        priority = get_job_priority(
+            settings, GradingJobType.STUDENT, len(grading_run.students_env)
+        )
+        next_jobs = [
+            _build_job(
+                course_id,
                 grading_run,
                 global_environ,
                 runtime_environ,
                 assignment.student_pipeline,
                 GradingJobType.STUDENT,
             )
-            queue.push(course_id, next_job)
+            for runtime_environ in grading_run.students_env
+        ]
+        try:
+            if next_jobs:
+                yield daos.GradingJobDao(settings).aio.insert_many(next_jobs)
+        except DocumentTooLarge:
+            logger.critical(
+                "student jobs of run '{}' are too large to be stored".format(
+                    grading_run.id
+                )
+            )
+            yield fail_grading_run(settings, grading_run)
+            return False
+
+        queue.push_many(
+            course_id,
+            [job.id for job in next_jobs],
+            cost=cost,
+            group=grading_run.id,
+            priority=priority,
+        )
+        settings["STREAM_QUEUE"].schedule_position_update(queue)
         return True
     if grading_run.state == GradingRunState.STUDENTS_STAGE:
         if assignment.post_processing_pipeline:
-            _update_run_state(
+            yield _update_run_state(
                 settings, grading_run, GradingRunState.POST_PROCESSING_STAGE
             )
-            next_job = _prepare_next_job(
+            next_job = yield _prepare_next_job(
                 settings,
+                course_id,
                 grading_run,
                 global_environ,
                 grading_run.post_processing_env or {},
                 assignment.post_processing_pipeline,
                 GradingJobType.POST_PROCESSING,
             )
-            queue.push(course_id, next_job)
+            if next_job is None:
+                yield fail_grading_run(settings, grading_run)
+                return False
+            queue.push(
+                course_id,
+                next_job,
+                cost=estimate_job_cost(assignment.post_processing_pipeline),
+                group=grading_run.id,
+                priority=HIGH_PRIORITY,
+            )
+            settings["STREAM_QUEUE"].schedule_position_update(queue)
             return True
         else:
-            _finish_grading_run(settings, grading_run)
+            yield _finish_grading_run(settings, grading_run)
             return True
     if grading_run.state == GradingRunState.POST_PROCESSING_STAGE:
-        _finish_grading_run(settings, grading_run)
+        yield _finish_grading_run(settings, grading_run)
         return True
     logger.critical("invalid grading run state for run '{}'".format(grading_run.id))
     return False
 
 
+def estimate_job_cost(stages):
+    """
+    Estimates how expensive a job is to run (used for fair scheduling between
+    courses) from the timeouts of its stages
+    """
+    return sum(stage.get("timeout", DEFAULT_STAGE_COST) for stage in stages or [])
+
+
+def get_job_priority(settings, job_type, run_size):
+    """
+    Pre and post processing jobs hold up their whole run, and small runs are
+    usually interactive, so both are queued ahead of bulk student jobs
+    """
+    if job_type != GradingJobType.STUDENT:
+        return HIGH_PRIORITY
+    if run_size <= settings["FLAGS"]["high_priority_run_size"]:
+        return HIGH_PRIORITY
+    return NORMAL_PRIORITY
+
+
+@gen.coroutine
+def requeue_job(settings, job):
+    """
+    Puts a job that was assigned to a worker but never started back at the head of
+    its queue
+    """
+    run = yield daos.GradingRunDao(settings).aio.find_by_id(job.run_id)
+    run_size = len(run.students_env) if run is not None else 0
+
+    job.started_at = None
+    job.worker_id = None
+    yield daos.GradingJobDao(settings).aio.update(job)
+
+    queue = settings["QUEUE"]
+    queue.release(job.course_id)
+    queue.push_front(
+        job.course_id,
+        job.id,
+        cost=estimate_job_cost(job.stages),
+        group=job.run_id,
+        priority=get_job_priority(settings, job.type, run_size),
+    )
+    settings["STREAM_QUEUE"].schedule_position_update(queue)
+
+
+@gen.coroutine
+def finish_job(settings, job, success, results):
+    """
+    Stores the result of a job. A result too large to be stored fails the job
+    instead, so that it does not stay running
+    """
+    job.finished_at = get_time()
+    job.results = results
+    job.success = success
+    try:
+        yield daos.GradingJobDao(settings).aio.update(job)
+    except DocumentTooLarge:
+        logger.critical("results of job '{}' are too large to be stored".format(job.id))
+        yield fail_job(settings, job, "job results are too large to be stored")
+
+
+@gen.coroutine
+def fail_job(settings, job, message):
+    """
+    Finishes a job as failed, with the message as its only result
+    """
+    job.finished_at = get_time()
+    job.results = [{"result": message}]
+    job.success = False
+    yield daos.GradingJobDao(settings).aio.update(job)
+
+
+@gen.coroutine
 def fail_grading_run(settings, run):
     run_dao = daos.GradingRunDao(settings)
     if run is None:
@@ -87,40 +216,97 @@ def fail_grading_run(settings, run):
     run.finished_at = get_time()
     run.state = GradingRunState.FAILED
     run.success = False
-    run_dao.update(run)
+    yield run_dao.aio.update(run)
+
+    _publish_run_state(settings, run, final=True)
 
 
+@gen.coroutine
 def _update_run_state(settings, grading_run, state):
     """
     Updates the state for a grading run
     """
     grading_run_dao = daos.GradingRunDao(settings)
     grading_run.state = state
-    grading_run_dao.update(grading_run)
+    yield grading_run_dao.aio.update(grading_run)
+
+    _publish_run_state(settings, grading_run)
+
+
+def _publish_run_state(settings, grading_run, final=False):
+    settings["COURSE_OVERVIEW"].update_run(grading_run)
+
+    stream_queue = settings["STREAM_QUEUE"]
+    stream_queue.update_run_state(grading_run.id, grading_run.state.name)
+    if final:
+        stream_queue.send_run_close_event(grading_run.id)
 
 
+@gen.coroutine
 def _prepare_next_job(
-    settings, grading_run, global_job_environ, runtime_job_environ, job_stages, job_type
+    settings,
+    course_id,
+    grading_run,
+    global_job_environ,
+    runtime_job_environ,
+    job_stages,
+    job_type,
 ):
     """
     Prepares a job to be submitted to queue
     """
-    grading_job_dao = daos.GradingJobDao(settings)
+    grading_job = _build_job(
+        course_id,
+        grading_run,
+        global_job_environ,
+        runtime_job_environ,
+        job_stages,
+        job_type,
+    )
+    try:
+        yield daos.GradingJobDao(settings).aio.insert(grading_job)
+    except DocumentTooLarge:
+        logger.critical(
+            "{} job of run '{}' is too large to be stored".format(
+                job_type.value, grading_run.id
+            )
+        )
+        return None
+
+    return grading_job.id
+
+
+def _build_job(
+    course_id,
+    grading_run,
+    global_job_environ,
+    runtime_job_environ,
+    job_stages,
+    job_type,
+):
+    """
+    Builds a job with a client generated ID without storing it
+    """
     grading_job = models.GradingJob(
-        job_type=job_type, run_id=grading_run.id, queued_at=get_time()
+        job_type=job_type,
+        id_=str(ObjectId()),
+        run_id=grading_run.id,
+        course_id=course_id,
+        queued_at=get_time(),
     )
-    grading_job.id = str(grading_job_dao.insert(grading_job).inserted_id)
 
     runtime_job_environ["GRADING_JOB_ID"] = grading_job.id
     grading_job.set_stages(job_stages, global_job_environ, runtime_job_environ)
-    grading_job_dao.update(grading_job)
 
-    return grading_job.id
+    return grading_job
 
 
+@gen.coroutine
 def _finish_grading_run(settings, grading_run):
     grading_run_dao = daos.GradingRunDao(settings)
     grading_run.state = GradingRunState.FINISHED
     grading_run.finished_at = get_time()
     grading_run.success = True
-    grading_run_dao.update(grading_run)
+    yield grading_run_dao.aio.update(grading_run)
+
+    _publish_run_state(settings, grading_run, final=True)
@@ -0,0 +1,50 @@
+from collections import Counter
+
+"""
+Caps the number of concurrent streams, so a dashboard gone wrong cannot exhaust
+the process's connections and memory.
+"""
+
+
+class StreamLimiter:
+    """
+    Counts the open streams of each course, and turns new ones away once the course
+    or the whole process has too many. A limit of `None` means no limit.
+    """
+
+    def __init__(self, max_streams=None, max_course_streams=None):
+        self._max_streams = max_streams
+        self._max_course_streams = max_course_streams
+        self._counts = Counter()
+        self._total = 0
+
+    def acquire(self, course_id) -> bool:
+        if self._max_streams is not None and self._total >= self._max_streams:
+            return False
+        if (
+            self._max_course_streams is not None
+            and self._counts[course_id] >= self._max_course_streams
+        ):
+            return False
+
+        self._counts[course_id] += 1
+        self._total += 1
+        return True
+
+    def release(self, course_id) -> None:
+        if self._counts[course_id] <= 0:
+            return
+
+        self._counts[course_id] -= 1
+        self._total -= 1
+        if not self._counts[course_id]:
+            del self._counts[course_id]
+
+    def get_total_count(self) -> int:
+        return self._total
+
+    def get_counts(self):
+        """
+        Returns the number of open streams of each course with any
+        """
+        return dict(self._counts)
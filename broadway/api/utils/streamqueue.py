@@ -1,39 +1,309 @@
-from tornado.queues import Queue
-from collections import defaultdict
+import json
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from collections import Counter, deque, namedtuple
 
 """
 Used in conjunction with server-sent events (SSE) to service updates about grading jobs.
-Updates on a job's queue position and state are saved here.
+Updates on a job's queue position and state are saved here, along with the recent
+events that reconnecting clients may have missed.
+"""
+
+
+def encode_event(event, data, event_id=None) -> bytes:
+    """
+    Encodes an event as a server-sent event chunk.
+
+    :param event: Type of the event.
+    :param data: JSON-serializable payload of the event.
+    :param event_id: ID of the event, sent back by clients in the `Last-Event-ID`
+        header when they reconnect.
+    """
+    blob = json.dumps({"type": event, "data": data})
+    chunk = f"event: status_update\ndata: {blob}\n\n"
+    if event_id is not None:
+        chunk = f"id: {event_id}\n" + chunk
+    return chunk.encode()
+
+
 """
+An event as stored for its listeners. `chunk` is the event encoded as a server-sent
+event chunk, and is `None` (see `StreamQueue.CLOSE_EVENT`) for close events, whose
+other fields are `None` as well.
+"""
+StreamEvent = namedtuple("StreamEvent", ["id", "type", "data", "chunk"])
+
+
+class _Channel:
+    """
+    Events of a single job or run, stored once for all of its listeners. Every
+    listener only keeps a cursor (the index of the next event it will read), and
+    events are dropped once every listener has read them, except for the last
+    `replay_size` events which are kept for listeners that reconnect.
+
+    Events are stored as `StreamEvent`s so that listeners can skip the types they
+    did not ask for.
+    """
+
+    def __init__(self, first_id, replay_size=0):
+        self.events = deque()
+        self.start = 0
+        # bytes of the stored chunks
+        self.size = 0
+        # every event of the channel with an ID of at least this one is stored
+        self.first_id = first_id
+        self.replay_size = replay_size
+        # removes the channel once it has had no listeners for a while
+        self.expiry = None
+        self.cursors = {}
+        self.readers_at = Counter()
+        self.event_types = {}
+        self.waiters = {}
+        # last position published for each job, so unchanged positions are skipped
+        self.positions = {}
+        # amount of log output dropped for each stream while listeners were behind
+        self.dropped_output = Counter()
+
+    @property
+    def end(self):
+        return self.start + len(self.events)
+
+    def get_backlog(self):
+        """
+        Returns the number of events the slowest listener has not read yet
+        """
+        if not self.readers_at:
+            return 0
+        return self.end - min(self.readers_at)
+
+    def add_listener(self, iid, event_types=None, last_event_id=None):
+        """
+        Returns whether the listener receives every event after `last_event_id`, if
+        given. Otherwise it receives the events that are still stored.
+        """
+        cursor = self.end
+        if last_event_id is not None:
+            cursor = self.start
+            for event in self.events:
+                if event.id is not None and event.id > last_event_id:
+                    break
+                cursor += 1
+
+        self.cursors[iid] = cursor
+        self.readers_at[cursor] += 1
+        self.event_types[iid] = event_types
+        return last_event_id is not None and last_event_id + 1 >= self.first_id
+
+    def remove_listener(self, iid):
+        self._move_cursor(iid, None)
+        del self.event_types[iid]
+        waiter, _ = self.waiters.pop(iid, (None, False))
+        if waiter is not None and not waiter.done():
+            waiter.cancel()
+
+    def _move_cursor(self, iid, to):
+        cursor = self.cursors.pop(iid)
+        self.readers_at[cursor] -= 1
+        if not self.readers_at[cursor]:
+            del self.readers_at[cursor]
+        if to is not None:
+            self.cursors[iid] = to
+            self.readers_at[to] += 1
+
+        self._trim()
+
+    def _trim(self):
+        # drop the events that every listener has read, beyond the replay buffer
+        while len(self.events) > self.replay_size and self.start not in self.readers_at:
+            event = self.events.popleft()
+            self.start += 1
+            self.size -= len(event.chunk or b"")
+            if event.id is not None:
+                self.first_id = event.id + 1
+
+    def _skip_filtered(self, iid):
+        event_types = self.event_types[iid]
+        if event_types is None:
+            return
+
+        cursor = self.cursors[iid]
+        while cursor < self.end:
+            event_type = self.events[cursor - self.start].type
+            if event_type is None or event_type in event_types:
+                break
+            cursor += 1
+        if cursor != self.cursors[iid]:
+            self._move_cursor(iid, cursor)
+
+    def read(self, iid, raw=False):
+        self._skip_filtered(iid)
+        event = self.events[self.cursors[iid] - self.start]
+        self._move_cursor(iid, self.cursors[iid] + 1)
+        return event if raw else event.chunk
+
+    def has_update(self, iid):
+        self._skip_filtered(iid)
+        return self.cursors[iid] < self.end
+
+    def append(self, event):
+        self.events.append(event)
+        self.size += len(event.chunk or b"")
+        self._trim()
+
+        waiters, self.waiters = self.waiters, {}
+        for iid, (waiter, raw) in waiters.items():
+            if waiter.done():
+                continue
+            if self.has_update(iid):
+                waiter.set_result(self.read(iid, raw))
+            else:
+                self.waiters[iid] = (waiter, raw)
 
 
 class StreamQueue:
     POSITION_EVENT = "position"
     STATE_EVENT = "state"
+    RUN_STATE_EVENT = "run_state"
+    LOG_EVENT = "log"
     CLOSE_EVENT = None
 
-    def __init__(self):
-        self._streams = defaultdict(lambda: defaultdict(lambda: Queue()))
+    RUN_EVENTS = (POSITION_EVENT, STATE_EVENT, RUN_STATE_EVENT)
+
+    _close_event = StreamEvent(None, None, None, CLOSE_EVENT)
+
+    def __init__(
+        self,
+        position_update_interval=0,
+        replay_size=0,
+        replay_timeout=0,
+        log_backlog=256,
+    ):
+        """
+        :param position_update_interval: Interval in milliseconds over which queue
+            position updates are coalesced. With 0, updates requested within one
+            IOLoop iteration are coalesced.
+        :param replay_size: Number of recent events kept for each job and run, so
+            that reconnecting listeners can receive the events they missed.
+        :param replay_timeout: Number of seconds the recent events of a job or run
+            are kept after its last listener unregisters.
+        :param log_backlog: Number of events the slowest listener of a job can fall
+            behind before log output is dropped for the job (see `update_job_log`).
+        """
+        self._streams = {}
+        self._run_streams = {}
+        self._position_update_interval = position_update_interval
+        self._position_update_scheduled = False
+
+        # event IDs increase monotonically across every job and run
+        self._next_event_id = 1
+        self._replay_size = replay_size
+        self._replay_timeout = replay_timeout
+        self._log_backlog = log_backlog
 
-    def _ensure_stream_exists(self, job_id, iid) -> bool:
+    @staticmethod
+    def _ensure_stream_exists(streams, key, iid) -> bool:
         """
         Raise an exception if there is no corresponding listener.
 
-        :param job_id: Target job ID.
+        :param streams: Either the job or the run streams.
+        :param key: Target job or run ID.
         :param iid: ID of the listener.
         :raises Exception: If there is no corresponding listener.
         """
-        if job_id not in self._streams or iid not in self._streams[job_id]:
-            raise Exception(f"KeyError: ({job_id}:{iid}) is not in the StreamQueue")
+        if key not in streams or iid not in streams[key].cursors:
+            raise Exception(f"KeyError: ({key}:{iid}) is not in the StreamQueue")
+
+    def _register(self, streams, key, iid, event_types, last_event_id) -> bool:
+        channel = streams.get(key)
+        if channel is None:
+            streams[key] = _Channel(self._next_event_id, self._replay_size)
+            streams[key].add_listener(iid, event_types)
+            # nothing was kept for the key, so nothing can be resumed
+            return False
+
+        if channel.expiry is not None:
+            IOLoop.current().remove_timeout(channel.expiry)
+            channel.expiry = None
+
+        # an ID that was not given out by this process cannot be resumed from, so
+        # the listener gets every event that is still kept instead
+        if last_event_id is not None and last_event_id >= self._next_event_id:
+            last_event_id = -1
+        return channel.add_listener(iid, event_types, last_event_id)
+
+    def _unregister(self, streams, key, iid) -> None:
+        self._ensure_stream_exists(streams, key, iid)
+        channel = streams[key]
+        channel.remove_listener(iid)
+        if channel.cursors:
+            return
 
-    def register_stream(self, job_id, iid) -> None:
+        if channel.events and self._replay_timeout > 0:
+            channel.expiry = IOLoop.current().call_later(
+                self._replay_timeout, self._expire, streams, key, channel
+            )
+        else:
+            del streams[key]
+
+    @staticmethod
+    def _expire(streams, key, channel) -> None:
+        if streams.get(key) is channel and not channel.cursors:
+            del streams[key]
+
+    def _publish(self, channel, event_type, data) -> None:
+        event_id = self._next_event_id
+        self._next_event_id += 1
+        channel.append(
+            StreamEvent(
+                event_id, event_type, data, encode_event(event_type, data, event_id)
+            )
+        )
+
+    def _get(self, streams, key, iid, raw) -> Future:
+        self._ensure_stream_exists(streams, key, iid)
+        channel = streams[key]
+
+        future = Future()
+        if channel.has_update(iid):
+            future.set_result(channel.read(iid, raw))
+        else:
+            channel.waiters[iid] = (future, raw)
+        return future
+
+    def register_stream(self, job_id, iid, last_event_id=None) -> bool:
         """
-        Register a new stream to listen for events for the given job ID.
+        Register a new stream to listen for events for the given job ID. The stream
+        receives events published after it is registered, or after the event with
+        `last_event_id` if given.
+
+        Returns whether every event after `last_event_id` could be resumed. If not,
+        the stream receives the recent events that are still kept.
 
         :param job_id: Target job ID.
         :param iid: A unique identifier for the listener (Using `id(self)` in handlers).
+        :param last_event_id: ID of the last event the listener received before it
+            reconnected.
+        """
+        return self._register(self._streams, job_id, iid, None, last_event_id)
+
+    def register_run_stream(
+        self, run_id, iid, event_types=None, last_event_id=None
+    ) -> bool:
+        """
+        Register a new stream to listen for the events of every job in the given run,
+        as well as the run's own state changes. See `register_stream` for resuming.
+
+        :param run_id: Target run ID.
+        :param iid: A unique identifier for the listener (Using `id(self)` in handlers).
+        :param event_types: Types of events (see `RUN_EVENTS`) the stream receives.
+            All of them if `None`.
+        :param last_event_id: ID of the last event the listener received before it
+            reconnected.
         """
-        self._streams[job_id][iid] = Queue()
+        return self._register(
+            self._run_streams, run_id, iid, event_types, last_event_id
+        )
 
     def unregister_stream(self, job_id, iid) -> None:
         """
@@ -43,10 +313,43 @@ class StreamQueue:
         :param iid: ID of the listener.
         :raises Exception: If there is no corresponding listener.
         """
-        self._ensure_stream_exists(job_id, iid)
-        del self._streams[job_id][iid]
-        if not self._streams[job_id]:
-            del self._streams[job_id]
+        self._unregister(self._streams, job_id, iid)
+
+    def unregister_run_stream(self, run_id, iid) -> None:
+        """
+        Remove a listener for the given run ID.
+
+        :param run_id: Target run ID.
+        :param iid: ID of the listener.
+        :raises Exception: If there is no corresponding listener.
+        """
+        self._unregister(self._run_streams, run_id, iid)
+
+    def get_job_ids(self):
+        """
+        Returns the IDs of all jobs that have at least one listener.
+        """
+        return list(self._streams.keys())
+
+    def get_run_ids(self):
+        """
+        Returns the IDs of all runs that have at least one listener.
+        """
+        return list(self._run_streams.keys())
+
+    def get_stats(self):
+        """
+        Returns the number of jobs and runs with stored events or listeners, the
+        number of listeners, and the number and size of the stored events.
+        """
+        channels = list(self._streams.values()) + list(self._run_streams.values())
+        return {
+            "jobs": len(self._streams),
+            "runs": len(self._run_streams),
+            "listeners": sum(len(channel.cursors) for channel in channels),
+            "events": sum(len(channel.events) for channel in channels),
+            "bytes": sum(channel.size for channel in channels),
+        }
 
     def has_update(self, job_id, iid) -> bool:
         """
@@ -56,54 +359,173 @@ class StreamQueue:
         :param iid: ID of the listener.
         :raises Exception: If there is no corresponding listener.
         """
-        self._ensure_stream_exists(job_id, iid)
-        return not self._streams[job_id][iid].empty()
+        self._ensure_stream_exists(self._streams, job_id, iid)
+        return self._streams[job_id].has_update(iid)
+
+    def has_run_update(self, run_id, iid) -> bool:
+        """
+        Returns whether a listener of a run has any new events.
+
+        :param run_id: Target run ID.
+        :param iid: ID of the listener.
+        :raises Exception: If there is no corresponding listener.
+        """
+        self._ensure_stream_exists(self._run_streams, run_id, iid)
+        return self._run_streams[run_id].has_update(iid)
 
-    def get(self, job_id, iid):
+    def get(self, job_id, iid, raw=False) -> Future:
         """
-        Pops and returns the next message from the listener's event queue. Returns a
-        tuple `(event, data)` or a sentinel value signifying there are no more events
-        for the job. See docstring for `send_close_event` for information about this
-        value.
+        Returns a future that resolves to the listener's next event, encoded as a
+        server-sent event chunk (see `encode_event`), or to a sentinel value
+        signifying there are no more events for the job. See docstring for
+        `send_close_event` for information about this value.
 
-        Blocks until there is an item in the queue.
+        The future is already resolved if the listener has unread events.
 
         :param job_id: Target job ID.
         :param iid: ID of the listener.
+        :param raw: Resolve to the `StreamEvent` instead of its chunk, for listeners
+            that do not speak server-sent events.
+        :raises Exception: If there is no corresponding listener.
+        """
+        return self._get(self._streams, job_id, iid, raw)
+
+    def get_run_event(self, run_id, iid, raw=False) -> Future:
+        """
+        Same as `get`, for a listener of a run.
+
+        :param run_id: Target run ID.
+        :param iid: ID of the listener.
+        :param raw: Resolve to the `StreamEvent` instead of its chunk.
         :raises Exception: If there is no corresponding listener.
         """
-        self._ensure_stream_exists(job_id, iid)
-        return self._streams[job_id][iid].get()
+        return self._get(self._run_streams, run_id, iid, raw)
 
-    def _update(self, job_id, event) -> None:
+    def _update(self, job_id, event_type, data) -> None:
         """
-        General function for adding events to listener queues.
+        General function for publishing events to the listeners of a job. The event
+        is given the next event ID and stored once no matter how many listeners
+        there are.
 
         :param job_id: Target job ID.
-        :param event: Event tuple to add to the queues.
+        :param event_type: Type of the event.
+        :param data: Payload of the event.
         """
         if job_id not in self._streams:
             return
-        for iid in self._streams[job_id]:
-            self._streams[job_id][iid].put(event)
+        self._publish(self._streams[job_id], event_type, data)
+
+    def _update_run(self, run_id, event_type, data) -> None:
+        """
+        Same as `_update`, for the listeners of a run.
+        """
+        if run_id not in self._run_streams:
+            return
+        self._publish(self._run_streams[run_id], event_type, data)
 
-    def update_queue_position(self, job_id, position) -> None:
+    def update_queue_position(self, job_id, position, run_id=None) -> None:
         """
-        Add a queue position change event to all listeners of the given job ID.
+        Add a queue position change event to all listeners of the given job ID, and
+        of its run if given.
 
         :param job_id: Target job ID.
         :param position: New position of the job.
+        :param run_id: ID of the run the job belongs to.
         """
-        self._update(job_id, (self.POSITION_EVENT, position))
+        channel = self._streams.get(job_id)
+        if channel is not None and channel.positions.get(job_id) != position:
+            channel.positions[job_id] = position
+            self._update(job_id, self.POSITION_EVENT, position)
 
-    def update_job_state(self, job_id, state) -> None:
+        channel = self._run_streams.get(run_id)
+        if channel is not None and channel.positions.get(job_id) != position:
+            channel.positions[job_id] = position
+            self._update_run(
+                run_id,
+                self.POSITION_EVENT,
+                {"grading_job_id": job_id, "position": position},
+            )
+
+    def schedule_position_update(self, queue) -> None:
+        """
+        Schedule a queue position event for every job that has listeners. Requests
+        made before the update runs are coalesced into a single update, so a job gets
+        at most one position event per IOLoop iteration (or per configured interval)
+        no matter how many jobs are pulled in between.
+
+        :param queue: The `MultiQueue` to read positions from.
+        """
+        if self._position_update_scheduled:
+            return
+        if not self._streams and not self._run_streams:
+            return
+        self._position_update_scheduled = True
+
+        ioloop = IOLoop.current()
+        if self._position_update_interval > 0:
+            ioloop.call_later(
+                self._position_update_interval / 1000, self._run_position_update, queue,
+            )
+        else:
+            ioloop.add_callback(self._run_position_update, queue)
+
+    def _run_position_update(self, queue) -> None:
+        self._position_update_scheduled = False
+        queue.update_job_positions(self)
+
+    def update_job_state(self, job_id, state, run_id=None) -> None:
         """
-        Add a job state change event to all listeners of the given job ID.
+        Add a job state change event to all listeners of the given job ID, and of its
+        run if given.
 
         :param job_id: Target job ID.
         :param state: New state of the job.
+        :param run_id: ID of the run the job belongs to.
+        """
+        self._update(job_id, self.STATE_EVENT, state)
+        self._update_run(
+            run_id, self.STATE_EVENT, {"grading_job_id": job_id, "state": state}
+        )
+
+    def update_job_log(self, job_id, stream, chunk) -> None:
+        """
+        Add a chunk of a running job's output to all listeners of the given job ID.
+        Output is not sent to the listeners of the job's run.
+
+        While the slowest listener is more than `log_backlog` events behind, chunks
+        are dropped instead, and the listeners are told how much output they missed
+        once they catch up.
+
+        :param job_id: Target job ID.
+        :param stream: Either "stdout" or "stderr".
+        :param chunk: The output.
+        """
+        channel = self._streams.get(job_id)
+        if channel is None:
+            return
+
+        if channel.get_backlog() >= self._log_backlog:
+            channel.dropped_output[stream] += len(chunk)
+            return
+
+        self._publish_dropped_output(channel)
+        self._publish(channel, self.LOG_EVENT, {"stream": stream, "chunk": chunk})
+
+    def _publish_dropped_output(self, channel) -> None:
+        for stream, dropped in channel.dropped_output.items():
+            self._publish(
+                channel, self.LOG_EVENT, {"stream": stream, "dropped": dropped}
+            )
+        channel.dropped_output.clear()
+
+    def update_run_state(self, run_id, state) -> None:
+        """
+        Add a run state change event to all listeners of the given run ID.
+
+        :param run_id: Target run ID.
+        :param state: New state of the run.
         """
-        self._update(job_id, (self.STATE_EVENT, state))
+        self._update_run(run_id, self.RUN_STATE_EVENT, state)
 
     def send_close_event(self, job_id) -> None:
         """
@@ -113,4 +535,15 @@ class StreamQueue:
 
         :param job_id: Target job ID.
         """
-        self._update(job_id, self.CLOSE_EVENT)
+        if job_id in self._streams:
+            self._publish_dropped_output(self._streams[job_id])
+            self._streams[job_id].append(self._close_event)
+
+    def send_run_close_event(self, run_id) -> None:
+        """
+        Same as `send_close_event`, for the listeners of a run.
+
+        :param run_id: Target run ID.
+        """
+        if run_id in self._run_streams:
+            self._run_streams[run_id].append(self._close_event)
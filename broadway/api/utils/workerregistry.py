@@ -0,0 +1,204 @@
+import logging
+
+from collections import OrderedDict, deque
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+import broadway.api.daos as daos
+
+"""
+The authoritative state of the websocket workers connected to this API process.
+The worker node documents in the database are only written from it, after the
+fact, for observability.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerRegistry:
+    """
+    Keeps connected workers in an idle set (at least one free slot) and a busy set,
+    so the scheduler can find a worker to dispatch to in constant time. Idle
+    workers are handed out in rotation so jobs are spread between them.
+
+    HTTP workers long-polling for a job are parked here as well, and are woken up
+    in the order they were parked when there are jobs for them to pull.
+
+    Heartbeats of both kinds of workers are only kept in memory, and are written to
+    the database together by `flush_heartbeats`.
+    """
+
+    def __init__(self):
+        self._workers = {}
+        self._idle = OrderedDict()
+        self._busy = set()
+        self._parked = deque()
+
+        self._dirty = set()
+        self._flush_scheduled = False
+
+        # websocket workers whose last heartbeat is not written yet, and the time of
+        # the last heartbeat of each http worker
+        self._touched = set()
+        self._http_heartbeats = {}
+
+    def _update_sets(self, worker):
+        if worker.get_free_slots() > 0:
+            self._busy.discard(worker.id)
+            self._idle.setdefault(worker.id, None)
+        else:
+            self._idle.pop(worker.id, None)
+            self._busy.add(worker.id)
+
+    def add(self, worker):
+        if worker.id in self._workers:
+            raise Exception(f"worker {worker.id} is already registered.")
+
+        self._workers[worker.id] = worker
+        self._update_sets(worker)
+        self._dirty.add(worker.id)
+
+    def get(self, worker_id):
+        return self._workers.get(worker_id)
+
+    def get_workers(self):
+        return list(self._workers.values())
+
+    def disconnect(self, worker_id):
+        """
+        Stops dispatching to a worker while keeping it (and the jobs it was running)
+        around until it is removed
+        """
+        self._idle.pop(worker_id, None)
+        self._busy.discard(worker_id)
+
+    def remove(self, worker_id):
+        self.disconnect(worker_id)
+        self._dirty.discard(worker_id)
+        self._touched.discard(worker_id)
+        self._http_heartbeats.pop(worker_id, None)
+        return self._workers.pop(worker_id, None)
+
+    def get_idle_worker(self):
+        if not self._idle:
+            return None
+        return self._workers[next(iter(self._idle))]
+
+    def assign(self, worker_id, job_id):
+        worker = self._workers[worker_id]
+        worker.running_job_ids.append(job_id)
+        worker.mark_changed("running_job_ids")
+        worker.jobs_processed += 1
+
+        # the next job goes to the next idle worker in rotation
+        self._idle.pop(worker_id, None)
+        self._update_sets(worker)
+        self._dirty.add(worker_id)
+
+    def release(self, worker_id, job_id):
+        worker = self._workers.get(worker_id)
+        if worker is None or job_id not in worker.running_job_ids:
+            return
+
+        worker.running_job_ids.remove(job_id)
+        worker.mark_changed("running_job_ids")
+        if worker_id in self._idle or worker_id in self._busy:
+            self._update_sets(worker)
+        self._dirty.add(worker_id)
+
+    def touch(self, worker_id, last_seen):
+        worker = self._workers.get(worker_id)
+        if worker is not None:
+            worker.last_seen = last_seen
+            self._touched.add(worker_id)
+
+    def touch_http(self, worker_id, last_seen):
+        self._http_heartbeats[worker_id] = last_seen
+
+    def get_last_seen(self, worker):
+        """
+        Returns the time of the last heartbeat of a worker, which may not be written
+        to the database yet
+        """
+        if worker.use_ws:
+            return worker.last_seen
+        return self._http_heartbeats.get(worker.id, worker.last_seen)
+
+    def get_idle_count(self):
+        return len(self._idle)
+
+    def get_busy_count(self):
+        return len(self._busy)
+
+    def park(self):
+        """
+        Returns a future that is resolved once there may be a job to pull
+        """
+        future = tornado.concurrent.Future()
+        self._parked.append(future)
+        return future
+
+    def unpark(self, future):
+        if future in self._parked:
+            self._parked.remove(future)
+
+    def wake_parked(self, n):
+        while n > 0 and self._parked:
+            future = self._parked.popleft()
+            if not future.done():
+                future.set_result(None)
+                n -= 1
+
+    def get_parked_count(self):
+        return len(self._parked)
+
+    def schedule_flush(self, settings):
+        """
+        Writes the workers that changed since the last flush to the database once
+        the current IOLoop iteration is done
+        """
+        if self._flush_scheduled or not self._dirty:
+            return
+
+        self._flush_scheduled = True
+        tornado.ioloop.IOLoop.current().add_callback(self._flush, settings)
+
+    @tornado.gen.coroutine
+    def _flush(self, settings, heartbeats=None):
+        self._flush_scheduled = False
+        heartbeats = heartbeats or {}
+
+        # the updates are built here rather than on the database threads, since the
+        # workers keep changing while they are written
+        dirty, self._dirty = self._dirty, set()
+        popped = [
+            (self._workers[worker_id], *self._workers[worker_id].pop_changes())
+            for worker_id in dirty
+            if worker_id in self._workers
+        ]
+
+        worker_node_dao = daos.WorkerNodeDao(settings)
+        try:
+            requests = worker_node_dao.to_updates(popped, heartbeats)
+            if requests:
+                yield worker_node_dao.aio.bulk_update(requests)
+        except Exception as e:
+            # written by the next flush instead
+            logger.critical("failed to write workers: {}".format(repr(e)))
+            for worker, changes, increments in popped:
+                worker.restore_changes(changes, increments)
+                self._dirty.add(worker.id)
+            for worker_id, last_seen in heartbeats.items():
+                self._http_heartbeats.setdefault(worker_id, last_seen)
+
+    def flush_heartbeats(self, settings):
+        """
+        Writes the heartbeats received since the last call, along with the other
+        changes of the workers, in a single round trip. Called periodically.
+        """
+        self._dirty |= self._touched
+        self._touched = set()
+        heartbeats, self._http_heartbeats = self._http_heartbeats, {}
+        return self._flush(settings, heartbeats)
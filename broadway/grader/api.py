@@ -1,11 +1,16 @@
 # API keys
 AUTH = "Authorization"
 HOSTNAME = "hostname"
+SLOTS = "slots"
+PREFETCH = "prefetch"
 HEARTBEAT = "heartbeat"
+WAIT = "wait"
 GRADING_JOB_ID = "grading_job_id"
 RESULTS = "results"
 SUCCESS = "success"
 LOGS = "logs"
+STREAM = "stream"
+CHUNK = "chunk"
 STAGES = "stages"
 ENV = "env"
 
@@ -19,6 +24,8 @@ SUCCESS_CODE = 200
 QUEUE_EMPTY_CODE = 498
 JOB_POLL_INTERVAL = 5
 HEARTBEAT_INTERVAL = 10
+LOG_CHUNK_SIZE = 16 * 1024  # bytes
+LOG_SEND_INTERVAL = 0.5
 
 GRADING_STAGE_DEF = {
     "type": ["object", "null"],
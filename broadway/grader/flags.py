@@ -1,5 +1,7 @@
 from flagset import Flag, FlagSet
 
+from broadway.grader.api import JOB_POLL_INTERVAL
+
 fset = FlagSet(
     {
         "token": Flag(
@@ -25,6 +27,34 @@ fset = FlagSet(
             help="api host. no slash in the end. "
             + "supported protocols: ws(s) and http(s)",
         ),
+        "slots": Flag(
+            int,
+            default=1,
+            cmdline_name="--slots",
+            env_name="BROADWAY_SLOTS",
+            config_name="slots",
+            help="number of jobs to run concurrently. "
+            + "only supported by websocket graders",
+        ),
+        "prefetch_depth": Flag(
+            int,
+            default=0,
+            cmdline_name="--prefetch-depth",
+            env_name="BROADWAY_PREFETCH_DEPTH",
+            config_name="prefetch_depth",
+            help="number of jobs to buffer so that a slot can start its next job "
+            + "as soon as it is done. only supported by websocket graders",
+        ),
+        "long_poll": Flag(
+            int,
+            default=30,
+            cmdline_name="--long-poll",
+            env_name="BROADWAY_LONG_POLL",
+            config_name="long_poll",
+            help="seconds the api may hold a job request until a job is available. "
+            + "0 polls every {} seconds instead. ".format(JOB_POLL_INTERVAL)
+            + "only used by http graders",
+        ),
         "verbose": Flag(
             bool,
             default=False,
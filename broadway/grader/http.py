@@ -29,6 +29,7 @@ _heartbeat_interval = HEARTBEAT_INTERVAL
 _api_host = None
 _header = None
 _verbose = None
+_long_poll = None
 
 _event_loop = asyncio.new_event_loop()
 _exit_event = Event()
@@ -66,14 +67,18 @@ def _worker_routine():
     asyncio.set_event_loop(_event_loop)
 
     while not _exit_event.is_set():
-        # poll from queue
+        # poll from queue. with long polling, the api holds the request until a job
+        # is available or the wait is over
         response = requests.get(
-            _get_url("{}/{}".format(GRADING_JOB_ENDPOINT, _grader_id)), headers=_header
+            _get_url("{}/{}".format(GRADING_JOB_ENDPOINT, _grader_id)),
+            headers=_header,
+            params={api.WAIT: _long_poll} if _long_poll else None,
         )
 
         # if the queue is empty then sleep for a while
         if response.status_code == QUEUE_EMPTY_CODE:
-            _exit_event.wait(JOB_POLL_INTERVAL)
+            if not _long_poll:
+                _exit_event.wait(JOB_POLL_INTERVAL)
             continue
 
         if response.status_code != SUCCESS_CODE:
@@ -177,6 +182,7 @@ def run_http_grader(flags):
     global _header
     global _api_host
     global _verbose
+    global _long_poll
 
     signal.signal(signal.SIGINT, _signal_handler)
 
@@ -184,6 +190,7 @@ def run_http_grader(flags):
     _hostname = socket.gethostname()
     _api_host = flags["api_host"]
     _verbose = flags["verbose"]
+    _long_poll = flags["long_poll"]
 
     # register node to server
     _header = {api.AUTH: "Bearer {}".format(flags["token"])}
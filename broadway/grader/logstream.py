@@ -0,0 +1,105 @@
+import codecs
+import logging
+import threading
+
+import docker
+
+"""
+Follows the output of the containers of running jobs as it is produced.
+
+Chainlink only hands back the output of a job's containers once they exit, and does
+not say which containers it started. The containers of a job are recognized by the
+GRADING_JOB_ID the api puts into the environment of every stage instead.
+"""
+
+logger = logging.getLogger(__name__)
+
+JOB_ID_ENV = "GRADING_JOB_ID="
+STREAMS = ("stdout", "stderr")
+
+
+def _get_job_id(container):
+    for var in container.attrs["Config"].get("Env") or []:
+        if var.startswith(JOB_ID_ENV):
+            return var[len(JOB_ID_ENV) :]
+    return None
+
+
+class ContainerLogFollower:
+    """
+    Watches the docker daemon for containers being started, and calls the callback
+    registered for the container's job with each piece of its output, as
+    `callback(stream, text)`, on the given event loop.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._client = docker.from_env()
+        self._callbacks = {}
+        self._events = None
+
+    def start(self):
+        self._events = self._client.events(
+            decode=True, filters={"type": "container", "event": "start"}
+        )
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def stop(self):
+        if self._events is not None:
+            self._events.close()
+
+    def follow(self, job_id, callback):
+        self._callbacks[job_id] = callback
+
+    def unfollow(self, job_id):
+        self._callbacks.pop(job_id, None)
+
+    def _watch(self):
+        try:
+            for event in self._events:
+                self._on_start(event["id"])
+        except Exception as e:
+            # e.g. the stream was closed by stop
+            logger.info("stopped watching containers: {}".format(repr(e)))
+
+    def _on_start(self, container_id):
+        try:
+            container = self._client.containers.get(container_id)
+        except docker.errors.NotFound:
+            return
+
+        job_id = _get_job_id(container)
+        if job_id not in self._callbacks:
+            return
+
+        for stream in STREAMS:
+            threading.Thread(
+                target=self._follow_container,
+                args=(container, job_id, stream),
+                daemon=True,
+            ).start()
+
+    def _follow_container(self, container, job_id, stream):
+        # a multibyte character may be split between two pieces of output
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        try:
+            for data in container.logs(
+                stdout=stream == "stdout",
+                stderr=stream == "stderr",
+                stream=True,
+                follow=True,
+            ):
+                text = decoder.decode(data)
+                if text:
+                    self._emit(job_id, stream, text)
+            self._emit(job_id, stream, decoder.decode(b"", final=True))
+        except docker.errors.APIError as e:
+            # e.g. the container was removed before its output was attached to
+            logger.warning(
+                "lost output of container {}: {}".format(container.id, repr(e))
+            )
+
+    def _emit(self, job_id, stream, text):
+        callback = self._callbacks.get(job_id)
+        if callback is not None and text:
+            self._loop.call_soon_threadsafe(callback, stream, text)
@@ -11,6 +11,7 @@ from chainlink import Chainlink
 
 import broadway.grader.api as api
 from broadway.grader.api import WORKER_WS_ENDPOINT, HEARTBEAT_INTERVAL, GRADING_JOB_DEF
+from broadway.grader.logstream import STREAMS, ContainerLogFollower
 
 logger = logging.getLogger(__name__)
 
@@ -57,19 +58,140 @@ async def _exec_job(flags, job):
     }
 
 
+def _split_chunks(text, size):
+    """
+    Splits text into pieces of at most `size` bytes once encoded, without splitting
+    any character
+    """
+    data = text.encode()
+    start = 0
+    while start < len(data):
+        end = min(start + size, len(data))
+        # utf-8 continuation bytes look like 0b10xxxxxx
+        while end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        yield data[start:end].decode()
+        start = end
+
+
+async def _send_logs(ws, job_id, logs):
+    # logs are sent in bounded chunks ahead of the result, so the api can relay them
+    # to clients and append them to storage as they arrive
+    for stream in STREAMS:
+        for chunk in _split_chunks(logs[stream], api.LOG_CHUNK_SIZE):
+            await ws.send(
+                json.dumps(
+                    {
+                        "type": "job_log",
+                        "args": {
+                            api.GRADING_JOB_ID: job_id,
+                            api.STREAM: stream,
+                            api.CHUNK: chunk,
+                        },
+                    }
+                )
+            )
+
+
+class _LogSender:
+    """
+    Collects the output of a running job and sends what was collected at most every
+    LOG_SEND_INTERVAL seconds, so that chatty jobs do not send a message per line.
+
+    This is only a live preview: output that is followed late or not at all is not
+    sent, since the complete logs are sent along with the result.
+    """
+
+    def __init__(self, ws, job_id):
+        self._ws = ws
+        self._job_id = job_id
+        self._pending = {stream: [] for stream in STREAMS}
+        self._wake = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.ensure_future(self._run())
+
+    def add(self, stream, text):
+        if self._closed:
+            # e.g. output of the last container delivered after the job finished
+            return
+        self._pending[stream].append(text)
+        self._wake.set()
+
+    async def close(self):
+        """
+        Sends the output that is still pending once the job is done
+        """
+        self._closed = True
+        self._wake.set()
+        await self._task
+        await self._flush()
+
+    async def _run(self):
+        while not self._closed:
+            await self._wake.wait()
+            self._wake.clear()
+            await self._flush()
+            if not self._closed:
+                await asyncio.sleep(api.LOG_SEND_INTERVAL)
+
+    async def _flush(self):
+        logs = {}
+        for stream in STREAMS:
+            logs[stream] = "".join(self._pending[stream])
+            self._pending[stream] = []
+        if any(logs.values()):
+            await _send_logs(self._ws, self._job_id, logs)
+
+
+async def _run_slot(flags, ws, jobs, follower):
+    while True:
+        job = await jobs.get()
+        job_id = job[api.GRADING_JOB_ID]
+
+        # the output of the job's containers is sent while they run
+        sender = _LogSender(ws, job_id)
+        follower.follow(job_id, sender.add)
+        try:
+            job_result = await _exec_job(flags, job)
+        finally:
+            follower.unfollow(job_id)
+            await sender.close()
+
+        # the logs chainlink collected are complete, unlike the output that was
+        # followed, so they are sent with the result and replace what was stored
+        await ws.send(json.dumps({"type": "job_result", "args": job_result}))
+
+
 async def _run(flags):
     url = "{}{}/{}".format(flags["api_host"], WORKER_WS_ENDPOINT, flags["grader_id"])
 
     headers = {api.AUTH: "Bearer {}".format(flags["token"])}
     hostname = socket.gethostname()
 
+    # jobs received but not started yet. the api sends at most one job per free
+    # slot plus the prefetch depth, so this never grows past the prefetch depth
+    jobs = asyncio.Queue()
+    slots = []
+
+    follower = ContainerLogFollower(asyncio.get_event_loop())
+    follower.start()
+
     async with websockets.connect(
         url, ping_interval=HEARTBEAT_INTERVAL, extra_headers=headers
     ) as ws:
         # poll job
         try:
             await ws.send(
-                json.dumps({"type": "register", "args": {"hostname": hostname}})
+                json.dumps(
+                    {
+                        "type": "register",
+                        "args": {
+                            api.HOSTNAME: hostname,
+                            api.SLOTS: flags["slots"],
+                            api.PREFETCH: flags["prefetch_depth"],
+                        },
+                    }
+                )
             )
 
             ack = json.loads(await ws.recv())
@@ -77,16 +199,23 @@ async def _run(flags):
             if not ack["success"]:
                 raise Exception("failed to register")
 
-            logger.info("registered as {}".format(flags["grader_id"]))
+            logger.info(
+                "registered as {} with {} slot(s)".format(
+                    flags["grader_id"], flags["slots"]
+                )
+            )
+
+            slots = [
+                asyncio.ensure_future(_run_slot(flags, ws, jobs, follower))
+                for _ in range(flags["slots"])
+            ]
 
             while True:
                 job = json.loads(await ws.recv())
 
                 validate(instance=job, schema=GRADING_JOB_DEF)
 
-                job_result = await _exec_job(flags, job)
-
-                await ws.send(json.dumps({"type": "job_result", "args": job_result}))
+                jobs.put_nowait(job)
 
         except websockets.ConnectionClosed as e:
             logger.critical("connection closed: {}".format(repr(e)))
@@ -97,6 +226,11 @@ async def _run(flags):
         except SchemaError as e:
             logger.critical("schema error: {}".format(repr(e)))
 
+        finally:
+            for slot in slots:
+                slot.cancel()
+            follower.stop()
+
 
 def _shutdown(sig, task):
     logger.info("signal received: {}, shutting down".format(signal.Signals(sig).name))
@@ -81,6 +81,7 @@ class AsyncHTTPMixin(AsyncHTTPTestCase):
     def tearDown(self):
         super().tearDown()
         database_utils.clear_db(self.app.settings)
+        self.app.settings["DB_EXECUTOR"].shutdown()
 
 
 class ClientMixin(AsyncHTTPMixin):
@@ -233,15 +234,63 @@ class ClientMixin(AsyncHTTPMixin):
             response_body = json.loads(response.body.decode("utf-8"))
             return response_body["data"]
 
-    def get_grading_job_stream(self, course_id, grading_job_id, header, callback):
+    def get_grading_job_stream(
+        self, course_id, grading_job_id, header, callback, **kwargs
+    ):
         # We have to create a new client as to not block other requests while receiving
         # streaming chunks
-        AsyncHTTPClient().fetch(
+        return AsyncHTTPClient().fetch(
             self.get_url("/api/v1/stream/{}/{}".format(course_id, grading_job_id)),
             method="GET",
             headers=header,
             header_callback=lambda _: None,
             streaming_callback=callback,
+            raise_error=False,
+            **kwargs
+        )
+
+    def get_stream_stats(self, header, expected_code=200):
+        response = self.fetch(
+            self.get_url("/api/v1/stream_stats"), method="GET", headers=header
+        )
+        self.assertEqual(response.code, expected_code)
+
+        if response.code == 200:
+            response_body = json.loads(response.body.decode("utf-8"))
+            return response_body["data"]
+
+    def get_course_overview_stream(self, course_id, header, callback):
+        return AsyncHTTPClient().fetch(
+            self.get_url("/api/v1/stream/{}/overview".format(course_id)),
+            method="GET",
+            headers=header,
+            header_callback=lambda _: None,
+            streaming_callback=callback,
+            raise_error=False,
+        )
+
+    def get_grading_run_stream(
+        self, course_id, run_id, header, callback, query="", **kwargs
+    ):
+        return AsyncHTTPClient().fetch(
+            self.get_url("/api/v1/stream/{}/run/{}{}".format(course_id, run_id, query)),
+            method="GET",
+            headers=header,
+            header_callback=lambda _: None,
+            streaming_callback=callback,
+            raise_error=False,
+            **kwargs
+        )
+
+    def wait_for_grading_run(self, course_id, run_id, header):
+        """
+        Blocks until the grading run is over, e.g. after a worker went away and the
+        run is moved along in the background
+        """
+        self.io_loop.run_sync(
+            lambda: self.get_grading_run_stream(
+                course_id, run_id, header, lambda _: None
+            )
         )
 
 
@@ -356,26 +405,46 @@ class WorkerWSMixin(AsyncHTTPMixin):
         )
         return websockets.connect(url, extra_headers=headers)
 
-    def worker_ws_conn_register(self, conn, hostname):
-        return conn.send(
-            json.dumps({"type": "register", "args": {"hostname": hostname}})
-        )
+    def worker_ws_conn_register(self, conn, hostname, slots=None, prefetch=None):
+        args = {"hostname": hostname}
+        if slots is not None:
+            args["slots"] = slots
+        if prefetch is not None:
+            args["prefetch"] = prefetch
+
+        return conn.send(json.dumps({"type": "register", "args": args}))
 
-    def worker_ws_conn_reulst(self, conn, job_id, job_success):
+    async def worker_ws_conn_reulst(self, conn, job_id, job_success, logs=True):
         args = {
             "grading_job_id": job_id,
             "success": job_success,
             "results": [{"res": "container 1 res"}, {"res": "container 2 res"}],
-            "logs": {"stdout": "stdout", "stderr": "stderr"},
         }
+        if logs:
+            args["logs"] = {"stdout": "stdout", "stderr": "stderr"}
+
+        await conn.send(json.dumps({"type": "job_result", "args": args}))
+        await self.worker_ws_conn_sync(conn)
 
-        return conn.send(json.dumps({"type": "job_result", "args": args}))
+    async def worker_ws_conn_log(self, conn, job_id, stream, chunk):
+        args = {"grading_job_id": job_id, "stream": stream, "chunk": chunk}
+        await conn.send(json.dumps({"type": "job_log", "args": args}))
+        await self.worker_ws_conn_sync(conn)
+
+    async def worker_ws_conn_sync(self, conn):
+        """
+        Messages are handled in order, so once a ping is answered, the messages
+        sent before it have been handled
+        """
+        await (await conn.ping())
 
     # need to be closed
-    async def worker_ws(self, worker_id, headers, hostname="eniac"):
+    async def worker_ws(
+        self, worker_id, headers, hostname="eniac", slots=None, prefetch=None
+    ):
         conn = await self.worker_ws_conn(worker_id=worker_id, headers=headers)
 
-        await self.worker_ws_conn_register(conn, hostname)
+        await self.worker_ws_conn_register(conn, hostname, slots, prefetch)
 
         ack = json.loads(await conn.recv())
         self.assertTrue(ack["success"])
@@ -383,5 +452,18 @@ class WorkerWSMixin(AsyncHTTPMixin):
         return conn
 
 
-class BaseTest(WorkerWSMixin, EqualityMixin, ClientMixin, GraderMixin):
+class ClientWSMixin(AsyncHTTPMixin):
+    def client_ws_conn(self, course_id, headers, query=""):
+        url = self.get_url("/api/v1/client_ws/{}{}".format(course_id, query)).replace(
+            "http://", "ws://"
+        )
+        return websockets.connect(url, extra_headers=headers)
+
+    async def client_ws_subscribe(self, conn, job_ids=(), run_ids=(), **kwargs):
+        args = {"job_ids": list(job_ids), "run_ids": list(run_ids), **kwargs}
+        await conn.send(json.dumps({"type": "subscribe", "args": args}))
+        return json.loads(await conn.recv())
+
+
+class BaseTest(WorkerWSMixin, ClientWSMixin, EqualityMixin, ClientMixin, GraderMixin):
     pass
@@ -0,0 +1,98 @@
+"""
+Times the grading run status and env endpoints for a large run. Not collected by
+pytest, run it against a local mongod with
+
+    python -m tests.api.benchmark.bench_run_status
+"""
+
+import logging
+import statistics
+import time
+import unittest
+
+from bson import ObjectId
+
+import broadway.api.daos as daos
+import broadway.api.models as models
+from broadway.api.utils.time import get_time
+
+from tests.api.base import BaseTest
+
+logging.disable(logging.WARNING)
+
+STUDENT_JOBS = 2000
+REQUESTS = 20
+
+
+class RunStatusBenchmark(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.run_id = self._insert_run()
+
+    def _insert_run(self):
+        students_env = [
+            {"STUDENT_ID": "student{}".format(i)} for i in range(STUDENT_JOBS)
+        ]
+        run = models.GradingRun(
+            assignment_id="{}/assignment1".format(self.course1),
+            state=models.GradingRunState.STUDENTS_STAGE,
+            started_at=get_time(),
+            students_env=students_env,
+            student_jobs_left=STUDENT_JOBS // 2,
+        )
+        daos.GradingRunDao(self.app.settings).insert(run)
+
+        # roughly what a finished job of a real assignment stores
+        stages = [
+            {
+                "image": "grader:{}".format(stage),
+                "timeout": 60,
+                "env": {"STAGE": str(stage), "ASSIGNMENT": "assignment1"},
+                "entrypoint": ["/bin/sh", "-c", "make test"],
+            }
+            for stage in range(3)
+        ]
+        results = [{"result": "x" * 1024}] * len(stages)
+
+        jobs = []
+        for i, student_env in enumerate(students_env):
+            finished = i % 2 == 0
+            job = models.GradingJob(
+                job_type=models.GradingJobType.STUDENT,
+                run_id=run.id,
+                id_=str(ObjectId()),
+                course_id=self.course1,
+                queued_at=get_time(),
+                started_at=get_time() if finished else None,
+                finished_at=get_time() if finished else None,
+                results=results if finished else None,
+                success=finished or None,
+            )
+            job.set_stages(stages, {}, student_env)
+            jobs.append(job)
+        daos.GradingJobDao(self.app.settings).insert_many(jobs)
+
+        return run.id
+
+    def _time(self, name, request):
+        timings = []
+        for _ in range(REQUESTS):
+            start = time.perf_counter()
+            request(self.course1, self.run_id, self.client_header1)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        print(
+            "{}: {} jobs, median {:.1f}ms, max {:.1f}ms over {} requests".format(
+                name, STUDENT_JOBS, statistics.median(timings), max(timings), REQUESTS,
+            )
+        )
+
+    def test_status(self):
+        self._time("grading_run_status", self.get_grading_run_state)
+
+    def test_env(self):
+        self._time("grading_run_env", self.get_grading_run_env)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1024,6 +1024,7 @@ class WSEndpointIntegrationTest(BaseTest):
         )
 
         to_sync(conn.close())
+        self.wait_for_grading_run(self.course1, grading_run_id, self.client_header1)
 
         self.check_grading_run_status(
             self.course1,
@@ -1186,6 +1187,114 @@ class WSEndpointIntegrationTest(BaseTest):
         to_sync(conn1.close())
         to_sync(conn2.close())
 
+    # one ws worker with two slots should get both jobs at once
+    def test_one_multi_slot_worker_two_jobs(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+
+        grading_run_ids = [
+            self.start_grading_run(
+                self.course1,
+                "assignment1",
+                self.client_header1,
+                grading_runs.one_student_job,
+                200,
+            )
+            for _ in range(2)
+        ]
+
+        conn = to_sync(self.worker_ws("test_worker", self.get_header(), slots=2))
+
+        student_jobs = [json.loads(to_sync(conn.recv())) for _ in range(2)]
+
+        worker_nodes = self.get_course_worker_nodes(
+            self.course1, "all", self.client_header1, 200
+        )["worker_nodes"]
+        self.assertEqual(2, worker_nodes[0]["running_jobs"])
+        self.assertTrue(worker_nodes[0]["busy"])
+
+        for student_job in reversed(student_jobs):
+            to_sync(
+                self.worker_ws_conn_reulst(
+                    conn, student_job.get("grading_job_id"), True
+                )
+            )
+
+        for grading_run_id in grading_run_ids:
+            self.check_grading_run_status(
+                self.course1,
+                grading_run_id,
+                self.client_header1,
+                200,
+                GradingRunState.FINISHED.value,
+            )
+
+        to_sync(conn.close())
+
+    # the prefetched job of a dead worker should go to another worker
+    def test_prefetched_job_requeued(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+
+        grading_run_ids = [
+            self.start_grading_run(
+                self.course1,
+                "assignment1",
+                self.client_header1,
+                grading_runs.one_student_job,
+                200,
+            )
+            for _ in range(2)
+        ]
+
+        conn1 = to_sync(self.worker_ws("test_worker1", self.get_header(), prefetch=1))
+        running_job = json.loads(to_sync(conn1.recv()))
+        prefetched_job = json.loads(to_sync(conn1.recv()))
+        to_sync(conn1.close())
+
+        conn2 = to_sync(self.worker_ws("test_worker2", self.get_header()))
+        student_job = json.loads(to_sync(conn2.recv()))
+        self.assertEqual(
+            prefetched_job.get("grading_job_id"), student_job.get("grading_job_id")
+        )
+        to_sync(
+            self.worker_ws_conn_reulst(conn2, student_job.get("grading_job_id"), True)
+        )
+
+        job_states = {}
+        for grading_run_id in grading_run_ids:
+            self.check_grading_run_status(
+                self.course1,
+                grading_run_id,
+                self.client_header1,
+                200,
+                GradingRunState.FINISHED.value,
+            )
+            run_state = self.get_grading_run_state(
+                self.course1, grading_run_id, self.client_header1
+            )
+            job_states.update(run_state["student_jobs_state"])
+
+        self.assertEqual(
+            GradingJobState.FAILED.value, job_states[running_job.get("grading_job_id")],
+        )
+        self.assertEqual(
+            GradingJobState.SUCCEEDED.value,
+            job_states[prefetched_job.get("grading_job_id")],
+        )
+
+        to_sync(conn2.close())
+
     # both ws worker and normal worker
     # the first job should be actively pushed to the ws worker
     # and the second job should be queued until the normal worker
@@ -1276,3 +1385,136 @@ class WSEndpointIntegrationTest(BaseTest):
         )
 
         to_sync(conn.close())
+
+    def test_ws_job_log(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        grading_run_id = self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.one_student_job,
+            200,
+        )
+
+        conn = to_sync(self.worker_ws("test_worker", self.get_header()))
+        job_id = json.loads(to_sync(conn.recv()))["grading_job_id"]
+
+        received = []
+        self.get_grading_job_stream(
+            self.course1, job_id, self.client_header1, received.append
+        )
+        # let the stream connect before the output is sent
+        self.get_grading_job_log(self.course1, job_id, self.client_header1, 400)
+
+        to_sync(self.worker_ws_conn_log(conn, job_id, "stdout", "hello "))
+        to_sync(self.worker_ws_conn_log(conn, job_id, "stderr", "oops"))
+        to_sync(self.worker_ws_conn_log(conn, job_id, "stdout", "world"))
+
+        # output is stored as it arrives, in the background
+        for _ in range(100):
+            job_log = self.get_grading_job_log(
+                self.course1, job_id, self.client_header1, 200
+            )
+            if job_log["stdout"] == "hello world":
+                break
+        self.assertEqual({"stdout": "hello world", "stderr": "oops"}, job_log)
+
+        to_sync(self.worker_ws_conn_reulst(conn, job_id, True, logs=False))
+        self.check_grading_run_status(
+            self.course1,
+            grading_run_id,
+            self.client_header1,
+            200,
+            GradingRunState.FINISHED.value,
+        )
+
+        job_log = self.get_grading_job_log(
+            self.course1, job_id, self.client_header1, 200
+        )
+        self.assertEqual({"stdout": "hello world", "stderr": "oops"}, job_log)
+
+        log_events = [
+            json.loads(chunk.split("data: ", 1)[1])["data"]
+            for chunk in b"".join(received).decode().split("\n\n")
+            if '"type": "log"' in chunk
+        ]
+        self.assertEqual(
+            [
+                {"stream": "stdout", "chunk": "hello "},
+                {"stream": "stderr", "chunk": "oops"},
+                {"stream": "stdout", "chunk": "world"},
+            ],
+            log_events,
+        )
+
+        to_sync(conn.close())
+
+    def test_ws_job_log_limit(self):
+        self.app.settings["FLAGS"]["job_log_max_size"] = 4
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.one_student_job,
+            200,
+        )
+
+        conn = to_sync(self.worker_ws("test_worker", self.get_header()))
+        job_id = json.loads(to_sync(conn.recv()))["grading_job_id"]
+
+        # the limit is on bytes, not characters
+        to_sync(self.worker_ws_conn_log(conn, job_id, "stdout", "ab"))
+        to_sync(self.worker_ws_conn_log(conn, job_id, "stdout", "\u00e9\u00e9"))
+        to_sync(self.worker_ws_conn_reulst(conn, job_id, True, logs=False))
+
+        job_log = self.get_grading_job_log(
+            self.course1, job_id, self.client_header1, 200
+        )
+        self.assertEqual(
+            {"stdout": "ab", "stderr": "\n[2 bytes of output truncated]\n"}, job_log
+        )
+
+        to_sync(conn.close())
+
+    def test_ws_job_log_replaced_by_result_logs(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.one_student_job,
+            200,
+        )
+
+        conn = to_sync(self.worker_ws("test_worker", self.get_header()))
+        job_id = json.loads(to_sync(conn.recv()))["grading_job_id"]
+
+        # the output followed while the job ran may miss its end
+        to_sync(self.worker_ws_conn_log(conn, job_id, "stdout", "std"))
+        to_sync(self.worker_ws_conn_reulst(conn, job_id, True))
+
+        job_log = self.get_grading_job_log(
+            self.course1, job_id, self.client_header1, 200
+        )
+        self.assertEqual({"stdout": "stdout", "stderr": "stderr"}, job_log)
+
+        to_sync(conn.close())
@@ -1,11 +1,22 @@
 import logging
 import json
+import websockets
+import unittest.mock as mock
 from collections import deque
 
+from tornado import gen
+from tornado.concurrent import Future
+
+from broadway.api.daos import GradingJobDao
+from broadway.api.utils.streamlimits import StreamLimiter
+from broadway.api.utils.streamqueue import StreamQueue
+from broadway.api.utils.time import get_time
+
 import tests.api._fixtures.grading_configs as grading_configs
 import tests.api._fixtures.grading_runs as grading_runs
 
 from tests.api.base import BaseTest
+from tests.api._utils.asyncio import to_sync
 
 logging.disable(logging.WARNING)
 
@@ -464,6 +475,62 @@ class CourseQueueLengthEndpointTest(BaseTest):
         self.assertLengthEquals(self.course2, self.client_header2, 0)
 
 
+class CourseQueueStatsEndpointTest(BaseTest):
+    def get_course_queue_stats(self, course_id, header, expected_code):
+        response = self.fetch(
+            self.get_url("/api/v1/queue/{}/stats".format(course_id)),
+            method="GET",
+            headers=header,
+        )
+        self.assertEqual(response.code, expected_code)
+
+        if response.code == 200:
+            response_body = json.loads(response.body.decode("utf-8"))
+            return response_body["data"]
+
+    def test_no_token(self):
+        self.get_course_queue_stats(self.course1, None, 401)
+
+    def test_empty_course(self):
+        stats = self.get_course_queue_stats(self.course1, self.client_header1, 200)
+        self.assertEqual(0, stats["queued"])
+        self.assertEqual(0, stats["dispatched_jobs"])
+
+    def test_dispatched_jobs(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.generate_n_student_jobs(3),
+            200,
+        )
+
+        stats = self.get_course_queue_stats(self.course1, self.client_header1, 200)
+        self.assertEqual(3, stats["queued"])
+        self.assertEqual(0, stats["running"])
+
+        worker_id = self.register_worker(self.get_header())
+        job_id = self.poll_job(worker_id, self.get_header())["grading_job_id"]
+
+        stats = self.get_course_queue_stats(self.course1, self.client_header1, 200)
+        self.assertEqual(2, stats["queued"])
+        self.assertEqual(1, stats["running"])
+        self.assertEqual(1, stats["dispatched_jobs"])
+        self.assertGreater(stats["dispatched_work"], 0)
+
+        self.post_job_result(worker_id, self.get_header(), job_id)
+
+        stats = self.get_course_queue_stats(self.course1, self.client_header1, 200)
+        self.assertEqual(0, stats["running"])
+
+
 class GradingJobQueuePositionEndpointTest(BaseTest):
     def assert_position_equals(self, course_id, grading_job_id, header, expected_pos):
         pos = self.get_grading_job_queue_position(
@@ -592,6 +659,9 @@ class StreamEndpointTest(BaseTest):
             def _create_callback(chunks):
                 def _callback(chunk):
                     self.assertNotEqual(len(chunks), 0)
+                    # event IDs depend on the order the jobs are published in
+                    event_id, chunk = chunk.split(b"\n", 1)
+                    self.assertTrue(event_id.startswith(b"id: "))
                     self.assertEqual(chunk, chunks.pop())
 
                 return _callback
@@ -618,3 +688,445 @@ class StreamEndpointTest(BaseTest):
             # Run and post the job
             self.poll_job(worker_id, self.get_header())
             self.post_job_result(worker_id, self.get_header(), job_id)
+
+    def test_run_stream(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        grading_run_id = self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.two_student_job,
+            200,
+        )
+
+        received = []
+        stream = self.get_grading_run_stream(
+            self.course1,
+            grading_run_id,
+            self.client_header_query_token,
+            received.append,
+            "?events=state,run_state",
+        )
+
+        worker_id = self.register_worker(self.get_header())
+        for _ in range(2):
+            job_id = self.poll_job(worker_id, self.get_header())["grading_job_id"]
+            self.post_job_result(worker_id, self.get_header(), job_id)
+
+        self.assertEqual(200, self.io_loop.run_sync(lambda: stream).code)
+
+        events = [
+            json.loads(chunk.split("data: ", 1)[1])
+            for chunk in b"".join(received).decode().split("\n\n")
+            if chunk
+        ]
+        self.assertEqual({"type": "run_state", "data": "STUDENTS_STAGE"}, events[0])
+        self.assertEqual({"type": "run_state", "data": "FINISHED"}, events[-1])
+
+        job_states = [event["data"]["state"] for event in events[1:-1]]
+        self.assertEqual(["STARTED", "FINISHED"] * 2, job_states)
+
+    def _start_job(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        grading_run_id = self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.one_student_job,
+            200,
+        )
+        run_state = self.get_grading_run_state(
+            self.course1, grading_run_id, self.client_header1
+        )
+        return list(run_state["student_jobs_state"].keys())[0]
+
+    def test_stream_finished_job(self):
+        job_id = self._start_job()
+        worker_id = self.register_worker(self.get_header())
+        self.poll_job(worker_id, self.get_header())
+        self.post_job_result(worker_id, self.get_header(), job_id)
+
+        received = []
+        stream = self.get_grading_job_stream(
+            self.course1, job_id, self.client_header1, received.append
+        )
+
+        # the final state is sent right away instead of waiting for events
+        self.assertEqual(200, self.io_loop.run_sync(lambda: stream).code)
+        self.assertIn(b'{"type": "state", "data": "FINISHED"}', b"".join(received))
+
+    def test_stream_cleaned_up_on_disconnect(self):
+        job_id = self._start_job()
+
+        stream = self.get_grading_job_stream(
+            self.course1,
+            job_id,
+            self.client_header1,
+            lambda _: None,
+            request_timeout=0.1,
+        )
+        self.assertEqual(599, self.io_loop.run_sync(lambda: stream).code)
+        self.io_loop.run_sync(lambda: gen.sleep(0.05))
+
+        stats = self.get_stream_stats(self.get_header())
+        self.assertEqual(0, stats["streams"])
+        self.assertEqual(0, stats["heartbeat_connections"])
+        self.assertEqual(0, stats["stream_queue"]["listeners"])
+
+    def test_stream_cleaned_up_on_error(self):
+        job_id = self._start_job()
+
+        # the stream ends with an error after taking its slot
+        with mock.patch.object(
+            StreamQueue, "register_stream", side_effect=RuntimeError("failed")
+        ):
+            stream = self.get_grading_job_stream(
+                self.course1, job_id, self.client_header1, lambda _: None
+            )
+            self.assertEqual(500, self.io_loop.run_sync(lambda: stream).code)
+
+        stats = self.get_stream_stats(self.get_header())
+        self.assertEqual(0, stats["streams"])
+        self.assertEqual(0, stats["heartbeat_connections"])
+
+    def test_idle_stream_of_finished_job(self):
+        self.app.settings["FLAGS"]["stream_idle_timeout"] = 0.05
+        job_id = self._start_job()
+
+        stream = self.get_grading_job_stream(
+            self.course1, job_id, self.client_header1, lambda _: None
+        )
+        self.io_loop.run_sync(lambda: gen.sleep(0.1))
+        self.assertFalse(stream.done())
+
+        # the job ends without its listeners being told
+        job_dao = GradingJobDao(self.app.settings)
+        job = job_dao.find_by_id(job_id)
+        job.started_at = job.finished_at = get_time()
+        job_dao.update(job)
+
+        self.assertEqual(200, self.io_loop.run_sync(lambda: stream).code)
+
+    def test_stream_limit(self):
+        self.app.settings["STREAM_LIMITER"] = StreamLimiter(max_course_streams=1)
+        job_id = self._start_job()
+
+        self.get_grading_job_stream(
+            self.course1, job_id, self.client_header1, lambda _: None
+        )
+        # the stream is only counted once its course token has been checked
+        for _ in range(100):
+            stats = self.get_stream_stats(self.get_header())
+            if stats["streams"]:
+                break
+        self.assertEqual(
+            {"streams": 1, "course_streams": {self.course1: 1}},
+            {
+                key: value
+                for key, value in stats.items()
+                if key in ("streams", "course_streams")
+            },
+        )
+
+        stream = self.get_grading_job_stream(
+            self.course1, job_id, self.client_header1, lambda _: None
+        )
+        self.assertEqual(503, self.io_loop.run_sync(lambda: stream).code)
+
+    def test_stream_stats_wrong_token(self):
+        self.get_stream_stats(self.client_header1, 401)
+
+    def test_overview_stream(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        grading_run_id = self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.two_student_job,
+            200,
+        )
+        worker_id = self.register_worker(self.get_header())
+        job_id = self.poll_job(worker_id, self.get_header())["grading_job_id"]
+        self.post_job_result(worker_id, self.get_header(), job_id, job_success=False)
+
+        received = Future()
+        self.get_course_overview_stream(
+            self.course1,
+            self.client_header1,
+            lambda chunk: received.done() or received.set_result(chunk),
+        )
+        chunk = self.io_loop.run_sync(lambda: received).decode()
+        overview = json.loads(chunk.split("data: ", 1)[1])
+
+        self.assertEqual("overview", overview["type"])
+        self.assertEqual(1, overview["data"]["queue_length"])
+        self.assertEqual(
+            [
+                {
+                    "grading_run_id": grading_run_id,
+                    "state": "STUDENTS_STAGE",
+                    "total_jobs": 2,
+                    "finished_jobs": 1,
+                    "failed_jobs": 1,
+                }
+            ],
+            overview["data"]["runs"],
+        )
+        self.assertEqual(1, overview["data"]["throughput"]["finished_jobs"])
+
+    def test_overview_stream_member(self):
+        stream = self.get_course_overview_stream(
+            self.course1, self.client_header_query_token, lambda _: None
+        )
+        self.assertEqual(401, self.io_loop.run_sync(lambda: stream).code)
+
+    def test_batched_run_stream_disconnect(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        grading_run_id = self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.one_student_job,
+            200,
+        )
+
+        with mock.patch.object(
+            StreamQueue,
+            "has_run_update",
+            autospec=True,
+            side_effect=StreamQueue.has_run_update,
+        ) as has_run_update:
+            stream = self.get_grading_run_stream(
+                self.course1,
+                grading_run_id,
+                self.client_header1,
+                lambda _: None,
+                query="?batch=300",
+                request_timeout=0.2,
+            )
+            for _ in range(100):
+                if self.get_stream_stats(self.get_header())["streams"]:
+                    break
+
+            # the client goes away while the job's state change is being batched
+            worker_id = self.register_worker(self.get_header())
+            self.poll_job(worker_id, self.get_header())
+            self.assertEqual(599, self.io_loop.run_sync(lambda: stream).code)
+            self.io_loop.run_sync(lambda: gen.sleep(0.3))
+
+            has_run_update.assert_not_called()
+
+    def test_run_stream_wrong_course(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        grading_run_id = self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.one_student_job,
+            200,
+        )
+
+        stream = self.get_grading_run_stream(
+            self.course2, grading_run_id, self.client_header2, lambda _: None
+        )
+        self.assertEqual(400, self.io_loop.run_sync(lambda: stream).code)
+
+
+class ClientWSEndpointTest(BaseTest):
+    def _start_two_student_run(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        grading_run_id = self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.two_student_job,
+            200,
+        )
+        run_state = self.get_grading_run_state(
+            self.course1, grading_run_id, self.client_header1
+        )
+        return grading_run_id, list(run_state["student_jobs_state"].keys())
+
+    def test_wrong_token(self):
+        conn = to_sync(self.client_ws_conn(self.course1, self.client_header2))
+        with self.assertRaises(websockets.ConnectionClosed):
+            to_sync(conn.recv())
+        self.assertEqual(1008, conn.close_code)
+
+    def test_subscribe_other_course(self):
+        _, job_ids = self._start_two_student_run()
+
+        conn = to_sync(self.client_ws_conn(self.course2, self.client_header2))
+        ack = to_sync(self.client_ws_subscribe(conn, job_ids=job_ids))
+        self.assertFalse(ack["success"])
+        to_sync(conn.close())
+
+    def test_subscribe(self):
+        grading_run_id, job_ids = self._start_two_student_run()
+
+        conn = to_sync(
+            self.client_ws_conn(
+                self.course1, self.client_header_query_token, "?batch=10"
+            )
+        )
+        ack = to_sync(
+            self.client_ws_subscribe(conn, job_ids=job_ids, run_ids=[grading_run_id])
+        )
+        self.assertTrue(ack["success"])
+
+        worker_id = self.register_worker(self.get_header())
+        for _ in range(2):
+            job_id = self.poll_job(worker_id, self.get_header())["grading_job_id"]
+            self.post_job_result(worker_id, self.get_header(), job_id)
+
+        events = []
+        while {"grading_run_id": grading_run_id, "type": "close"} not in events:
+            message = json.loads(to_sync(conn.recv()))
+            self.assertEqual("events", message["type"])
+            events.extend(message["events"])
+        to_sync(conn.close())
+
+        for job_id in job_ids:
+            job_states = [
+                event["data"]
+                for event in events
+                if event.get("grading_job_id") == job_id and event["type"] == "state"
+            ]
+            self.assertEqual(["STARTED", "FINISHED"], job_states)
+            self.assertIn({"grading_job_id": job_id, "type": "close"}, events)
+
+        run_states = [
+            event["data"]
+            for event in events
+            if event.get("grading_run_id") == grading_run_id
+            and event["type"] == "run_state"
+        ]
+        self.assertEqual(["FINISHED"], run_states)
+
+    def test_subscribe_limit(self):
+        self.app.settings["STREAM_LIMITER"] = StreamLimiter(max_course_streams=1)
+        grading_run_id, job_ids = self._start_two_student_run()
+
+        conn = to_sync(self.client_ws_conn(self.course1, self.client_header1))
+        ack = to_sync(self.client_ws_subscribe(conn, job_ids=job_ids))
+        self.assertFalse(ack["success"])
+        ack = to_sync(self.client_ws_subscribe(conn, job_ids=job_ids[:1]))
+        self.assertTrue(ack["success"])
+        ack = to_sync(self.client_ws_subscribe(conn, run_ids=[grading_run_id]))
+        self.assertFalse(ack["success"])
+
+        to_sync(
+            conn.send(
+                json.dumps({"type": "unsubscribe", "args": {"job_ids": job_ids[:1]}})
+            )
+        )
+        self.assertEqual("unsubscribe", json.loads(to_sync(conn.recv()))["type"])
+        ack = to_sync(self.client_ws_subscribe(conn, run_ids=[grading_run_id]))
+        self.assertTrue(ack["success"])
+
+        to_sync(conn.close())
+        # the slot is given back once the server sees the connection close
+        for _ in range(100):
+            stats = self.get_stream_stats(self.get_header())
+            if not stats["streams"]:
+                break
+        self.assertEqual(0, stats["streams"])
+
+    def test_subscribe_finished(self):
+        self.app.settings["STREAM_LIMITER"] = StreamLimiter(max_course_streams=1)
+        grading_run_id, job_ids = self._start_two_student_run()
+        worker_id = self.register_worker(self.get_header())
+        for _ in range(2):
+            job_id = self.poll_job(worker_id, self.get_header())["grading_job_id"]
+            self.post_job_result(worker_id, self.get_header(), job_id)
+        self.wait_for_grading_run(self.course1, grading_run_id, self.client_header1)
+
+        # jobs and runs that are over are closed right away, without a stream slot
+        conn = to_sync(self.client_ws_conn(self.course1, self.client_header1))
+        ack = to_sync(
+            self.client_ws_subscribe(conn, job_ids=job_ids, run_ids=[grading_run_id])
+        )
+        self.assertTrue(ack["success"])
+
+        message = json.loads(to_sync(conn.recv()))
+        self.assertEqual("events", message["type"])
+        for job_id in job_ids:
+            self.assertIn(
+                {"grading_job_id": job_id, "type": "state", "data": "FINISHED"},
+                message["events"],
+            )
+            self.assertIn(
+                {"grading_job_id": job_id, "type": "close"}, message["events"]
+            )
+        self.assertIn(
+            {"grading_run_id": grading_run_id, "type": "run_state", "data": "FINISHED"},
+            message["events"],
+        )
+        self.assertIn(
+            {"grading_run_id": grading_run_id, "type": "close"}, message["events"]
+        )
+        self.assertEqual(0, self.get_stream_stats(self.get_header())["streams"])
+
+        to_sync(conn.close())
+
+    def test_subscribe_idle_timeout(self):
+        self.app.settings["FLAGS"]["stream_idle_timeout"] = 0.05
+        _, job_ids = self._start_two_student_run()
+
+        conn = to_sync(self.client_ws_conn(self.course1, self.client_header1))
+        ack = to_sync(self.client_ws_subscribe(conn, job_ids=job_ids[:1]))
+        self.assertTrue(ack["success"])
+
+        # the job is over without anything being published for it
+        job_dao = GradingJobDao(self.app.settings)
+        job = job_dao.find_by_id(job_ids[0])
+        job.started_at = job.finished_at = get_time()
+        job_dao.update(job)
+
+        message = json.loads(to_sync(conn.recv()))
+        self.assertEqual(
+            {
+                "type": "events",
+                "events": [{"grading_job_id": job_ids[0], "type": "close"}],
+            },
+            message,
+        )
+        self.assertEqual(0, self.get_stream_stats(self.get_header())["streams"])
+
+        to_sync(conn.close())
@@ -1,13 +1,25 @@
 import logging
 import time
 import json
+import unittest.mock as mock
 import websockets
 
+from bson import ObjectId
+
+import tests.api._fixtures.grading_configs as grading_configs
+import tests.api._fixtures.grading_runs as grading_runs
 from tests.api.base import BaseTest
 
+import tornado.gen
 import tornado.testing
 
+from tornado.websocket import WebSocketClosedError
+
 from broadway.api.callbacks import worker_heartbeat_callback
+from broadway.api.callbacks.worker import worker_schedule_job
+from broadway.api.daos import GradingJobDao, WorkerNodeDao
+from broadway.api.models import GradingJob, GradingJobType, WorkerNode
+from broadway.api.utils.time import get_time
 
 logging.disable(logging.WARNING)
 
@@ -24,7 +36,7 @@ class RegisterGraderEndpointsTest(BaseTest):
     def test_reregister_id(self):
         worker_id = self.register_worker(self.get_header(), expected_code=200)
         time.sleep(self.app.settings["FLAGS"]["heartbeat_interval"] * 2 + 1)
-        worker_heartbeat_callback(self.app.settings)
+        self.io_loop.run_sync(lambda: worker_heartbeat_callback(self.app.settings))
         self.register_worker(self.get_header(), worker_id=worker_id, expected_code=200)
 
     def test_unauthorized(self):
@@ -50,6 +62,60 @@ class PollGradingJobEndpointsTest(BaseTest):
         worker_id = self.register_worker(self.get_header())
         self.assertEqual(self.poll_job(worker_id, self.get_header()), 498)
 
+    def test_empty_long_poll(self):
+        worker_id = self.register_worker(self.get_header())
+        response = self.fetch(
+            self.get_url("/api/v1/grading_job/{}?wait=0.1".format(worker_id)),
+            method="GET",
+            headers=self.get_header(),
+        )
+        self.assertEqual(response.code, 498)
+        self.assertEqual(0, self.app.settings["WORKER_REGISTRY"].get_parked_count())
+
+    def test_long_poll(self):
+        worker_id = self.register_worker(self.get_header())
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+
+        async def poll_then_start_run():
+            poll = self.http_client.fetch(
+                self.get_url("/api/v1/grading_job/{}?wait=5".format(worker_id)),
+                method="GET",
+                headers=self.get_header(),
+                raise_error=False,
+            )
+            await tornado.gen.sleep(0.1)
+
+            await self.http_client.fetch(
+                self.get_url("/api/v1/grading_run/{}/assignment1".format(self.course1)),
+                method="POST",
+                headers=self.client_header1,
+                body=json.dumps(grading_runs.one_student_job),
+            )
+            return await poll
+
+        response = self.io_loop.run_sync(poll_then_start_run)
+        self.assertEqual(response.code, 200)
+
+    def test_long_poll_disconnect(self):
+        worker_id = self.register_worker(self.get_header())
+        response = self.fetch(
+            self.get_url("/api/v1/grading_job/{}?wait=5".format(worker_id)),
+            method="GET",
+            headers=self.get_header(),
+            request_timeout=0.2,
+        )
+        self.assertEqual(response.code, 599)
+
+        # the request is no longer parked once its worker went away
+        self.io_loop.run_sync(lambda: tornado.gen.sleep(0.05))
+        self.assertEqual(0, self.app.settings["WORKER_REGISTRY"].get_parked_count())
+
 
 class UpdateGradingJobEndpointsTest(BaseTest):
     def test_unauthorized(self):
@@ -80,6 +146,98 @@ class HeartBeatEndpointsTest(BaseTest):
         worker_id = self.register_worker(self.get_header())
         self.send_heartbeat(worker_id, self.get_header())
 
+    def test_heartbeats_written_together(self):
+        worker_id = self.register_worker(self.get_header())
+        worker_dao = WorkerNodeDao(self.app.settings)
+        registered_at = worker_dao.find_by_id(worker_id).last_seen
+
+        # heartbeats are kept in memory until the heartbeat callback runs
+        time.sleep(0.01)
+        self.send_heartbeat(worker_id, self.get_header())
+        self.assertEqual(registered_at, worker_dao.find_by_id(worker_id).last_seen)
+
+        self.io_loop.run_sync(lambda: worker_heartbeat_callback(self.app.settings))
+        self.assertGreater(worker_dao.find_by_id(worker_id).last_seen, registered_at)
+
+
+class ScheduleJobTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.worker = WorkerNode(id_="worker1", hostname="eniac", use_ws=True)
+        self.app.settings["WORKER_REGISTRY"].add(self.worker)
+        self.conn = mock.Mock()
+        self.app.settings["WS_CONN_MAP"][self.worker.id] = self.conn
+
+    def _schedule(self):
+        self.io_loop.run_sync(lambda: worker_schedule_job(self.app.settings))
+
+    def test_missing_job_released(self):
+        queue = self.app.settings["QUEUE"]
+        queue.push(self.course1, str(ObjectId()))
+
+        self._schedule()
+        self.assertEqual(0, queue.get_stats(self.course1)["running"])
+        self.assertEqual([], self.worker.running_job_ids)
+
+    def _queue_job(self):
+        job = GradingJob(
+            job_type=GradingJobType.STUDENT,
+            run_id="run1",
+            course_id=self.course1,
+            queued_at=get_time(),
+        )
+        GradingJobDao(self.app.settings).insert(job)
+        self.app.settings["QUEUE"].push(self.course1, job.id, group="run1")
+        return job.id
+
+    def test_failed_send_requeued(self):
+        job_id = self._queue_job()
+        self.conn.send.side_effect = WebSocketClosedError()
+        self._schedule()
+
+        # the job is put back where it was, and the worker is no longer used
+        queue = self.app.settings["QUEUE"]
+        self.assertEqual(0, queue.get_position_in_queue(self.course1, job_id))
+        self.assertEqual(0, queue.get_stats(self.course1)["running"])
+        self.assertEqual([], self.worker.running_job_ids)
+        self.assertIsNone(self.app.settings["WORKER_REGISTRY"].get_idle_worker())
+        self.assertIsNone(
+            GradingJobDao(self.app.settings).find_by_id(job_id).started_at
+        )
+
+    def test_database_error_keeps_worker(self):
+        job_id = self._queue_job()
+        with mock.patch.object(
+            GradingJobDao, "update", side_effect=RuntimeError("database down")
+        ):
+            self._schedule()
+
+        queue = self.app.settings["QUEUE"]
+        self.assertEqual(0, queue.get_position_in_queue(self.course1, job_id))
+        self.assertEqual(0, queue.get_stats(self.course1)["running"])
+        self.assertEqual([], self.worker.running_job_ids)
+        self.assertEqual(
+            self.worker, self.app.settings["WORKER_REGISTRY"].get_idle_worker()
+        )
+        self.conn.send.assert_not_called()
+
+    def test_worker_lost_while_assigning(self):
+        job_id = self._queue_job()
+        conn_map = self.app.settings["WS_CONN_MAP"]
+
+        def lose_worker(job):
+            # what closing the connection and handling the lost worker amount to
+            del conn_map[self.worker.id]
+            self.worker.running_job_ids = []
+
+        with mock.patch.object(GradingJobDao, "update", side_effect=lose_worker):
+            self._schedule()
+
+        # the job is left to the lost worker's handling, rather than requeued
+        queue = self.app.settings["QUEUE"]
+        self.assertEqual(-1, queue.get_position_in_queue(self.course1, job_id))
+        self.assertEqual(1, queue.get_stats(self.course1)["running"])
+
 
 class WorkerWSEndpointTest(BaseTest):
     @tornado.testing.gen_test
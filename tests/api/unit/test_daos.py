@@ -1,6 +1,9 @@
 import datetime as dt
 import logging
 
+from bson import ObjectId
+from pymongo.errors import DocumentTooLarge
+
 import broadway.api.daos as daos
 import broadway.api.models as models
 
@@ -31,7 +34,10 @@ class AssignmentConfigDaoTest(BaseTest):
 
     def test_insert(self):
         result = self._insert_obj()
-        self.assertIsNotNone(result.inserted_id)
+        self.assertEqual(
+            AssignmentConfigDaoTest.DEFAULT_OBJECT.id, str(result.inserted_id)
+        )
+        self.assertIsNotNone(self.dao.find_by_id(str(result.inserted_id)))
 
     def test_find_by_id(self):
         result = self._insert_obj()
@@ -98,7 +104,10 @@ class GradingJobLogDaoTest(BaseTest):
 
     def test_insert(self):
         result = self._insert_obj()
-        self.assertIsNotNone(result.inserted_id)
+        self.assertEqual(
+            GradingJobLogDaoTest.DEFAULT_OBJECT.id, str(result.inserted_id)
+        )
+        self.assertIsNotNone(self.dao.find_by_id(str(result.inserted_id)))
 
     def test_find_by_id(self):
         result = self._insert_obj()
@@ -117,6 +126,28 @@ class GradingJobLogDaoTest(BaseTest):
         result = self.dao.find_by_id("$$$")
         self.assertIsNone(result)
 
+    def test_insert_too_large(self):
+        output = "x" * self.app.settings["DB"].max_bson_size
+        with self.assertRaises(DocumentTooLarge):
+            self.dao.insert(models.GradingJobLog(job_id="job_id", stdout=output))
+        with self.assertRaises(DocumentTooLarge):
+            self.dao.append("job_id", stdout=output)
+        self.assertIsNone(self.dao.find_by_job_id("job_id"))
+
+    def test_append(self):
+        self.dao.append("job_id", stdout="out")
+        self.dao.append("job_id", stdout="put", stderr="errors")
+        self.dao.append("job_id")
+
+        obj = self.dao.find_by_job_id("job_id")
+        self.assertEqual("output", obj.stdout)
+        self.assertEqual("errors", obj.stderr)
+
+        self.dao.append("other_job_id")
+        obj = self.dao.find_by_job_id("other_job_id")
+        self.assertEqual("", obj.stdout)
+        self.assertEqual("", obj.stderr)
+
 
 class GradingJobDaoTest(BaseTest):
 
@@ -139,7 +170,24 @@ class GradingJobDaoTest(BaseTest):
 
     def test_insert(self):
         result = self._insert_obj()
-        self.assertIsNotNone(result.inserted_id)
+        self.assertEqual(GradingJobDaoTest.DEFAULT_OBJECT.id, str(result.inserted_id))
+        self.assertIsNotNone(self.dao.find_by_id(str(result.inserted_id)))
+
+    def test_insert_many(self):
+        objs = [
+            models.GradingJob(
+                job_type=models.GradingJobType.STUDENT,
+                run_id="run123",
+                id_=str(ObjectId()),
+            )
+            for _ in range(3)
+        ]
+        result = self.dao.insert_many(objs)
+
+        self.assertEqual([obj.id for obj in objs], list(map(str, result.inserted_ids)))
+        for inserted_id in result.inserted_ids:
+            self.assertEqual(str(inserted_id), self.dao.find_by_id(inserted_id).id)
+        self.assertEqual(3, len(self.dao.find_by_run_id("run123")))
 
     def test_find_by_id(self):
         result = self._insert_obj()
@@ -164,6 +212,26 @@ class GradingJobDaoTest(BaseTest):
         self.assertEqual(len(objs), 1)
         self.assertEqual(objs[0].id, str(result.inserted_id))
 
+    def test_find_projected_by_run_id(self):
+        self.dao.insert(
+            models.GradingJob(
+                job_type=models.GradingJobType.STUDENT,
+                run_id="run123",
+                queued_at=dt.datetime.utcnow(),
+                stages=[{"image": "alpine", "env": {"STUDENT_ID": "example"}}],
+                results=[{"result": "ok"}],
+            )
+        )
+
+        obj = self.dao.find_states_by_run_id("run123")[0]
+        self.assertEqual(models.GradingJobState.QUEUED, obj.get_state())
+        self.assertIsNone(obj.stages)
+        self.assertIsNone(obj.results)
+
+        obj = self.dao.find_envs_by_run_id("run123")[0]
+        self.assertEqual([{"env": {"STUDENT_ID": "example"}}], obj.stages)
+        self.assertIsNone(obj.results)
+
     def test_update(self):
         insert_result = self._insert_obj()
         obj = self.dao.find_by_id(insert_result.inserted_id)
@@ -191,7 +259,8 @@ class GradingRunDaoTest(BaseTest):
 
     def test_insert(self):
         result = self._insert_obj()
-        self.assertIsNotNone(result.inserted_id)
+        self.assertEqual(GradingRunDaoTest.DEFAULT_OBJECT.id, str(result.inserted_id))
+        self.assertIsNotNone(self.dao.find_by_id(str(result.inserted_id)))
 
     def test_find_by_id(self):
         result = self._insert_obj()
@@ -214,6 +283,64 @@ class GradingRunDaoTest(BaseTest):
 
         self.assertGreater(update_result.matched_count, 0)
 
+    def test_update_changed_fields(self):
+        insert_result = self._insert_obj()
+        obj = self.dao.find_by_id(insert_result.inserted_id)
+        # nothing to write
+        self.assertIsNone(self.dao.update(obj))
+
+        # fields that did not change are not overwritten
+        self.dao._collection.update_one(
+            {daos.GradingRunDao.ID: insert_result.inserted_id},
+            {"$set": {daos.GradingRunDao.STUDENTS_ENV: []}},
+        )
+        obj.state = models.GradingRunState.STUDENTS_STAGE
+        self.dao.update(obj)
+
+        updated = self.dao.find_by_id(insert_result.inserted_id)
+        self.assertEqual(models.GradingRunState.STUDENTS_STAGE, updated.state)
+        self.assertEqual([], updated.students_env)
+
+    def test_update_too_large_keeps_changes(self):
+        insert_result = self._insert_obj()
+        obj = self.dao.find_by_id(insert_result.inserted_id)
+
+        obj.state = models.GradingRunState.STUDENTS_STAGE
+        obj.student_jobs_left -= 1
+        obj.students_env = [{"override": "x" * self.app.settings["DB"].max_bson_size}]
+        with self.assertRaises(DocumentTooLarge):
+            self.dao.update(obj)
+
+        # the changes that failed to be written are written by the next update
+        obj.students_env = []
+        self.dao.update(obj)
+        updated = self.dao.find_by_id(insert_result.inserted_id)
+        self.assertEqual(models.GradingRunState.STUDENTS_STAGE, updated.state)
+        self.assertEqual(0, updated.student_jobs_left)
+        self.assertEqual([], updated.students_env)
+
+    def test_decrement_student_jobs_left(self):
+        insert_result = self._insert_obj()
+        run_id = str(insert_result.inserted_id)
+
+        obj = self.dao.decrement_student_jobs_left(run_id)
+        self.assertEqual(0, obj.student_jobs_left)
+        # the counter does not go below zero
+        self.assertIsNone(self.dao.decrement_student_jobs_left(run_id))
+        self.assertEqual(0, self.dao.find_by_id(run_id).student_jobs_left)
+
+    def test_async_find_by_id(self):
+        insert_result = self._insert_obj()
+        obj = self.io_loop.run_sync(
+            lambda: self.dao.aio.find_by_id(insert_result.inserted_id)
+        )
+
+        self.assertIsNotNone(obj)
+        self.assertEqual(
+            GradingRunDaoTest.DEFAULT_OBJECT.assignment_id, obj.assignment_id
+        )
+        self.assertEqual(daos.GradingRunDao.STATE, self.dao.aio.STATE)
+
 
 class WorkerNodeDaoTest(BaseTest):
 
@@ -229,7 +356,7 @@ class WorkerNodeDaoTest(BaseTest):
 
     def test_insert(self):
         worker_id = self._insert_obj()
-        self.assertIsNotNone(worker_id)
+        self.assertEqual(worker_id, self.dao.find_by_id(worker_id).id)
 
     def test_find_by_hostname(self):
         self._insert_obj()
@@ -251,3 +378,66 @@ class WorkerNodeDaoTest(BaseTest):
         update_result = self.dao.update(obj)
 
         self.assertGreater(update_result.matched_count, 0)
+
+    def test_update_increments_counters(self):
+        worker_id = self._insert_obj()
+        obj1 = self.dao.find_by_id(worker_id)
+        obj2 = self.dao.find_by_id(worker_id)
+
+        obj1.jobs_processed += 1
+        obj2.jobs_processed += 2
+        obj2.running_job_ids.append("job")
+        obj2.mark_changed("running_job_ids")
+        self.dao.update(obj1)
+        self.dao.update(obj2)
+
+        obj = self.dao.find_by_id(worker_id)
+        self.assertEqual(3, obj.jobs_processed)
+        self.assertEqual(["job"], obj.running_job_ids)
+
+    def test_migrate_running_job_id(self):
+        self.dao._collection.insert_many(
+            [
+                {"_id": "busy", "worker_hostname": "a", "running_job_id": "job"},
+                {"_id": "idle", "worker_hostname": "b", "running_job_id": None},
+            ]
+        )
+        self.dao.migrate_running_job_id()
+
+        self.assertEqual(["job"], self.dao.find_by_id("busy").running_job_ids)
+        self.assertEqual([], self.dao.find_by_id("idle").running_job_ids)
+        self.assertEqual(
+            0,
+            self.dao._collection.count_documents({"running_job_id": {"$exists": True}}),
+        )
+
+
+class IndexTest(BaseTest):
+    def test_ensure_indexes(self):
+        # the indexes are ensured when the database is initialized
+        for dao_class in daos.ALL_DAOS:
+            dao = dao_class(self.app.settings)
+            index_keys = [
+                index["key"] for index in dao._collection.index_information().values()
+            ]
+            for index in dao_class._INDEXES:
+                self.assertIn(list(index.document["key"].items()), index_keys)
+
+    def test_no_collection_scans(self):
+        # only the explain support of the database may skip the check, not the DAOs
+        cursor = daos.WorkerNodeDao(self.app.settings)._collection.find()
+        if not hasattr(cursor, "explain"):
+            self.skipTest("the database does not explain queries")
+
+        for dao_class in daos.ALL_DAOS:
+            try:
+                plans = dao_class(self.app.settings).explain_queries()
+            except NotImplementedError:
+                self.skipTest("the database does not explain queries")
+
+            for name, stages in plans.items():
+                self.assertNotIn(
+                    "COLLSCAN",
+                    stages,
+                    "{}.{} scans the collection".format(dao_class.__name__, name),
+                )
@@ -2,14 +2,40 @@ import json
 import logging
 import unittest.mock as mock
 
+from pymongo.errors import WriteError
+from tornado import gen
+
 from broadway.api.utils.bootstrap import (
     initialize_course_tokens,
     initialize_global_settings,
 )
-from broadway.api.utils.multiqueue import MultiQueue
+from broadway.api.utils.heartbeat import HeartbeatScheduler
+from broadway.api.utils.multiqueue import HIGH_PRIORITY, MultiQueue
+from broadway.api.utils.overview import CourseOverview
+from broadway.api.utils.recovery import recover_queue
+from broadway.api.utils.run import continue_grading_run, finish_job, requeue_job
+from broadway.api.utils.streamlimits import StreamLimiter
+from broadway.api.utils.streamqueue import StreamQueue, encode_event
+from broadway.api.utils.time import get_time
+from broadway.api.utils.workerregistry import WorkerRegistry
 
 from broadway.api.flags import app_flags
+from broadway.api.daos.assignment_config import AssignmentConfigDao
 from broadway.api.daos.course import CourseDao
+from broadway.api.daos.grading_job import GradingJobDao
+from broadway.api.daos.grading_run import GradingRunDao
+from broadway.api.daos.worker_node import WorkerNodeDao
+from broadway.api.models import (
+    AssignmentConfig,
+    GradingJob,
+    GradingJobType,
+    GradingRun,
+    GradingRunState,
+    WorkerNode,
+)
+
+import tests.api._fixtures.grading_configs as grading_configs
+import tests.api._fixtures.grading_runs as grading_runs
 
 from tests.api.base import BaseTest
 
@@ -53,6 +79,23 @@ class TestCourseTokenUtils(BaseTest):
         self.assertIn("token2", cs241.query_tokens)
         self.assertNotIn("token2", cs241.tokens)
 
+    def test_init_course_shares(self):
+        course_tokens = {
+            "cs225": {"tokens": ["token1"]},
+            "cs241": {"tokens": ["token1"], "weight": 2.5, "max_concurrency": 4},
+        }
+
+        with mock.patch(
+            "builtins.open", mock.mock_open(read_data=json.dumps(course_tokens))
+        ):
+            initialize_course_tokens(self.app.settings, self.app.settings["FLAGS"])
+
+        queue = self.app.settings["QUEUE"]
+        self.assertEqual(1, queue.weights["cs225"])
+        self.assertIsNone(queue.max_concurrency["cs225"])
+        self.assertEqual(2.5, queue.weights["cs241"])
+        self.assertEqual(4, queue.max_concurrency["cs241"])
+
 
 class TestMultiQueue(BaseTest):
     def setUp(self):
@@ -151,3 +194,798 @@ class TestMultiQueue(BaseTest):
         # the multiqueue should be empty now
         with self.assertRaises(Empty):
             self.multiqueue.pull()
+
+    def test_weighted_pull(self):
+        self.multiqueue.configure("cs225", weight=2)
+
+        for i in range(30):
+            self.multiqueue.push("cs225", "cs225-" + str(i))
+            self.multiqueue.push("cs241", "cs241-" + str(i))
+
+        for _ in range(30):
+            self.multiqueue.pull()
+
+        self.assertEqual(20, self.multiqueue.get_stats("cs225")["dispatched_jobs"])
+        self.assertEqual(10, self.multiqueue.get_stats("cs241")["dispatched_jobs"])
+
+    def test_cost_aware_pull(self):
+        for i in range(10):
+            self.multiqueue.push("cs225", "cs225-" + str(i), cost=10)
+        for i in range(100):
+            self.multiqueue.push("cs241", "cs241-" + str(i), cost=1)
+
+        for _ in range(22):
+            self.multiqueue.pull()
+
+        # equal weights get equal amounts of work, not equal numbers of jobs
+        cs225 = self.multiqueue.get_stats("cs225")
+        cs241 = self.multiqueue.get_stats("cs241")
+        self.assertEqual(2, cs225["dispatched_jobs"])
+        self.assertEqual(20, cs241["dispatched_jobs"])
+        self.assertEqual(cs225["dispatched_work"], cs241["dispatched_work"])
+
+    def test_max_concurrency(self):
+        self.multiqueue.configure("cs225", max_concurrency=1)
+
+        for i in range(3):
+            self.multiqueue.push("cs225", "cs225-" + str(i))
+            self.multiqueue.push("cs241", "cs241-" + str(i))
+
+        self.assertEqual("cs225-0", self.multiqueue.pull())
+        for i in range(3):
+            self.assertEqual("cs241-" + str(i), self.multiqueue.pull())
+
+        # cs225 is at its limit until its running job is released
+        with self.assertRaises(Empty):
+            self.multiqueue.pull()
+
+        self.multiqueue.release("cs225")
+        self.assertEqual("cs225-1", self.multiqueue.pull())
+        self.assertEqual(1, self.multiqueue.get_stats("cs225")["running"])
+
+    def test_groups_take_turns(self):
+        for i in range(10):
+            self.multiqueue.push("cs241", "exam-" + str(i), group="exam")
+        for i in range(2):
+            self.multiqueue.push("cs241", "lab-" + str(i), group="lab")
+
+        # the lab run does not wait behind the whole exam run
+        self.assertEqual(1, self.multiqueue.get_position_in_queue("cs241", "lab-0"))
+        self.assertEqual(3, self.multiqueue.get_position_in_queue("cs241", "lab-1"))
+        self.assertEqual(2, self.multiqueue.get_position_in_queue("cs241", "exam-1"))
+        self.assertEqual(11, self.multiqueue.get_position_in_queue("cs241", "exam-9"))
+
+        expected = ["exam-0", "lab-0", "exam-1", "lab-1", "exam-2", "exam-3"]
+        for elem in expected:
+            self.assertEqual(elem, self.multiqueue.pull())
+
+        self.assertEqual(0, self.multiqueue.get_position_in_queue("cs241", "exam-4"))
+        self.assertEqual(6, self.multiqueue.get_queue_length("cs241"))
+
+    def test_high_priority_first(self):
+        for i in range(3):
+            self.multiqueue.push("cs241", "student-" + str(i), group="exam")
+        self.multiqueue.push(
+            "cs241", "post-processing", group="lab", priority=HIGH_PRIORITY
+        )
+
+        self.assertEqual(
+            0, self.multiqueue.get_position_in_queue("cs241", "post-processing")
+        )
+        self.assertEqual(1, self.multiqueue.get_position_in_queue("cs241", "student-0"))
+        self.assertEqual("post-processing", self.multiqueue.pull())
+        self.assertEqual("student-0", self.multiqueue.pull())
+
+    def test_high_priority_across_courses(self):
+        self.multiqueue.push("cs241", "student-0")
+        self.multiqueue.push("cs241", "student-1")
+        self.multiqueue.push("cs225", "post-processing", priority=HIGH_PRIORITY)
+
+        # cs225 is not in debt, so its high priority job does not wait for its turn
+        self.assertEqual("post-processing", self.multiqueue.pull())
+        self.assertEqual("student-0", self.multiqueue.pull())
+        self.assertEqual("student-1", self.multiqueue.pull())
+
+    def test_high_priority_aging(self):
+        self.multiqueue = MultiQueue(aging=60)
+        with mock.patch("time.monotonic", return_value=0):
+            self.multiqueue.push("cs241", "student-0")
+        with mock.patch("time.monotonic", return_value=30):
+            self.multiqueue.push("cs241", "pre-processing", priority=HIGH_PRIORITY)
+
+        with mock.patch("time.monotonic", return_value=59):
+            self.assertEqual("pre-processing", self.multiqueue.queues["cs241"].peek())
+        with mock.patch("time.monotonic", return_value=60):
+            # the student job has waited long enough to go first
+            self.assertEqual("student-0", self.multiqueue.pull())
+            self.assertEqual("pre-processing", self.multiqueue.pull())
+
+    def test_push_front(self):
+        self.multiqueue.push("cs241", "exam-0", group="exam")
+        self.multiqueue.push("cs241", "lab-0", group="lab")
+        self.multiqueue.push("cs241", "exam-1", group="exam")
+        self.assertEqual("exam-0", self.multiqueue.pull())
+
+        self.multiqueue.push_front("cs241", "exam-0", group="exam")
+
+        self.assertEqual(0, self.multiqueue.get_position_in_queue("cs241", "exam-0"))
+        expected = ["exam-0", "lab-0", "exam-1"]
+        for elem in expected:
+            self.assertEqual(elem, self.multiqueue.pull())
+
+    def test_position_matches_pull_order(self):
+        for i in range(7):
+            self.multiqueue.push("cs241", "a-" + str(i), group="a")
+        for i in range(3):
+            self.multiqueue.push("cs241", "b-" + str(i), group="b")
+        for i in range(5):
+            self.multiqueue.push("cs241", "c-" + str(i), group="c")
+        self.multiqueue.remove("cs241", "a-2")
+
+        positions = {}
+        for elem in ["a-" + str(i) for i in range(7) if i != 2]:
+            positions[elem] = self.multiqueue.get_position_in_queue("cs241", elem)
+        for elem in ["b-" + str(i) for i in range(3)]:
+            positions[elem] = self.multiqueue.get_position_in_queue("cs241", elem)
+        for elem in ["c-" + str(i) for i in range(5)]:
+            positions[elem] = self.multiqueue.get_position_in_queue("cs241", elem)
+
+        # without new pushes the estimates are exact
+        for pos in range(14):
+            self.assertEqual(pos, positions[self.multiqueue.pull()])
+
+    def test_position_after_pull(self):
+        for i in range(10):
+            self.multiqueue.push("cs225", "cs225-" + str(i))
+
+        for i in range(4):
+            self.assertEqual("cs225-" + str(i), self.multiqueue.pull())
+
+        self.assertEqual(-1, self.multiqueue.get_position_in_queue("cs225", "cs225-0"))
+        for i in range(4, 10):
+            self.assertEqual(
+                i - 4, self.multiqueue.get_position_in_queue("cs225", "cs225-" + str(i))
+            )
+
+    def test_remove(self):
+        for i in range(10):
+            self.multiqueue.push("cs225", "cs225-" + str(i))
+
+        # removing from the middle shifts everything behind it
+        self.assertTrue(self.multiqueue.remove("cs225", "cs225-5"))
+        self.assertFalse(self.multiqueue.remove("cs225", "cs225-5"))
+        self.assertEqual(9, self.multiqueue.get_queue_length("cs225"))
+        self.assertEqual(-1, self.multiqueue.get_position_in_queue("cs225", "cs225-5"))
+        self.assertEqual(4, self.multiqueue.get_position_in_queue("cs225", "cs225-4"))
+        self.assertEqual(5, self.multiqueue.get_position_in_queue("cs225", "cs225-6"))
+
+        # removing the head
+        self.assertTrue(self.multiqueue.remove("cs225", "cs225-0"))
+        self.assertEqual(0, self.multiqueue.get_position_in_queue("cs225", "cs225-1"))
+        self.assertEqual(4, self.multiqueue.get_position_in_queue("cs225", "cs225-6"))
+
+        expected = [1, 2, 3, 4, 6, 7, 8, 9]
+        for i in expected:
+            self.assertEqual("cs225-" + str(i), self.multiqueue.pull())
+
+        with self.assertRaises(Empty):
+            self.multiqueue.pull()
+
+    def test_position_with_many_removals(self):
+        for i in range(100):
+            self.multiqueue.push("cs241", i, group=i % 3)
+        for i in range(0, 100, 7):
+            self.multiqueue.remove("cs241", i)
+        for _ in range(10):
+            self.multiqueue.push_front("cs241", self.multiqueue.pull(), group=0)
+        for i in range(100, 150):
+            self.multiqueue.push("cs241", i, group=i % 3)
+        for i in range(101, 150, 5):
+            self.multiqueue.remove("cs241", i)
+
+        queue = self.multiqueue.queues["cs241"]
+        elems = [elem for group in range(3) for elem in queue.get_group(group)]
+        positions = {
+            elem: self.multiqueue.get_position_in_queue("cs241", elem) for elem in elems
+        }
+        self.assertEqual(len(elems), len(set(positions.values())))
+        for pos in range(len(elems)):
+            self.assertEqual(pos, positions[self.multiqueue.pull()])
+
+
+class TestStreamQueue(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.multiqueue = MultiQueue()
+        self.stream_queue = StreamQueue()
+
+    def test_positions_only_for_listeners(self):
+        for i in range(5):
+            self.multiqueue.push("cs241", "cs241-" + str(i))
+
+        self.stream_queue.register_stream("cs241-3", 1)
+        self.multiqueue.update_job_positions(self.stream_queue)
+
+        self.assertEqual(["cs241-3"], self.stream_queue.get_job_ids())
+        self.assertTrue(self.stream_queue.has_update("cs241-3", 1))
+
+    def test_unchanged_position_not_repeated(self):
+        for i in range(5):
+            self.multiqueue.push("cs241", "cs241-" + str(i))
+
+        self.stream_queue.register_stream("cs241-3", 1)
+        self.multiqueue.update_job_positions(self.stream_queue)
+        self.multiqueue.update_job_positions(self.stream_queue)
+        self.assertEqual(
+            encode_event(StreamQueue.POSITION_EVENT, 3, 1),
+            self.stream_queue.get("cs241-3", 1).result(),
+        )
+        self.assertFalse(self.stream_queue.has_update("cs241-3", 1))
+
+        self.multiqueue.pull()
+        self.multiqueue.update_job_positions(self.stream_queue)
+        self.assertEqual(
+            encode_event(StreamQueue.POSITION_EVENT, 2, 2),
+            self.stream_queue.get("cs241-3", 1).result(),
+        )
+
+    def test_coalesced_position_update(self):
+        for i in range(5):
+            self.multiqueue.push("cs241", "cs241-" + str(i))
+
+        self.stream_queue.register_stream("cs241-4", 1)
+        for _ in range(3):
+            self.multiqueue.pull()
+            self.stream_queue.schedule_position_update(self.multiqueue)
+
+        # the update only runs once the IOLoop gets to it
+        self.assertFalse(self.stream_queue.has_update("cs241-4", 1))
+        self.io_loop.run_sync(lambda: None)
+
+        self.assertEqual(
+            encode_event(StreamQueue.POSITION_EVENT, 1, 1),
+            self.stream_queue.get("cs241-4", 1).result(),
+        )
+        self.assertFalse(self.stream_queue.has_update("cs241-4", 1))
+
+    def test_events_shared_between_listeners(self):
+        self.stream_queue.register_stream("job", 1)
+        self.stream_queue.register_stream("job", 2)
+        pending = self.stream_queue.get("job", 2)
+
+        self.stream_queue.update_job_state("job", "STARTED")
+        self.stream_queue.update_job_state("job", "FINISHED")
+
+        started = encode_event(StreamQueue.STATE_EVENT, "STARTED", 1)
+        self.assertEqual(started, pending.result())
+        self.assertEqual(started, self.stream_queue.get("job", 1).result())
+
+        # both listeners read the same chunk, which is only kept until both read it
+        channel = self.stream_queue._streams["job"]
+        self.assertEqual(1, len(channel.events))
+        self.assertIs(
+            self.stream_queue.get("job", 1).result(),
+            self.stream_queue.get("job", 2).result(),
+        )
+        self.assertEqual(0, len(channel.events))
+
+        # listeners only get the events published after they registered
+        self.stream_queue.register_stream("job", 3)
+        self.stream_queue.send_close_event("job")
+        self.assertIsNone(self.stream_queue.get("job", 3).result())
+        self.assertFalse(self.stream_queue.has_update("job", 3))
+        self.assertEqual(1, len(channel.events))
+
+    def test_run_positions(self):
+        for i in range(3):
+            self.multiqueue.push("cs241", "cs241-" + str(i), group="run")
+
+        self.stream_queue.register_run_stream("run", 1)
+        self.multiqueue.update_job_positions(self.stream_queue)
+
+        self.assertEqual(["run"], self.stream_queue.get_run_ids())
+        for i in range(3):
+            self.assertEqual(
+                encode_event(
+                    StreamQueue.POSITION_EVENT,
+                    {"grading_job_id": "cs241-" + str(i), "position": i},
+                    i + 1,
+                ),
+                self.stream_queue.get_run_event("run", 1).result(),
+            )
+        self.assertFalse(self.stream_queue.has_run_update("run", 1))
+
+    def test_run_event_filter(self):
+        self.stream_queue.register_run_stream("run", 1, {StreamQueue.RUN_STATE_EVENT})
+        self.stream_queue.register_run_stream("run", 2)
+
+        self.stream_queue.update_job_state("job", "STARTED", run_id="run")
+        self.stream_queue.update_run_state("run", "FINISHED")
+        self.stream_queue.send_run_close_event("run")
+
+        self.assertEqual(
+            encode_event(StreamQueue.RUN_STATE_EVENT, "FINISHED", 2),
+            self.stream_queue.get_run_event("run", 1).result(),
+        )
+        self.assertIsNone(self.stream_queue.get_run_event("run", 1).result())
+
+        self.assertEqual(
+            encode_event(
+                StreamQueue.STATE_EVENT,
+                {"grading_job_id": "job", "state": "STARTED"},
+                1,
+            ),
+            self.stream_queue.get_run_event("run", 2).result(),
+        )
+
+        self.stream_queue.unregister_run_stream("run", 1)
+        self.stream_queue.unregister_run_stream("run", 2)
+        self.assertEqual([], self.stream_queue.get_run_ids())
+
+    def test_resume_from_last_event_id(self):
+        stream_queue = StreamQueue(replay_size=2, replay_timeout=60)
+        stream_queue.register_stream("job", 1)
+        stream_queue.update_job_state("job", "QUEUED")
+        stream_queue.get("job", 1).result()
+        stream_queue.unregister_stream("job", 1)
+
+        # events published while nobody listens are kept for a while
+        stream_queue.update_queue_position("job", 0)
+        stream_queue.update_job_state("job", "STARTED")
+
+        self.assertTrue(stream_queue.register_stream("job", 2, last_event_id=1))
+        self.assertEqual(
+            encode_event(StreamQueue.POSITION_EVENT, 0, 2),
+            stream_queue.get("job", 2).result(),
+        )
+        self.assertEqual(
+            encode_event(StreamQueue.STATE_EVENT, "STARTED", 3),
+            stream_queue.get("job", 2).result(),
+        )
+        self.assertFalse(stream_queue.has_update("job", 2))
+
+        # the first event no longer fits in the replay buffer
+        self.assertFalse(stream_queue.register_stream("job", 3, last_event_id=0))
+        self.assertTrue(stream_queue.has_update("job", 3))
+
+        # IDs that were not given out by this queue are not resumed from
+        self.assertFalse(stream_queue.register_stream("job", 4, last_event_id=100))
+        self.assertEqual(
+            encode_event(StreamQueue.POSITION_EVENT, 0, 2),
+            stream_queue.get("job", 4).result(),
+        )
+
+    def test_log_backlog(self):
+        stream_queue = StreamQueue(log_backlog=2)
+        stream_queue.register_stream("job", 1)
+
+        for chunk in ("a", "bc", "def", "gh"):
+            stream_queue.update_job_log("job", "stdout", chunk)
+
+        # the listener falls behind after two chunks, so the rest are dropped
+        for chunk in ("a", "bc"):
+            self.assertEqual(
+                {"stream": "stdout", "chunk": chunk},
+                stream_queue.get("job", 1, raw=True).result().data,
+            )
+        self.assertFalse(stream_queue.has_update("job", 1))
+
+        # once it catches up, it is told how much output it missed
+        stream_queue.update_job_log("job", "stderr", "ij")
+        self.assertEqual(
+            {"stream": "stdout", "dropped": 5},
+            stream_queue.get("job", 1, raw=True).result().data,
+        )
+        self.assertEqual(
+            {"stream": "stderr", "chunk": "ij"},
+            stream_queue.get("job", 1, raw=True).result().data,
+        )
+
+    def test_replay_expires(self):
+        stream_queue = StreamQueue(replay_size=2, replay_timeout=0.01)
+        stream_queue.register_stream("job", 1)
+        stream_queue.update_job_state("job", "STARTED")
+        stream_queue.unregister_stream("job", 1)
+        self.assertEqual(["job"], stream_queue.get_job_ids())
+
+        self.io_loop.run_sync(lambda: gen.sleep(0.05))
+        self.assertEqual([], stream_queue.get_job_ids())
+
+
+class TestHeartbeatScheduler(BaseTest):
+    def test_beat(self):
+        scheduler = HeartbeatScheduler(batch_size=2)
+        conns = [mock.Mock() for _ in range(5)]
+        for conn in conns:
+            scheduler.register(conn)
+        scheduler.unregister(conns[0])
+
+        self.io_loop.run_sync(scheduler.beat)
+
+        conns[0].send_heartbeat.assert_not_called()
+        for conn in conns[1:]:
+            conn.send_heartbeat.assert_called_once_with()
+
+    def test_beat_failing_connection(self):
+        scheduler = HeartbeatScheduler(batch_size=2)
+        conns = [mock.Mock() for _ in range(3)]
+        conns[0].send_heartbeat.side_effect = RuntimeError("finished")
+        for conn in conns:
+            scheduler.register(conn)
+
+        self.io_loop.run_sync(scheduler.beat)
+
+        for conn in conns[1:]:
+            conn.send_heartbeat.assert_called_once_with()
+
+    def test_timer_stopped_without_connections(self):
+        scheduler = HeartbeatScheduler()
+        conn = mock.Mock()
+
+        scheduler.register(conn)
+        self.assertTrue(scheduler._callback.is_running())
+
+        scheduler.unregister(conn)
+        self.assertIsNone(scheduler._callback)
+        self.assertEqual(0, scheduler.get_connection_count())
+
+
+class TestStreamLimiter(BaseTest):
+    def test_limits(self):
+        limiter = StreamLimiter(max_streams=3, max_course_streams=2)
+
+        self.assertTrue(limiter.acquire("cs241"))
+        self.assertTrue(limiter.acquire("cs241"))
+        self.assertFalse(limiter.acquire("cs241"))
+        self.assertTrue(limiter.acquire("cs225"))
+        self.assertFalse(limiter.acquire("cs233"))
+
+        limiter.release("cs241")
+        self.assertEqual({"cs241": 1, "cs225": 1}, limiter.get_counts())
+        self.assertTrue(limiter.acquire("cs233"))
+        self.assertEqual(3, limiter.get_total_count())
+
+        # releasing more than was acquired does not free up extra slots
+        limiter.release("cs225")
+        limiter.release("cs225")
+        self.assertEqual(2, limiter.get_total_count())
+
+
+class TestCourseOverview(BaseTest):
+    def test_run_progress(self):
+        overview = CourseOverview()
+        run = GradingRun(
+            "cs241/mp1",
+            GradingRunState.STUDENTS_STAGE,
+            id_="run",
+            students_env=[{}, {}, {}],
+            student_jobs_left=3,
+        )
+        overview.update_run(run)
+
+        run.student_jobs_left -= 1
+        overview.record_finished_job("cs241", "run", failed=True)
+        overview.update_run(run)
+
+        queue = MultiQueue()
+        queue.push("cs241", "job")
+        snapshot = overview.get_overview("cs241", queue, WorkerRegistry())
+        self.assertEqual(1, snapshot["queue_length"])
+        self.assertEqual(
+            [
+                {
+                    "grading_run_id": "run",
+                    "state": "STUDENTS_STAGE",
+                    "total_jobs": 3,
+                    "finished_jobs": 1,
+                    "failed_jobs": 1,
+                }
+            ],
+            snapshot["runs"],
+        )
+        self.assertEqual(1, snapshot["throughput"]["finished_jobs"])
+
+        # finished runs are no longer tracked
+        run.finished_at = "now"
+        overview.update_run(run)
+        self.assertEqual(
+            [], overview.get_overview("cs241", queue, WorkerRegistry())["runs"]
+        )
+
+    def test_throughput_window(self):
+        overview = CourseOverview(window=60)
+        with mock.patch("time.monotonic", return_value=1000):
+            overview.record_finished_job("cs241", "run", failed=False)
+        with mock.patch("time.monotonic", return_value=1030):
+            overview.record_finished_job("cs241", "run", failed=False)
+            overview.record_finished_job("cs225", "run", failed=False)
+            self.assertEqual(2, overview.get_throughput("cs241"))
+
+        with mock.patch("time.monotonic", return_value=1070):
+            self.assertEqual(1, overview.get_throughput("cs241"))
+        with mock.patch("time.monotonic", return_value=1100):
+            self.assertEqual(0, overview.get_throughput("cs241"))
+            self.assertEqual(0, overview.get_throughput("cs241"))
+
+
+class TestWorkerRegistry(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.registry = WorkerRegistry()
+
+    def test_idle_and_busy(self):
+        self.registry.add(WorkerNode(id_="worker1", hostname="eniac", slots=2))
+        self.registry.add(WorkerNode(id_="worker2", hostname="eniac"))
+
+        # idle workers take turns
+        self.assertEqual("worker1", self.registry.get_idle_worker().id)
+        self.registry.assign("worker1", "job1")
+        self.assertEqual("worker2", self.registry.get_idle_worker().id)
+        self.registry.assign("worker2", "job2")
+        self.assertEqual("worker1", self.registry.get_idle_worker().id)
+        self.registry.assign("worker1", "job3")
+
+        self.assertIsNone(self.registry.get_idle_worker())
+        self.assertEqual(2, self.registry.get_busy_count())
+
+        self.registry.release("worker2", "job2")
+        self.assertEqual("worker2", self.registry.get_idle_worker().id)
+        self.assertEqual(1, self.registry.get_busy_count())
+
+    def test_disconnect(self):
+        self.registry.add(WorkerNode(id_="worker1", hostname="eniac"))
+        self.registry.assign("worker1", "job1")
+        self.registry.disconnect("worker1")
+
+        # a disconnected worker keeps its jobs but is never dispatched to again
+        self.registry.release("worker1", "job1")
+        self.assertIsNone(self.registry.get_idle_worker())
+        self.assertIsNotNone(self.registry.remove("worker1"))
+        self.assertIsNone(self.registry.get("worker1"))
+
+    def test_flush(self):
+        worker_dao = WorkerNodeDao(self.app.settings)
+        worker = WorkerNode(id_="worker1", hostname="eniac", use_ws=True)
+        worker_dao.insert(worker)
+
+        self.registry.add(worker)
+        self.registry.assign("worker1", "job1")
+        self.assertEqual([], worker_dao.find_by_id("worker1").running_job_ids)
+
+        self.io_loop.run_sync(lambda: self.registry._flush(self.app.settings))
+        self.assertEqual(["job1"], worker_dao.find_by_id("worker1").running_job_ids)
+
+    def test_failed_flush(self):
+        worker_dao = WorkerNodeDao(self.app.settings)
+        worker = WorkerNode(id_="worker1", hostname="eniac", use_ws=True)
+        worker_dao.insert(worker)
+
+        self.registry.add(worker)
+        self.registry.assign("worker1", "job1")
+        with mock.patch.object(
+            WorkerNodeDao, "bulk_update", side_effect=Exception("write failed")
+        ):
+            self.io_loop.run_sync(lambda: self.registry._flush(self.app.settings))
+        self.assertEqual([], worker_dao.find_by_id("worker1").running_job_ids)
+
+        # the worker is written by the next flush
+        self.io_loop.run_sync(lambda: self.registry._flush(self.app.settings))
+        self.assertEqual(["job1"], worker_dao.find_by_id("worker1").running_job_ids)
+
+    def test_flush_heartbeats(self):
+        worker_dao = WorkerNodeDao(self.app.settings)
+        worker = WorkerNode(id_="worker1", hostname="eniac", use_ws=True)
+        worker_dao.insert(worker)
+        self.registry.add(worker)
+
+        # heartbeats are not written until they are flushed
+        self.registry.touch("worker1", get_time())
+        self.registry.touch_http("worker2", get_time())
+        self.assertIsNone(worker_dao.find_by_id("worker1").last_seen)
+
+        self.io_loop.run_sync(lambda: self.registry.flush_heartbeats(self.app.settings))
+        self.assertIsNotNone(worker_dao.find_by_id("worker1").last_seen)
+
+
+class TestGradingRunUtils(BaseTest):
+    def test_student_jobs_stored_in_bulk(self):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        run_id = self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.two_student_job,
+            200,
+        )
+
+        jobs = GradingJobDao(self.app.settings).find_by_run_id(run_id)
+        self.assertEqual(2, len(jobs))
+
+        queue = self.app.settings["QUEUE"]
+        self.assertEqual(2, queue.get_queue_length(self.course1))
+
+        netids = set()
+        for job in jobs:
+            env = job.stages[0]["env"]
+            # every job gets its own copy of the pipeline
+            self.assertEqual(job.id, env["GRADING_JOB_ID"])
+            self.assertEqual("global1", env["env1"])
+            self.assertNotEqual(-1, queue.get_position_in_queue(self.course1, job.id))
+            netids.add(env["netid"])
+
+        self.assertEqual({"student id 1", "student id 2"}, netids)
+
+    def test_run_with_too_large_jobs_fails(self):
+        settings = self.app.settings
+        half = settings["DB"].max_bson_size // 2
+        AssignmentConfigDao(settings).insert(
+            AssignmentConfig(
+                id_="{}/assignment1".format(self.course1),
+                env={"env1": "x" * half},
+                student_pipeline=[{"image": "alpine:3.5"}],
+            )
+        )
+        # the run and the config fit, but not a job combining them
+        run = GradingRun(
+            assignment_id="{}/assignment1".format(self.course1),
+            state=GradingRunState.READY,
+            students_env=[{"netid": "x" * half}],
+            student_jobs_left=1,
+        )
+        GradingRunDao(settings).insert(run)
+
+        self.assertFalse(
+            self.io_loop.run_sync(lambda: continue_grading_run(settings, run))
+        )
+        self.assertEqual(
+            GradingRunState.FAILED, GradingRunDao(settings).find_by_id(run.id).state
+        )
+        self.assertFalse(settings["QUEUE"].contains_key(self.course1))
+
+    def test_positions_updated_on_requeue(self):
+        settings = self.app.settings
+        settings["STREAM_QUEUE"] = StreamQueue()
+        job_dao = GradingJobDao(settings)
+        jobs = [
+            GradingJob(
+                job_type=GradingJobType.STUDENT,
+                run_id="run1",
+                course_id=self.course1,
+                queued_at=get_time(),
+            )
+            for _ in range(2)
+        ]
+        for job in jobs:
+            job_dao.insert(job)
+        settings["QUEUE"].push(self.course1, jobs[0].id, group="run1")
+        settings["STREAM_QUEUE"].register_stream(jobs[0].id, 1)
+
+        self.io_loop.run_sync(lambda: requeue_job(settings, jobs[1]))
+        self.io_loop.run_sync(lambda: None)
+        self.assertEqual(
+            encode_event(StreamQueue.POSITION_EVENT, 1, 1),
+            settings["STREAM_QUEUE"].get(jobs[0].id, 1).result(),
+        )
+
+    def test_too_large_job_result_fails_job(self):
+        settings = self.app.settings
+        job_dao = GradingJobDao(settings)
+        job = GradingJob(
+            job_type=GradingJobType.STUDENT, run_id="run1", queued_at=get_time()
+        )
+        job_dao.insert(job)
+
+        results = [{"result": "x" * settings["DB"].max_bson_size}]
+        self.io_loop.run_sync(lambda: finish_job(settings, job, True, results))
+
+        stored = job_dao.find_by_id(job.id)
+        self.assertIsNotNone(stored.finished_at)
+        self.assertFalse(stored.success)
+        self.assertEqual(
+            [{"result": "job results are too large to be stored"}], stored.results
+        )
+
+    def test_job_grown_too_large_fails_job(self):
+        settings = self.app.settings
+        job_dao = GradingJobDao(settings)
+        job = GradingJob(
+            job_type=GradingJobType.STUDENT, run_id="run1", queued_at=get_time()
+        )
+        job_dao.insert(job)
+
+        # the result fits, but not along with what is already stored
+        collection = job_dao._collection
+        update_one = collection.update_one
+        failed = []
+
+        def grow_too_large(*args, **kwargs):
+            if not failed:
+                failed.append(args)
+                raise WriteError("BSONObjectTooLarge", 10334)
+            return update_one(*args, **kwargs)
+
+        with mock.patch.object(collection, "update_one", side_effect=grow_too_large):
+            self.io_loop.run_sync(
+                lambda: finish_job(settings, job, True, [{"result": "x"}])
+            )
+
+        stored = job_dao.find_by_id(job.id)
+        self.assertFalse(stored.success)
+        self.assertEqual(
+            [{"result": "job results are too large to be stored"}], stored.results
+        )
+
+
+class TestQueueRecovery(BaseTest):
+    def _start_run(self, num_students):
+        self.upload_grading_config(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_configs.only_student_config,
+            200,
+        )
+        return self.start_grading_run(
+            self.course1,
+            "assignment1",
+            self.client_header1,
+            grading_runs.generate_n_student_jobs(num_students),
+            200,
+        )
+
+    def _restart_queue(self):
+        old_queue = self.app.settings["QUEUE"]
+        self.app.settings["QUEUE"] = MultiQueue()
+        self.io_loop.run_sync(lambda: recover_queue(self.app.settings))
+        return old_queue
+
+    def test_recover_queued_jobs(self):
+        self._start_run(5)
+
+        old_queue = self._restart_queue()
+        new_queue = self.app.settings["QUEUE"]
+
+        self.assertEqual(5, new_queue.get_queue_length(self.course1))
+        for _ in range(5):
+            self.assertEqual(old_queue.pull(), new_queue.pull())
+
+    def test_requeue_lost_job(self):
+        self._start_run(2)
+
+        worker_id = self.register_worker(self.get_header())
+        job_id = self.poll_job(worker_id, self.get_header())["grading_job_id"]
+
+        worker_dao = WorkerNodeDao(self.app.settings)
+        worker = worker_dao.find_by_id(worker_id)
+        worker.is_alive = False
+        worker_dao.update(worker)
+
+        self._restart_queue()
+        queue = self.app.settings["QUEUE"]
+
+        # the lost job keeps its place ahead of the jobs that were still queued
+        self.assertEqual(2, queue.get_queue_length(self.course1))
+        self.assertEqual(0, queue.get_position_in_queue(self.course1, job_id))
+        self.assertEqual(job_id, queue.pull())
+        self.assertIsNone(
+            GradingJobDao(self.app.settings).find_by_id(job_id).started_at
+        )
+        self.assertEqual([], worker_dao.find_by_id(worker_id).running_job_ids)
+
+    def test_running_job_on_live_worker_kept(self):
+        self._start_run(2)
+
+        worker_id = self.register_worker(self.get_header())
+        job_id = self.poll_job(worker_id, self.get_header())["grading_job_id"]
+
+        self._restart_queue()
+        queue = self.app.settings["QUEUE"]
+
+        self.assertEqual(1, queue.get_queue_length(self.course1))
+        self.assertEqual(-1, queue.get_position_in_queue(self.course1, job_id))